@@ -0,0 +1,278 @@
+"""
+Times the analysis and compilation hot paths on synthetic sessions and writes the results as JSON.
+
+    python -m julie.benchmarks.run_benchmarks --size medium --output benchmarks.json
+    python -m julie.benchmarks.run_benchmarks --compare baseline.json benchmarks.json
+
+Everything runs offline: sessions come from julie.benchmarks.synthetic and are written to a temporary directory.
+"""
+
+import os
+
+# Benchmarks never open windows; keep the analysis modules from switching to Qt5Agg on import
+os.environ.setdefault("MPLBACKEND", "Agg")
+
+import argparse
+import json
+import platform
+import statistics
+import subprocess
+import tempfile
+import time
+from dataclasses import asdict
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from julie.benchmarks.synthetic import (SyntheticSessionSpec, make_compiled_session, make_trial_recording,
+                                        make_sorted_spike_indices, make_task_table, make_epochs,
+                                        write_intan_recording)
+from julie.channel_access import ChannelAccessor
+from julie.compile.intan_stream import epoch_digitalin_file, read_spike_tstamps
+from julie.compile.julie_intan_file_per_trial_fields import filter_spikes_with_epochs
+from julie.compile.merge_compiled import add_pickled_dataframes
+from julie.compiled_session import CompiledSession, write_session, read_compiled
+from julie.group_tests import group_differences_for_session
+from julie.raster import prepare_raster
+from julie.responsiveness import score_responsiveness
+from julie.single_channel_analysis import (calculate_binned_spike_rate, calculate_spikerates_per_bin,
+                                           extract_target_channel_data)
+from julie.single_unit_analysis import calculate_spike_timestamps
+
+SIZES = {
+    "small": SyntheticSessionSpec(n_trials=100, n_channels=8),
+    "medium": SyntheticSessionSpec(n_trials=500, n_channels=32),
+    "large": SyntheticSessionSpec(n_trials=2000, n_channels=64),
+}
+NUM_BINS = 10
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark Julie analysis and compilation hot paths.")
+    parser.add_argument("--size", choices=sorted(SIZES), default="medium")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--output", default=None, help="JSON file to write (default benchmarks_<time>.json)")
+    parser.add_argument("--compare", nargs=2, metavar=("BASELINE", "CURRENT"),
+                        help="Compare two result files instead of running")
+    args = parser.parse_args()
+
+    if args.compare:
+        print_comparison(compare_results(*args.compare))
+        return
+
+    results = run_benchmarks(SIZES[args.size], repeat=args.repeat)
+    output = args.output or f"benchmarks_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
+    write_results(results, output)
+    print_results(results)
+    print("Wrote", os.path.abspath(output))
+
+
+def time_call(function, repeat: int = 5, setup=None) -> dict:
+    """
+    Run function repeat times (after one warm-up call) and summarize wall-clock seconds.
+
+    Parameters:
+        function: Called with the result of setup(), or with no arguments if there is no setup.
+        repeat (int): Number of timed calls.
+        setup: Called before every call, outside the timed region.
+
+    Returns:
+        dict: min, median, mean and max seconds, and repeat.
+    """
+    def call():
+        args = () if setup is None else (setup(),)
+        start = time.perf_counter()
+        function(*args)
+        return time.perf_counter() - start
+
+    call()
+    seconds = [call() for _ in range(repeat)]
+    return {
+        "min": min(seconds),
+        "median": statistics.median(seconds),
+        "mean": statistics.fmean(seconds),
+        "max": max(seconds),
+        "repeat": repeat,
+    }
+
+
+def run_benchmarks(spec: SyntheticSessionSpec, repeat: int = 5) -> dict:
+    """
+    Time every benchmark case on sessions generated from spec.
+
+    Returns:
+        dict: Run information (spec, versions, commit) and a list of {name, params, seconds} results.
+    """
+    data = make_compiled_session(spec)
+    channel = spec.channels[0]
+    results = []
+
+    def record(name: str, seconds: dict, **params):
+        results.append({"name": name, "params": params, "seconds": seconds})
+        print(f"{name:<40}{seconds['median']:>12.4f}s")
+
+    # Binning
+    channel_data = extract_target_channel_data(channel, data)
+    spike_trains = channel_data[f"SpikeTimes_{channel.value}"].tolist()
+    epochs = channel_data["EpochStartStop"].tolist()
+    record("calculate_binned_spike_rate",
+           time_call(lambda: [calculate_binned_spike_rate(spikes, epoch, NUM_BINS)
+                              for spikes, epoch in zip(spike_trains, epochs)], repeat),
+           n_trials=spec.n_trials, num_bins=NUM_BINS)
+    record("calculate_spikerates_per_bin",
+           time_call(lambda frame: calculate_spikerates_per_bin(frame, channel, NUM_BINS), repeat,
+                     setup=lambda: channel_data.copy(deep=False)),
+           n_trials=spec.n_trials, num_bins=NUM_BINS)
+
+    # Channel extraction and raster filtering
+    record("extract_target_channel_data",
+           time_call(lambda: [extract_target_channel_data(ch, data) for ch in spec.channels], repeat),
+           n_trials=spec.n_trials, n_channels=spec.n_channels)
+    record("extract_target_channel_data_accessor", _time_with_accessor(data, spec.channels, repeat),
+           n_trials=spec.n_trials, n_channels=spec.n_channels)
+    record("raster_filter",
+           time_call(lambda: filter_raster_spike_times(channel_data, channel), repeat),
+           n_trials=spec.n_trials)
+    record("prepare_raster",
+           time_call(lambda: prepare_raster(channel_data, channel_data[f"SpikeTimes_{channel.value}"]), repeat),
+           n_trials=spec.n_trials)
+    record("score_responsiveness", time_call(lambda: score_responsiveness(data), repeat),
+           n_trials=spec.n_trials, n_channels=spec.n_channels)
+    record("group_differences_for_session",
+           time_call(lambda: group_differences_for_session(data, n_permutations=1000, processes=1), repeat),
+           n_trials=spec.n_trials, n_channels=spec.n_channels, n_permutations=1000)
+
+    # Compilation
+    spike_tstamps_for_channels, epochs_for_task_ids = make_trial_recording(spec)
+    record("filter_spikes_with_epochs",
+           time_call(lambda: [filter_spikes_with_epochs(spike_tstamps_for_channels, epochs_for_task_ids, task_id,
+                                                        spec.sample_rate)
+                              for task_id in epochs_for_task_ids], repeat),
+           n_tasks=len(epochs_for_task_ids), n_channels=spec.n_channels)
+
+    epoch_array = make_epochs(spec)
+    sorted_spikes = make_sorted_spike_indices(spec, float(epoch_array[-1, 1]) + 1.0)
+    task_table = make_task_table(spec, epoch_array)
+    record("calculate_spike_timestamps",
+           time_call(lambda frame: calculate_spike_timestamps(frame, sorted_spikes, spec.sample_rate), repeat,
+                     setup=lambda: task_table.copy()),
+           n_trials=spec.n_trials, n_channels=spec.n_channels, n_units_per_channel=spec.n_units_per_channel)
+
+    # Loading and merging
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        pickle_path = os.path.join(tmp_dir, "session.pk1")
+        data.to_pickle(pickle_path)
+        session_path = os.path.join(tmp_dir, "session.session")
+        write_session(data, session_path)
+
+        record("load_pickle", time_call(lambda: pd.read_pickle(pickle_path), repeat),
+               n_trials=spec.n_trials, n_channels=spec.n_channels)
+        record("load_session", time_call(lambda: read_compiled(session_path), repeat),
+               n_trials=spec.n_trials, n_channels=spec.n_channels)
+        record("load_session_one_channel",
+               time_call(lambda: ChannelAccessor(CompiledSession(session_path)).channel_data(channel), repeat),
+               n_trials=spec.n_trials, n_channels=spec.n_channels)
+
+        intan_epochs = write_intan_recording(spec, tmp_dir)
+        record("epoch_digitalin_file",
+               time_call(lambda: epoch_digitalin_file(os.path.join(tmp_dir, "digitalin.dat"), 10), repeat),
+               n_samples=int(intan_epochs[-1, 1]), n_epochs=len(intan_epochs))
+        record("read_spike_tstamps", time_call(lambda: read_spike_tstamps(os.path.join(tmp_dir, "spike.dat")), repeat),
+               n_channels=spec.n_channels)
+
+        n_merged = 4
+        merge_paths = []
+        for i in range(n_merged):
+            merge_path = os.path.join(tmp_dir, f"part_{i}.pk1")
+            make_compiled_session(SyntheticSessionSpec(**{**asdict(spec), "seed": spec.seed + i})).to_pickle(merge_path)
+            merge_paths.append(merge_path)
+        record("add_pickled_dataframes", time_call(lambda: add_pickled_dataframes(merge_paths), repeat),
+               n_sessions=n_merged, n_trials=spec.n_trials, n_channels=spec.n_channels)
+
+    return {
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "commit": _git_commit(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "pandas": pd.__version__,
+        "machine": platform.machine(),
+        "spec": asdict(spec),
+        "results": results,
+    }
+
+
+def _time_with_accessor(data: pd.DataFrame, channels: list, repeat: int) -> dict:
+    # Build the channel index once per session, then extract every channel from it
+    def extract_all():
+        accessor = ChannelAccessor(data)
+        for channel in channels:
+            extract_target_channel_data(channel, accessor)
+
+    return time_call(extract_all, repeat)
+
+
+def filter_raster_spike_times(channel_data: pd.DataFrame, channel) -> list:
+    """
+    The per-trial spike filtering done by plot_raster_for_monkeys, without the plotting.
+    """
+    filtered_spike_times_list = []
+    for spike_times, (epoch_start, epoch_stop) in zip(channel_data[f"SpikeTimes_{channel.value}"],
+                                                      channel_data["EpochStartStop"]):
+        filtered_spike_times_list.append([spike - epoch_start for spike in spike_times
+                                          if epoch_start <= spike <= epoch_stop])
+    return filtered_spike_times_list
+
+
+def _git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(__file__), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def write_results(results: dict, path: str):
+    with open(path, "w") as f:
+        json.dump(results, f, indent=1)
+
+
+def print_results(results: dict):
+    print(f"{'Benchmark':<40}{'Median (s)':>12}{'Min (s)':>12}")
+    for result in results["results"]:
+        print(f"{result['name']:<40}{result['seconds']['median']:>12.4f}{result['seconds']['min']:>12.4f}")
+
+
+def compare_results(baseline_path: str, current_path: str) -> list[dict]:
+    """
+    Median-time ratios (current / baseline) for benchmarks present in both result files.
+    """
+    with open(baseline_path) as f:
+        baseline = {result["name"]: result for result in json.load(f)["results"]}
+    with open(current_path) as f:
+        current = json.load(f)["results"]
+
+    comparison = []
+    for result in current:
+        if result["name"] not in baseline:
+            continue
+        baseline_seconds = baseline[result["name"]]["seconds"]["median"]
+        current_seconds = result["seconds"]["median"]
+        comparison.append({
+            "name": result["name"],
+            "baseline": baseline_seconds,
+            "current": current_seconds,
+            "ratio": current_seconds / baseline_seconds if baseline_seconds > 0 else float("inf"),
+        })
+    return comparison
+
+
+def print_comparison(comparison: list[dict], threshold: float = 1.2):
+    print(f"{'Benchmark':<40}{'Baseline (s)':>14}{'Current (s)':>14}{'Ratio':>8}")
+    for row in comparison:
+        flag = "  slower" if row["ratio"] > threshold else ""
+        print(f"{row['name']:<40}{row['baseline']:>14.4f}{row['current']:>14.4f}{row['ratio']:>8.2f}{flag}")
+
+
+if __name__ == '__main__':
+    main()
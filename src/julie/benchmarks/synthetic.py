@@ -0,0 +1,291 @@
+"""
+Synthetic sessions shaped like Julie recordings, for benchmarking (and running the live compiler) without Intan
+files or the database.
+"""
+
+import os
+import struct
+from dataclasses import dataclass
+
+import numpy as np
+import pandas as pd
+from clat.intan.channels import Channel
+
+from julie.compile.sqlite_stand_in import (open_stand_in_connections, insert_picture, insert_trial,
+                                           insert_trial_complete)
+
+MONKEY_GROUPS = ["Zombies", "Instigators", "Stranger Things", "Best Frans"]
+
+
+@dataclass
+class SyntheticSessionSpec:
+    """
+    Size and shape of a synthetic session.
+
+    Parameters:
+        n_trials (int): Number of tasks (trials).
+        n_channels (int): Number of channels with spikes (taken from the start of Channel).
+        spike_rate_hz (float): Mean Poisson firing rate of every channel.
+        epoch_duration (tuple): Range of epoch lengths in seconds.
+        inter_trial_interval (tuple): Range of gaps between epochs in seconds.
+        n_monkeys (int): Number of distinct pictures (MonkeyName values).
+        n_units_per_channel (int): Sorted units per channel, for sorted-spike benchmarks.
+        sample_rate (int): Samples per second.
+        seed (int): Random seed; the same spec always gives the same session.
+    """
+    n_trials: int = 500
+    n_channels: int = 32
+    spike_rate_hz: float = 20.0
+    epoch_duration: tuple = (2.0, 2.5)
+    inter_trial_interval: tuple = (0.5, 1.0)
+    n_monkeys: int = 40
+    n_units_per_channel: int = 2
+    sample_rate: int = 30000
+    seed: int = 0
+
+    @property
+    def channels(self) -> list[Channel]:
+        return list(Channel)[:self.n_channels]
+
+
+def make_epochs(spec: SyntheticSessionSpec, rng: np.random.Generator = None) -> np.ndarray:
+    """
+    (n_trials x 2) epoch start and stop times in seconds, back to back with random gaps.
+    """
+    rng = rng if rng is not None else np.random.default_rng(spec.seed)
+    durations = rng.uniform(*spec.epoch_duration, size=spec.n_trials)
+    gaps = rng.uniform(*spec.inter_trial_interval, size=spec.n_trials)
+    starts = np.cumsum(gaps + np.concatenate([[0.0], durations[:-1]]))
+    return np.column_stack([starts, starts + durations])
+
+
+def make_continuous_spikes(spec: SyntheticSessionSpec, duration: float,
+                           rng: np.random.Generator = None) -> dict[Channel, np.ndarray]:
+    """
+    Sorted Poisson spike times in seconds over [0, duration) for every channel.
+    """
+    rng = rng if rng is not None else np.random.default_rng(spec.seed + 1)
+    spike_times_by_channel = {}
+    for channel in spec.channels:
+        n_spikes = rng.poisson(spec.spike_rate_hz * duration)
+        spike_times_by_channel[channel] = np.sort(rng.uniform(0.0, duration, size=n_spikes))
+    return spike_times_by_channel
+
+
+def make_task_table(spec: SyntheticSessionSpec, epochs: np.ndarray = None,
+                    rng: np.random.Generator = None) -> pd.DataFrame:
+    """
+    Task fields in the compiled layout (TaskField, FileName, MonkeyId, MonkeyName, MonkeyGroup, EpochStartStop).
+    """
+    rng = rng if rng is not None else np.random.default_rng(spec.seed + 2)
+    epochs = epochs if epochs is not None else make_epochs(spec)
+    picture_ids = rng.integers(0, spec.n_monkeys, size=spec.n_trials)
+    jpg_ids = 1000 + picture_ids
+    return pd.DataFrame({
+        "TaskField": 1697058623833000 + np.arange(spec.n_trials, dtype=np.int64) * 1000,
+        "FileName": [f"{jpg_id}.JPG" for jpg_id in jpg_ids],
+        "MonkeyId": [str(jpg_id) for jpg_id in jpg_ids],
+        "MonkeyName": [f"{picture_id}M" for picture_id in picture_ids],
+        "MonkeyGroup": [MONKEY_GROUPS[picture_id % len(MONKEY_GROUPS)] for picture_id in picture_ids],
+        "EpochStartStop": [(float(start), float(stop)) for start, stop in epochs],
+    })
+
+
+def make_compiled_session(spec: SyntheticSessionSpec) -> pd.DataFrame:
+    """
+    A session as compile_data writes it: task fields plus SpikeTimes, a dict of Channel -> list of spike
+    times inside each trial's epoch.
+    """
+    rng = np.random.default_rng(spec.seed)
+    epochs = make_epochs(spec, rng)
+    data = make_task_table(spec, epochs, rng)
+    spike_times_by_channel = make_continuous_spikes(spec, float(epochs[-1, 1]) + 1.0, rng)
+
+    bounds_by_channel = {}
+    for channel, spike_times in spike_times_by_channel.items():
+        bounds_by_channel[channel] = (np.searchsorted(spike_times, epochs[:, 0], side="left"),
+                                      np.searchsorted(spike_times, epochs[:, 1], side="right"))
+    data["SpikeTimes"] = [
+        {channel: spike_times_by_channel[channel][lo[row]:hi[row]].tolist()
+         for channel, (lo, hi) in bounds_by_channel.items()}
+        for row in range(spec.n_trials)]
+    return data
+
+
+def make_trial_recording(spec: SyntheticSessionSpec, n_tasks: int = 10) -> tuple[dict, dict]:
+    """
+    One Intan trial directory's worth of data, as read by the per-trial compilation fields.
+
+    Returns:
+        tuple: (spike_tstamps_for_channels, epochs_for_task_ids) with spike times as lists of seconds and epochs
+        as (start, stop) sample indices keyed by task_id.
+    """
+    rng = np.random.default_rng(spec.seed + 3)
+    epochs = make_epochs(SyntheticSessionSpec(n_trials=n_tasks, epoch_duration=spec.epoch_duration,
+                                              inter_trial_interval=spec.inter_trial_interval, seed=spec.seed), rng)
+    spike_times_by_channel = make_continuous_spikes(spec, float(epochs[-1, 1]) + 1.0, rng)
+    spike_tstamps_for_channels = {channel: spike_times.tolist()
+                                  for channel, spike_times in spike_times_by_channel.items()}
+    epochs_for_task_ids = {task_id: (int(start * spec.sample_rate), int(stop * spec.sample_rate))
+                           for task_id, (start, stop) in enumerate(epochs)}
+    return spike_tstamps_for_channels, epochs_for_task_ids
+
+
+def make_sorted_spike_indices(spec: SyntheticSessionSpec, duration: float) -> dict[Channel, dict[str, np.ndarray]]:
+    """
+    Sorted-unit spike sample indices, as in sorted_spikes.pkl: Channel -> unit name -> sample indices.
+    """
+    rng = np.random.default_rng(spec.seed + 4)
+    spike_indices_by_unit_by_channel = {}
+    for channel in spec.channels:
+        units = {}
+        for unit in range(spec.n_units_per_channel):
+            n_spikes = rng.poisson(spec.spike_rate_hz * duration / spec.n_units_per_channel)
+            units[f"Unit {unit}"] = np.sort(rng.integers(0, int(duration * spec.sample_rate), size=n_spikes))
+        spike_indices_by_unit_by_channel[channel] = units
+    return spike_indices_by_unit_by_channel
+
+
+def write_intan_recording(spec: SyntheticSessionSpec, directory: str) -> np.ndarray:
+    """
+    Write a single-file recording of the session as digitalin.dat (epochs alternating between marker bits 0 and
+    1) and a multichannel spike.dat without snapshots, in the Intan RHX formats.
+
+    Returns:
+        np.ndarray: (n_trials x 2) epoch start and stop sample indices.
+    """
+    recording = make_intan_recording(spec)
+    recording.digital_words.tofile(os.path.join(directory, "digitalin.dat"))
+    with open(os.path.join(directory, "spike.dat"), "wb") as f:
+        f.write(recording.spike_file_header)
+        recording.spike_records.tofile(f)
+    return recording.epochs
+
+
+@dataclass
+class IntanRecording:
+    """
+    Contents of a synthetic single-file recording: epochs in samples, the digitalin.dat words, the spike.dat
+    header bytes and its records in time order.
+    """
+    epochs: np.ndarray
+    digital_words: np.ndarray
+    spike_file_header: bytes
+    spike_records: np.ndarray
+
+
+def make_intan_recording(spec: SyntheticSessionSpec) -> IntanRecording:
+    rng = np.random.default_rng(spec.seed + 5)
+    epochs = np.round(make_epochs(spec, rng) * spec.sample_rate).astype(np.int64)
+    n_samples = int(epochs[-1, 1]) + spec.sample_rate
+    digital_words = np.zeros(n_samples, dtype="<u2")
+    for trial, (start, stop) in enumerate(epochs):
+        digital_words[start:stop + 1] = 1 << (trial % 2)
+
+    spike_times_by_channel = make_continuous_spikes(spec, n_samples / spec.sample_rate, rng)
+    channel_names = [channel.value for channel in spike_times_by_channel]
+    n_spikes = [spike_times.size for spike_times in spike_times_by_channel.values()]
+    records = np.zeros(sum(n_spikes), dtype=[("channel", "S5"), ("timestamp", "<i4"), ("spike_id", "u1")])
+    records["channel"] = np.repeat(np.array(channel_names, dtype="S5"), n_spikes)
+    records["timestamp"] = np.concatenate(list(spike_times_by_channel.values())) * spec.sample_rate
+    records["spike_id"] = 1
+    records = records[np.argsort(records["timestamp"], kind="stable")]
+
+    names = ",".join(channel_names).encode() + b"\0"
+    header = (struct.pack("<IH", 0x18f8474b, 1) + b"spike\0" + names + names +
+              struct.pack("<fII", spec.sample_rate, 0, 0))
+    return IntanRecording(epochs, digital_words, header, records)
+
+
+class StandInRecorder:
+    """
+    Plays a synthetic session into a local stand-in of a recording in progress: the Intan files (digitalin.dat,
+    spike.dat, notes.txt) of a single-file experiment directory and the SQLite stand-ins of {date}_recording and
+    photo_metadata (see julie.compile.sqlite_stand_in), advanced a step of recording time at a time.
+
+    Every trial gets a livenote shortly before its epoch and a SlideOff after it; about one trial in
+    twenty is aborted (TrialStop instead of TrialComplete). The first monkey is a new_monkey picture.
+    """
+
+    def __init__(self, spec: SyntheticSessionSpec, directory: str, start_unix: int = 1697058662909405,
+                 first_task_id: int = 1000):
+        self.spec = spec
+        self.directory = directory
+        self.start_unix = start_unix
+        self.recording = make_intan_recording(spec)
+        self.conn_xper, self.conn_photo = open_stand_in_connections(directory)
+        self.elapsed = 0.0
+        self._written = {"digitalin": 0, "spikes": 0, "notes": 0, "messages": 0}
+
+        rng = np.random.default_rng(spec.seed + 6)
+        self.picture_paths = ["/pictures/new_monkey/macaque_0.png"]
+        for monkey in range(1, spec.n_monkeys):
+            monkey_id = 100 + monkey
+            self.picture_paths.append(f"/pictures/{monkey_id}.png")
+            insert_picture(self.conn_photo, monkey_id=monkey_id, monkey_name=f"Monkey {monkey_id}", jpg_id=monkey,
+                           monkey_group=MONKEY_GROUPS[monkey % len(MONKEY_GROUPS)])
+
+        sample_rate = spec.sample_rate
+        self.task_ids = first_task_id + np.arange(len(self.recording.epochs))
+        self.pictures = rng.integers(0, spec.n_monkeys, size=len(self.task_ids))
+        self.aborted = rng.random(len(self.task_ids)) < 0.05
+        # Livenotes in samples, database messages in unix microseconds, both with the sample they appear at
+        self.notes = [(int(start) - sample_rate // 20, f"{int(start) - sample_rate // 20}, 0, {task_id}\n\n")
+                      for task_id, (start, _) in zip(self.task_ids, self.recording.epochs)]
+        self.messages = []
+        for task_id, (_, stop), aborted in zip(self.task_ids, self.recording.epochs, self.aborted):
+            slide_off = self._unix(stop) + 1000
+            self.messages.append((int(stop), slide_off, "SlideOff", int(task_id)))
+            self.messages.append((int(stop), slide_off + 1000, "TrialStop" if aborted else "TrialComplete", None))
+
+        for filename in ("digitalin.dat", "notes.txt"):
+            open(os.path.join(directory, filename), "wb").close()
+        with open(os.path.join(directory, "spike.dat"), "wb") as f:
+            f.write(self.recording.spike_file_header)
+
+    @property
+    def n_samples(self) -> int:
+        return len(self.recording.digital_words)
+
+    @property
+    def done(self) -> bool:
+        return self._written["digitalin"] >= self.n_samples
+
+    def complete_task_ids(self) -> list[int]:
+        return [int(task_id) for task_id, aborted in zip(self.task_ids, self.aborted) if not aborted]
+
+    def advance(self, seconds: float):
+        """
+        Append everything recorded in the next seconds of recording time.
+        """
+        self.elapsed += seconds
+        until = min(int(self.elapsed * self.spec.sample_rate), self.n_samples)
+        with open(os.path.join(self.directory, "digitalin.dat"), "ab") as f:
+            self.recording.digital_words[self._written["digitalin"]:until].tofile(f)
+        self._written["digitalin"] = until
+
+        n_spikes = int(np.searchsorted(self.recording.spike_records["timestamp"], until))
+        with open(os.path.join(self.directory, "spike.dat"), "ab") as f:
+            self.recording.spike_records[self._written["spikes"]:n_spikes].tofile(f)
+        self._written["spikes"] = n_spikes
+
+        with open(os.path.join(self.directory, "notes.txt"), "a") as f:
+            while self._written["notes"] < len(self.notes) and self.notes[self._written["notes"]][0] < until:
+                f.write(self.notes[self._written["notes"]][1])
+                self._written["notes"] += 1
+
+        while self._written["messages"] < len(self.messages) and self.messages[self._written["messages"]][0] < until:
+            _, tstamp, msg_type, task_id = self.messages[self._written["messages"]]
+            if msg_type == "SlideOff":
+                insert_trial(self.conn_xper, task_id=task_id, stim_id=task_id,
+                             picture_path=self.picture_paths[self.pictures[task_id - self.task_ids[0]]],
+                             slide_off_tstamp=tstamp)
+            elif msg_type == "TrialComplete":
+                insert_trial_complete(self.conn_xper, tstamp)
+            else:
+                self.conn_xper.execute("INSERT INTO BehMsg (tstamp, type, msg) VALUES (%s, %s, %s)",
+                                       (tstamp, msg_type, "<TrialMessage/>"))
+            self._written["messages"] += 1
+
+    def _unix(self, sample: int) -> int:
+        return self.start_unix + int(sample * 1_000_000 // self.spec.sample_rate)
@@ -0,0 +1,380 @@
+"""
+Catalog of compiled sessions, for querying trials across sessions without unpickling all of them.
+
+The catalog is a SQLite file (catalog.sqlite, next to the compiled files) with one row per compiled file: its
+date and round (parsed from the file name), task_ids, the channels present and how many trials each MonkeyName,
+MonkeyGroup, MonkeyId and JpgId has. Queries use the catalog to choose which sessions to load, and then load
+only the requested channels from those sessions.
+
+Round numbers are often only in the names of merged files (A&B_round3.pk1), so a session without a round of its
+own takes the round of a merged file made from it.
+"""
+
+import glob
+import os
+import re
+import sqlite3
+from dataclasses import dataclass, field
+from datetime import datetime, date
+from pathlib import Path
+
+import pandas as pd
+
+from julie.compiled_session import CompiledSession, SESSION_SUFFIX, is_session, read_compiled, spike_key_value
+
+CATALOG_FILENAME = "catalog.sqlite"
+# Bumped when register stores more; older catalogs re-index their merged files on the next scan
+CATALOG_VERSION = 1
+COUNTED_FIELD_NAMES = ["MonkeyName", "MonkeyGroup", "MonkeyId", "JpgId"]
+
+_INTAN_NAME = re.compile(r"^(?:test_)?(?P<unix>\d{16})_(?P<yymmdd>\d{6})_(?P<hhmmss>\d{6})"
+                         r"(?:_round(?P<round>\d+)(?:_(?P<sub_round>\d+))?)?$")
+_TIME_RANGE_NAME = re.compile(r"^(?P<day>\d{4}-\d{2}-\d{2})_(?P<start>\d{2}-\d{2}-\d{2})_to_(?P<end>\d{2}-\d{2}-\d{2})$")
+_ROUND_SUFFIX = re.compile(r"_round(?P<round>\d+)(?:_(?P<sub_round>\d+))?$")
+
+
+def _round_of_parts(column: str) -> str:
+    # round or sub_round of the first merged file listing the session as a part and naming a round
+    return (f"(SELECT merged.{column} FROM SessionPart JOIN Session AS merged ON merged.path = SessionPart.path "
+            "WHERE SessionPart.part = Session.name AND merged.round IS NOT NULL ORDER BY merged.path LIMIT 1)")
+
+
+_ROUND = f"COALESCE(round, {_round_of_parts('round')})"
+_SUB_ROUND = f"CASE WHEN round IS NULL THEN {_round_of_parts('sub_round')} ELSE sub_round END"
+
+
+@dataclass
+class SessionName:
+    day: date = None
+    round: int = None
+    sub_round: int = None
+    merged_from: list[str] = field(default_factory=list)
+
+
+def parse_session_name(name: str) -> SessionName:
+    """
+    Date and round of a compiled session from its name.
+
+    Handles experiment names ({unix_us}_{yymmdd}_{hhmmss}[_roundN[_k]]), merges of them joined with "&"
+    (the round suffix of the last part applies to the merge) and per-trial compilations
+    ({YYYY-MM-DD}_{HH-MM-SS}_to_{HH-MM-SS}). Unknown names give an empty SessionName.
+    """
+    match = _TIME_RANGE_NAME.match(name)
+    if match:
+        return SessionName(day=datetime.strptime(match.group("day"), "%Y-%m-%d").date())
+
+    parts = name.split("&")
+    parsed = SessionName()
+    if len(parts) > 1:
+        parsed.merged_from = [_ROUND_SUFFIX.sub("", part) for part in parts]
+        round_match = _ROUND_SUFFIX.search(parts[-1])
+        if round_match:
+            parsed.round = int(round_match.group("round"))
+            if round_match.group("sub_round"):
+                parsed.sub_round = int(round_match.group("sub_round"))
+
+    match = _INTAN_NAME.match(parts[0])
+    if match:
+        parsed.day = datetime.strptime(match.group("yymmdd"), "%y%m%d").date()
+        if len(parts) == 1 and match.group("round"):
+            parsed.round = int(match.group("round"))
+            if match.group("sub_round"):
+                parsed.sub_round = int(match.group("sub_round"))
+    return parsed
+
+
+class SessionCatalog:
+    """
+    SQLite index of compiled sessions. Files are only re-read when their size or modification time changes.
+    """
+
+    def __init__(self, path: str):
+        self.path = str(path)
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.db = sqlite3.connect(self.path)
+        self.db.execute("PRAGMA foreign_keys=ON")
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS Session (
+              path TEXT PRIMARY KEY,
+              name TEXT NOT NULL,
+              day TEXT,
+              round INTEGER,
+              sub_round INTEGER,
+              merged INTEGER NOT NULL,
+              n_trials INTEGER NOT NULL,
+              signature TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS SessionTask (
+              path TEXT NOT NULL REFERENCES Session(path) ON DELETE CASCADE,
+              task_id INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS SessionChannel (
+              path TEXT NOT NULL REFERENCES Session(path) ON DELETE CASCADE,
+              channel TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS SessionFieldCount (
+              path TEXT NOT NULL REFERENCES Session(path) ON DELETE CASCADE,
+              name TEXT NOT NULL,
+              value TEXT NOT NULL,
+              n_trials INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS SessionPart (
+              path TEXT NOT NULL REFERENCES Session(path) ON DELETE CASCADE,
+              part TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS SessionTaskByPath ON SessionTask(path);
+            CREATE INDEX IF NOT EXISTS SessionTaskByTask ON SessionTask(task_id);
+            CREATE INDEX IF NOT EXISTS SessionChannelByChannel ON SessionChannel(channel, path);
+            CREATE INDEX IF NOT EXISTS SessionFieldCountByValue ON SessionFieldCount(name, value, path);
+            CREATE INDEX IF NOT EXISTS SessionPartByPart ON SessionPart(part, path);
+            """)
+        if self.db.execute("PRAGMA user_version").fetchone()[0] < CATALOG_VERSION:
+            self.db.execute("UPDATE Session SET signature = '' WHERE merged = 1")
+            self.db.execute(f"PRAGMA user_version = {CATALOG_VERSION}")
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+    def register(self, session_path, force: bool = False) -> bool:
+        """
+        Add or refresh one compiled file (.pk1 or session directory).
+
+        Returns:
+            bool: True if the file was (re)indexed, False if the catalog was already up to date.
+        """
+        session_path = os.path.abspath(str(session_path))
+        signature = _file_signature(session_path)
+        row = self.db.execute("SELECT signature FROM Session WHERE path = ?", (session_path,)).fetchone()
+        if not force and row is not None and row[0] == signature:
+            return False
+
+        metadata, channels = _read_index_columns(session_path)
+        name = _session_name(session_path)
+        parsed = parse_session_name(name)
+
+        with self.db:
+            self.db.execute("DELETE FROM Session WHERE path = ?", (session_path,))
+            self.db.execute("INSERT INTO Session (path, name, day, round, sub_round, merged, n_trials, signature) "
+                            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                            (session_path, name, parsed.day.isoformat() if parsed.day else None, parsed.round,
+                             parsed.sub_round, int(bool(parsed.merged_from)), len(metadata), signature))
+            self.db.executemany("INSERT INTO SessionPart (path, part) VALUES (?, ?)",
+                                [(session_path, part) for part in parsed.merged_from])
+            if "TaskField" in metadata:
+                self.db.executemany("INSERT INTO SessionTask (path, task_id) VALUES (?, ?)",
+                                    [(session_path, int(task_id)) for task_id in metadata["TaskField"]])
+            self.db.executemany("INSERT INTO SessionChannel (path, channel) VALUES (?, ?)",
+                                [(session_path, channel) for channel in channels])
+            for name in COUNTED_FIELD_NAMES:
+                if name not in metadata:
+                    continue
+                counts = metadata[name].astype(str).value_counts()
+                self.db.executemany("INSERT INTO SessionFieldCount (path, name, value, n_trials) VALUES (?, ?, ?, ?)",
+                                    [(session_path, name, value, int(n)) for value, n in counts.items()])
+        return True
+
+    def scan(self, compiled_dir: str) -> list[str]:
+        """
+        Register every compiled file in compiled_dir and forget files that no longer exist.
+
+        Returns:
+            list[str]: Paths that were (re)indexed.
+        """
+        paths = sorted(glob.glob(os.path.join(compiled_dir, "*.pk1")) +
+                       [path for path in glob.glob(os.path.join(compiled_dir, "*" + SESSION_SUFFIX)) if is_session(path)])
+        updated = []
+        for path in paths:
+            try:
+                if self.register(path):
+                    updated.append(os.path.abspath(path))
+            except Exception as e:
+                print(f"Could not index {path}: {e}")
+
+        compiled_dir = os.path.abspath(compiled_dir)
+        with self.db:
+            for (path,) in self.db.execute("SELECT path FROM Session").fetchall():
+                if os.path.dirname(path) == compiled_dir and not os.path.exists(path):
+                    self.db.execute("DELETE FROM Session WHERE path = ?", (path,))
+        return updated
+
+    def find_sessions(self, *, day_from: date = None, day_to: date = None, rounds: list[int] = None,
+                      monkey_names: list[str] = None, monkey_groups: list[str] = None, channels: list = None,
+                      task_ids: list[int] = None, include_merged: bool = False) -> list[str]:
+        """
+        Paths of the sessions that can contain matching trials.
+
+        A .pk1 with a session directory next to it is returned as the session directory. Merged files repeat the
+        trials of the sessions they were made from, so they are left out unless include_merged is True. rounds
+        also match sessions without a round whose merged file has one.
+        """
+        clauses = []
+        params = []
+        if not include_merged:
+            clauses.append("merged = 0")
+        if day_from is not None:
+            clauses.append("day >= ?")
+            params.append(day_from.isoformat())
+        if day_to is not None:
+            clauses.append("day <= ?")
+            params.append(day_to.isoformat())
+        if rounds is not None:
+            clauses.append(f"{_ROUND} IN ({_placeholders(rounds)})")
+            params.extend(rounds)
+        for name, values in (("MonkeyName", monkey_names), ("MonkeyGroup", monkey_groups)):
+            if values is not None:
+                clauses.append("path IN (SELECT path FROM SessionFieldCount WHERE name = ? "
+                               f"AND value IN ({_placeholders(values)}))")
+                params.extend([name] + [str(value) for value in values])
+        if channels is not None:
+            clauses.append(f"path IN (SELECT path FROM SessionChannel WHERE channel IN ({_placeholders(channels)}))")
+            params.extend(spike_key_value(channel) for channel in channels)
+        if task_ids is not None:
+            clauses.append(f"path IN (SELECT path FROM SessionTask WHERE task_id IN ({_placeholders(task_ids)}))")
+            params.extend(int(task_id) for task_id in task_ids)
+
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        paths = [path for (path,) in self.db.execute(f"SELECT path FROM Session {where} ORDER BY day, name, path",
+                                                     params).fetchall()]
+
+        # Prefer the session directory over its pickle
+        selected = []
+        for path in paths:
+            stem = os.path.splitext(path)[0]
+            if path.endswith(".pk1") and stem + SESSION_SUFFIX in paths:
+                continue
+            selected.append(path)
+        return selected
+
+    def query_trials(self, *, day_from: date = None, day_to: date = None, rounds: list[int] = None,
+                     monkey_names: list[str] = None, monkey_groups: list[str] = None, channels: list = None,
+                     task_ids: list[int] = None, include_merged: bool = False,
+                     source_column: str = "Session") -> pd.DataFrame:
+        """
+        Matching trials from every catalogued session, loading only the sessions and channels needed.
+
+        Parameters:
+            day_from, day_to (date): Inclusive range of recording days.
+            rounds (list[int]): Round numbers from the session names (or the names of their merged files).
+            monkey_names (list[str]): Keep only trials showing these monkeys.
+            monkey_groups (list[str]): Keep only trials of these groups.
+            channels (list): Channels (or values such as "A-000") to keep in SpikeTimes. None keeps all.
+            task_ids (list[int]): Keep only these tasks.
+            include_merged (bool): Also read merged files (their trials repeat those of their parts).
+            source_column (str): Column naming the session each row came from, or None.
+
+        Returns:
+            pd.DataFrame: Trials in the compiled layout, in session order.
+        """
+        paths = self.find_sessions(day_from=day_from, day_to=day_to, rounds=rounds, monkey_names=monkey_names,
+                                   monkey_groups=monkey_groups, channels=channels, task_ids=task_ids,
+                                   include_merged=include_merged)
+        frames = []
+        for path in paths:
+            data = _read_channels(path, channels)
+            if monkey_names is not None:
+                data = data[data["MonkeyName"].astype(str).isin([str(name) for name in monkey_names])]
+            if monkey_groups is not None:
+                data = data[data["MonkeyGroup"].astype(str).isin([str(group) for group in monkey_groups])]
+            if task_ids is not None:
+                data = data[data["TaskField"].isin(task_ids)]
+            if data.empty:
+                continue
+            if source_column is not None:
+                data = data.assign(**{source_column: _session_name(path)})
+            frames.append(data)
+        if not frames:
+            return pd.DataFrame()
+        return pd.concat(frames, axis=0, ignore_index=True)
+
+    def sessions(self) -> pd.DataFrame:
+        """
+        One row per catalogued file: path, name, day, round, sub_round, merged and n_trials. round and sub_round
+        come from a merged file when the session's own name has none.
+        """
+        return pd.read_sql_query(f"SELECT path, name, day, {_ROUND} AS round, {_SUB_ROUND} AS sub_round, merged, "
+                                 "n_trials FROM Session ORDER BY day, name, path", self.db)
+
+
+def update_catalog(*session_paths, catalog_path: str = None):
+    """
+    Register freshly written compiled files in the catalog of their directory (or catalog_path).
+    """
+    for session_path in session_paths:
+        path = catalog_path or os.path.join(os.path.dirname(os.path.abspath(str(session_path))), CATALOG_FILENAME)
+        catalog = SessionCatalog(path)
+        try:
+            catalog.register(session_path, force=True)
+        finally:
+            catalog.close()
+
+
+def _placeholders(values) -> str:
+    return ", ".join("?" for _ in values)
+
+
+def _session_name(path: str) -> str:
+    name = os.path.basename(path.rstrip(os.sep)).split(".")[0]
+    if name == "compiled":
+        # Sorted-unit compilations are saved as compiled.pk1 inside the experiment directory
+        name = os.path.basename(os.path.dirname(path.rstrip(os.sep)))
+    return name
+
+
+def _file_signature(path: str) -> str:
+    if is_session(path):
+        path = os.path.join(path, "manifest.json")
+    stat = os.stat(path)
+    return f"{stat.st_size}:{stat.st_mtime_ns}"
+
+
+def _read_index_columns(path: str) -> tuple[pd.DataFrame, list[str]]:
+    """
+    Task fields and channel values of a compiled file. Session directories are read without their spike files.
+    """
+    if is_session(path):
+        session = CompiledSession(path)
+        return session.metadata, [spike_key_value(key) for key in session.keys]
+
+    data = pd.read_pickle(path)
+    channels = {}
+    if "SpikeTimes" in data:
+        for spike_times_by_key in data["SpikeTimes"]:
+            if isinstance(spike_times_by_key, dict):
+                for key in spike_times_by_key:
+                    channels.setdefault(spike_key_value(key), None)
+    return data.drop(columns=[column for column in ("SpikeTimes", "EpochStartStop") if column in data]), list(channels)
+
+
+def _read_channels(path: str, channels: list = None) -> pd.DataFrame:
+    if is_session(path):
+        session = CompiledSession(path)
+        if channels is not None:
+            values = {spike_key_value(key) for key in session.keys}
+            channels = [channel for channel in channels if spike_key_value(channel) in values]
+        return session.to_dataframe(channels)
+
+    data = read_compiled(path)
+    if channels is not None and "SpikeTimes" in data:
+        values = {spike_key_value(channel) for channel in channels}
+        data["SpikeTimes"] = [
+            {key: spike_times for key, spike_times in spike_times_by_key.items() if spike_key_value(key) in values}
+            if isinstance(spike_times_by_key, dict) else spike_times_by_key
+            for spike_times_by_key in data["SpikeTimes"]]
+    return data
+
+
+def main():
+    script_dir = Path(__file__).parent
+    compiled_dir = (script_dir / '..' / '..' / 'compiled' / 'julie').resolve()
+    catalog = SessionCatalog(str(compiled_dir / CATALOG_FILENAME))
+    updated = catalog.scan(str(compiled_dir))
+    print(f"Indexed {len(updated)} files")
+    print(catalog.sessions().to_string())
+    catalog.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+import numpy as np
+import pandas as pd
+
+from julie.compiled_session import CompiledSession, is_session, spike_key_value
+
+
+class ChannelAccessor:
+    """
+    Per-channel access to a loaded session without copying it.
+
+    The channel value -> SpikeTimes key index is built once per session. channel_data() then hands out a
+    frame with the task fields plus a single SpikeTimes_<channel> column, so looping over every channel only
+    holds one channel's spike lists (or memory-mapped views, for session directories) at a time.
+    """
+
+    def __init__(self, data):
+        """
+        Parameters:
+            data: Compiled DataFrame (SpikeTimes column of dicts) or a CompiledSession.
+        """
+        if isinstance(data, CompiledSession):
+            self.session = data
+            self.data = None
+            self.metadata = data.metadata.copy(deep=False)
+            self.metadata['EpochStartStop'] = data.epoch_start_stop()
+            self.key_by_value = {spike_key_value(key): key for key in data.keys}
+        else:
+            self.session = None
+            self.data = data
+            # Frames compiled without spikes (e.g. sorted units before assignment) have no SpikeTimes column
+            self.metadata = data.drop(columns=['SpikeTimes'], errors='ignore')
+            self.key_by_value = {}
+            for spike_times_by_key in (data['SpikeTimes'] if 'SpikeTimes' in data else []):
+                if isinstance(spike_times_by_key, dict):
+                    for key in spike_times_by_key:
+                        self.key_by_value.setdefault(spike_key_value(key), key)
+
+    @classmethod
+    def open(cls, file_path) -> "ChannelAccessor":
+        """
+        Open a compiled session directory lazily, or read a compiled pickle.
+        """
+        if is_session(file_path):
+            return cls(CompiledSession(file_path))
+        return cls(pd.read_pickle(file_path).reset_index(drop=True))
+
+    @classmethod
+    def of(cls, data) -> "ChannelAccessor":
+        if isinstance(data, ChannelAccessor):
+            return data
+        return cls(data)
+
+    @property
+    def channels(self) -> list:
+        return list(self.key_by_value.values())
+
+    def spike_trains(self, channel) -> list:
+        """
+        Per-trial spike times of one channel (None where a trial has no SpikeTimes or lacks the channel).
+        """
+        value = spike_key_value(channel)
+        if self.session is not None:
+            if value not in self.key_by_value:
+                return [None] * self.session.n_trials
+            return self.session.spike_trains(self.key_by_value[value])
+
+        key = self.key_by_value.get(value)
+        spike_trains = []
+        for spike_times_by_key in self.data['SpikeTimes']:
+            if not isinstance(spike_times_by_key, dict):
+                spike_trains.append(None)
+            elif key in spike_times_by_key:
+                spike_trains.append(spike_times_by_key[key])
+            else:
+                # Rows merged from other sessions may hold an equal channel under a different key object
+                spike_trains.append(next((spike_times for spike_key, spike_times in spike_times_by_key.items()
+                                          if spike_key_value(spike_key) == value), None))
+        return spike_trains
+
+    def channel_data(self, channel) -> pd.DataFrame:
+        """
+        Task fields plus a SpikeTimes_<channel.value> column for one channel.
+        """
+        channel_data = self.metadata.copy(deep=False)
+        channel_data[f'SpikeTimes_{spike_key_value(channel)}'] = self.spike_trains(channel)
+        return channel_data
+
+    def iter_channel_data(self, channels: list = None):
+        """
+        Yield (channel, channel_data) one channel at a time.
+        """
+        for channel in (self.channels if channels is None else channels):
+            yield channel, self.channel_data(channel)
+
+    def subset(self, channels: list) -> "ChannelAccessor":
+        """
+        A standalone accessor holding only the given channels, small enough to send to a worker process.
+        """
+        spike_trains_by_key = {self.key_by_value[spike_key_value(channel)]: self.spike_trains(channel)
+                               for channel in channels if spike_key_value(channel) in self.key_by_value}
+        if self.session is not None:
+            has_spikes = self.session.has_spikes
+        else:
+            has_spikes = [isinstance(spike_times_by_key, dict) for spike_times_by_key in self.data['SpikeTimes']]
+
+        data = self.metadata.copy(deep=False)
+        data['SpikeTimes'] = [
+            {key: _materialize(spike_trains[row]) for key, spike_trains in spike_trains_by_key.items()}
+            if has_spikes[row] else None
+            for row in range(len(data))]
+        return ChannelAccessor(data)
+
+
+def _materialize(spike_times):
+    # Memory-mapped views are copied so the subset does not depend on the session files staying open
+    if isinstance(spike_times, np.memmap):
+        return np.array(spike_times)
+    return spike_times
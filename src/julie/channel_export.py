@@ -0,0 +1,133 @@
+import os
+
+# Batch exports never open windows; keep single_channel_analysis from switching to Qt5Agg on import
+os.environ.setdefault("MPLBACKEND", "Agg")
+
+import time
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from pathlib import Path
+
+from matplotlib import pyplot as plt
+
+from julie.channel_access import ChannelAccessor
+from julie.group_statistics import channel_rate_statistics
+from julie.psth_cube import PsthCube, load_psth_cube
+from julie.single_channel_analysis import plot_raster_for_monkeys, plot_channel_histograms
+
+
+def main():
+    experiment_data_filename = "1697058662909405_231011_171103_round3.pk1"
+    script_dir = Path(__file__).parent
+    file_path = (script_dir / '..' / '..' / 'compiled' / 'julie' / experiment_data_filename).resolve()
+
+    # All channels of the session, rasters and histograms
+    export_channel_plots(file_path, channels=None, experiment_name=experiment_data_filename.split(".")[0],
+                         raster_mode="image")
+
+
+def export_channel_plots(file_path, channels: list = None, experiment_name: str = None,
+                         plots: tuple = ("raster", "histogram"), processes: int = None,
+                         raster_mode: str = "vector", vector_overlay: bool = True, use_psth_cube: bool = True) -> dict:
+    """
+    Render and save plots for many channels across a process pool with a non-interactive backend.
+
+    Parameters:
+        file_path: Compiled session (directory or .pk1).
+        channels (list): Channels to export. None exports every channel in the session.
+        experiment_name (str): Name of the plots/julie subdirectory. Defaults to the file name without extension.
+        plots (tuple): Any of "raster" and "histogram".
+        processes (int): Number of worker processes. Defaults to the number of CPUs.
+        raster_mode (str): "vector" (one line per spike) or "image" (pre-binned panels of bounded size).
+        vector_overlay (bool): Save image-mode rasters as SVG with vector axes and labels, or as plain PNG.
+        use_psth_cube (bool): Take histogram rates from the session's PSTH cube, building it if needed.
+
+    Returns:
+        dict: channel -> {plot name: seconds} timings, also printed as a summary.
+    """
+    if experiment_name is None:
+        experiment_name = os.path.basename(str(file_path)).split(".")[0]
+    if processes is None:
+        processes = os.cpu_count() or 1
+
+    accessor = ChannelAccessor.open(file_path)
+    channels = accessor.channels if channels is None else channels
+    psth_cube = load_psth_cube(file_path) if use_psth_cube and "histogram" in plots else None
+    # Histogram statistics of every channel in one pass; each worker gets them with its channel's index
+    statistics = None
+    if "histogram" in plots:
+        _, monkey_statistics, group_statistics = channel_rate_statistics(accessor, channels, psth_cube=psth_cube)
+        statistics = (monkey_statistics, group_statistics)
+
+    timings_by_channel = {}
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=processes, initializer=_init_worker) as executor:
+        channel_by_future = {}
+        pending = set()
+        for channel_index, channel in enumerate(channels):
+            # Each worker gets only its own channel's arrays; keep a bounded number of jobs in flight
+            channel_cube = psth_cube.subset([channel]) if psth_cube is not None else None
+            channel_statistics = (*statistics, channel_index) if statistics is not None else None
+            future = executor.submit(_render_channel, accessor.subset([channel]), channel, experiment_name, plots,
+                                     raster_mode, vector_overlay, channel_cube, channel_statistics)
+            channel_by_future[future] = channel
+            pending.add(future)
+            if len(pending) >= 2 * processes:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                _collect(done, channel_by_future, timings_by_channel)
+        _collect(pending, channel_by_future, timings_by_channel)
+
+    print_timings(timings_by_channel, time.perf_counter() - start)
+    return timings_by_channel
+
+
+def _init_worker():
+    plt.switch_backend("Agg")
+
+
+def _render_channel(channel_accessor: ChannelAccessor, channel, experiment_name: str, plots: tuple,
+                    raster_mode: str = "vector", vector_overlay: bool = True, psth_cube: PsthCube = None,
+                    statistics: tuple = None):
+    """
+    statistics: (monkey statistics, group statistics, channel index) of the session, or None to compute them.
+    """
+    timings = {}
+    if "raster" in plots:
+        start = time.perf_counter()
+        fig = plot_raster_for_monkeys(channel_accessor, channel, experiment_name=experiment_name, show=False,
+                                      raster_mode=raster_mode, vector_overlay=vector_overlay)
+        plt.close(fig)
+        timings["raster"] = time.perf_counter() - start
+    if "histogram" in plots:
+        start = time.perf_counter()
+        monkey_statistics, group_statistics, channel_index = statistics if statistics is not None else (None, None, 0)
+        figs = plot_channel_histograms(channel_accessor, channel, experiment_name=experiment_name, show=False,
+                                       psth_cube=psth_cube, monkey_statistics=monkey_statistics,
+                                       group_statistics=group_statistics, channel_index=channel_index)
+        for fig in figs:
+            plt.close(fig)
+        timings["histogram"] = time.perf_counter() - start
+    return timings
+
+
+def _collect(futures, channel_by_future: dict, timings_by_channel: dict):
+    for future in futures:
+        channel = channel_by_future.pop(future)
+        try:
+            timings = future.result()
+        except Exception as e:
+            print(f"Error exporting channel {channel.value}: {e}")
+            continue
+        timings_by_channel[channel] = timings
+        print(f"Finished {channel.value}: " + ", ".join(f"{name} {seconds:.2f}s" for name, seconds in timings.items()))
+
+
+def print_timings(timings_by_channel: dict, total_seconds: float):
+    print(f"{'Channel':<10}{'Plot':<12}{'Seconds':>10}")
+    for channel in sorted(timings_by_channel, key=lambda channel: channel.value):
+        for name, seconds in timings_by_channel[channel].items():
+            print(f"{channel.value:<10}{name:<12}{seconds:>10.2f}")
+    print(f"Exported {len(timings_by_channel)} channels in {total_seconds:.2f}s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,382 @@
+"""
+Batch runner for the compile entry points, driven by a manifest of (day, experiment, mode) rows.
+
+The manifest is a CSV file with a header. start_time and end_time are only needed for manual_thresh rows
+without an experiment (per-trial Intan files):
+
+    day,experiment,mode,start_time,end_time
+    2023-10-11,1697058662909405_231011_171103,manual_thresh,,
+    2023-09-13,,manual_thresh,17:00:00,17:59:00
+    2023-10-11,231011_round3,sorted_units,,
+    2023-10-11,231011_round3,single_unit,,
+
+Modes:
+    manual_thresh: manual_thresh_compilation.compile_data (experiment is the Intan experiment file name)
+    sorted_units: sorted_units_compilation.compile_data (experiment is the round directory)
+    single_unit: single_unit_analysis.plot_sorted_units of a round. It waits for the sorted_units row of the same
+        round, if the manifest has one, and runs again whenever that row runs.
+
+Jobs run on a process pool. Each job writes its output to a log of its own in log_dir. Failed jobs are retried
+after retry_delay (times the attempt number) up to max_attempts times. When a worker process dies the pool is
+rebuilt; if several jobs were running, none of them is charged an attempt and each is run again alone. A job
+whose output is already complete is skipped, so rerunning the same manifest after an interruption resumes where
+it stopped (force=True redoes everything). The status, attempts, time and last error of every job are kept in a
+SQLite state file next to the manifest.
+"""
+
+import os
+
+# Batch runs never open windows; keep single_unit_analysis from switching to Qt5Agg on import
+os.environ.setdefault("MPLBACKEND", "Agg")
+
+import csv
+import sqlite3
+import traceback
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import redirect_stdout, redirect_stderr
+from dataclasses import dataclass
+from datetime import date, datetime, time
+from time import monotonic, sleep
+
+import pandas as pd
+
+from julie.compile import manual_thresh_compilation, sorted_units_compilation
+from julie.compiled_session import is_session, session_path_for
+from julie.single_unit_analysis import plot_sorted_units, sorted_rasters_marker_path
+
+MODES = ("manual_thresh", "sorted_units", "single_unit")
+STATE_SUFFIX = "_state.sqlite"
+LOG_DIR_SUFFIX = "_logs"
+
+
+def main():
+    manifest_path = "/compiled/julie/batch_manifest.csv"
+    # Sorted-unit rasters are the densest plots; image mode keeps their files small
+    run_batch(manifest_path, processes=4, raster_mode="image")
+
+
+@dataclass(frozen=True)
+class CompileJob:
+    day: date
+    experiment: str = None
+    mode: str = "manual_thresh"
+    start_time: time = None
+    end_time: time = None
+
+    @property
+    def job_id(self) -> str:
+        name = self.experiment or f"{self.start_time:%H-%M-%S}_to_{self.end_time:%H-%M-%S}"
+        return f"{self.mode}/{self.day.isoformat()}/{name}"
+
+    def output_path(self) -> str:
+        if self.mode == "manual_thresh":
+            return manual_thresh_compilation.compiled_path(self.day, self.start_time, self.end_time, self.experiment)
+        if self.mode == "sorted_units":
+            return sorted_units_compilation.compiled_path(self.day, self.experiment)
+        return sorted_rasters_marker_path(self.experiment)
+
+    def is_complete(self) -> bool:
+        """
+        Whether the output of a previous run is there: the pickle and its session directory (written last, and
+        atomically) of a compilation, or the marker plot_sorted_units writes after the raster of every unit.
+        """
+        output_path = self.output_path()
+        if self.mode == "single_unit":
+            return os.path.exists(output_path)
+        return os.path.exists(output_path) and is_session(session_path_for(output_path))
+
+    def depends_on(self, other: "CompileJob") -> bool:
+        return (self.mode == "single_unit" and other.mode == "sorted_units"
+                and (other.day, other.experiment) == (self.day, self.experiment))
+
+
+def read_manifest(path: str) -> list[CompileJob]:
+    """
+    Jobs of a manifest CSV, in file order. Blank lines and lines starting with # are ignored.
+    """
+    jobs = []
+    with open(path, newline="") as f:
+        rows = csv.DictReader(line for line in f if line.strip() and not line.lstrip().startswith("#"))
+        for line_number, row in enumerate(rows, start=2):
+            row = {key.strip(): (value or "").strip() for key, value in row.items() if key is not None}
+            mode = row.get("mode") or "manual_thresh"
+            if mode not in MODES:
+                raise ValueError(f"{path}, row {line_number}: mode must be one of {MODES}, not {mode}")
+            experiment = row.get("experiment") or None
+            start_time = time.fromisoformat(row["start_time"]) if row.get("start_time") else None
+            end_time = time.fromisoformat(row["end_time"]) if row.get("end_time") else None
+            if experiment is None and (mode != "manual_thresh" or start_time is None or end_time is None):
+                raise ValueError(f"{path}, row {line_number}: {mode} needs an experiment"
+                                 + (" or start_time and end_time" if mode == "manual_thresh" else ""))
+            jobs.append(CompileJob(date.fromisoformat(row["day"]), experiment, mode, start_time, end_time))
+
+    job_ids = [job.job_id for job in jobs]
+    duplicates = sorted({job_id for job_id in job_ids if job_ids.count(job_id) > 1})
+    if duplicates:
+        raise ValueError(f"{path}: duplicate jobs {duplicates}")
+    return jobs
+
+
+class BatchState:
+    """
+    Status of every job of a manifest across runs, in a SQLite file.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS BatchJob (
+              job_id TEXT PRIMARY KEY,
+              status TEXT NOT NULL,
+              attempts INTEGER NOT NULL DEFAULT 0,
+              seconds REAL,
+              log_path TEXT,
+              error TEXT,
+              updated_at TEXT NOT NULL
+            )""")
+        self.db.commit()
+
+    def update(self, job_id: str, status: str, **fields):
+        columns = ["status", "updated_at", *fields]
+        values = [status, datetime.now().isoformat(timespec="seconds"), *fields.values()]
+        self.db.execute(f"INSERT INTO BatchJob (job_id, {', '.join(columns)}) "
+                        f"VALUES (?, {', '.join('?' * len(columns))}) "
+                        f"ON CONFLICT(job_id) DO UPDATE SET "
+                        + ", ".join(f"{column} = excluded.{column}" for column in columns),
+                        (job_id, *values))
+        self.db.commit()
+
+    def mark_interrupted(self):
+        """
+        Jobs still "running" were stopped by an interruption of an earlier run; they are run again.
+        """
+        self.db.execute("UPDATE BatchJob SET status = 'interrupted' WHERE status = 'running'")
+        self.db.commit()
+
+    def jobs(self, job_ids: list = None) -> pd.DataFrame:
+        frame = pd.read_sql_query("SELECT * FROM BatchJob", self.db)
+        if job_ids is not None:
+            frame = frame.set_index("job_id").reindex(job_ids).reset_index()
+        return frame
+
+    def close(self):
+        self.db.close()
+
+
+def run_batch(manifest_path: str, processes: int = 4, max_attempts: int = 3, retry_delay: float = 60.0,
+              log_dir: str = None, state_path: str = None, force: bool = False, use_cache: bool = True,
+              max_workers: int = 1, profile: bool = False, raster_mode: str = "vector",
+              vector_overlay: bool = True) -> pd.DataFrame:
+    """
+    Run every job of a manifest (see the module docstring).
+
+    Parameters:
+        manifest_path (str): Manifest CSV.
+        processes (int): Jobs run at once, each in its own process.
+        max_attempts (int): Runs of a failing job before it is given up.
+        retry_delay (float): Seconds before a retry, times the number of attempts so far.
+        log_dir (str): Directory of the per-job logs. Defaults to <manifest>_logs next to the manifest.
+        state_path (str): SQLite state file. Defaults to <manifest>_state.sqlite next to the manifest.
+        force (bool): Run jobs whose output is already complete too.
+        use_cache, max_workers, profile: Passed to the compile_data of manual_thresh and sorted_units jobs.
+        raster_mode, vector_overlay: Passed to plot_sorted_units of single_unit jobs (see raster.plot_raster).
+
+    Returns:
+        pd.DataFrame: State of every job of the manifest after the run.
+    """
+    jobs = read_manifest(manifest_path)
+    manifest_base = os.path.splitext(manifest_path)[0]
+    log_dir = log_dir if log_dir is not None else manifest_base + LOG_DIR_SUFFIX
+    os.makedirs(log_dir, exist_ok=True)
+    state = BatchState(state_path if state_path is not None else manifest_base + STATE_SUFFIX)
+    state.mark_interrupted()
+    options = {"use_cache": use_cache, "max_workers": max_workers, "profile": profile,
+               "raster_mode": raster_mode, "vector_overlay": vector_overlay}
+
+    dependency_ids = {job.job_id: [other.job_id for other in jobs if job.depends_on(other)] for job in jobs}
+    queued_ids = {job.job_id for job in jobs if force or not job.is_complete()}
+    # A job whose output is complete still runs again after a job it depends on does, since its output is stale
+    while True:
+        stale_ids = {job.job_id for job in jobs if job.job_id not in queued_ids
+                     and any(job_id in queued_ids for job_id in dependency_ids[job.job_id])}
+        if not stale_ids:
+            break
+        queued_ids |= stale_ids
+
+    # Outcome of each job in this run: "done", "skipped" or "failed"
+    outcome_by_job_id = {}
+    queue = []
+    for job in jobs:
+        if job.job_id in queued_ids:
+            queue.append(job)
+            state.update(job.job_id, "pending", attempts=0, error=None)
+        else:
+            outcome_by_job_id[job.job_id] = "skipped"
+            state.update(job.job_id, "skipped")
+    print(f"{len(queue)} of {len(jobs)} jobs to run, {len(jobs) - len(queue)} already complete")
+
+    attempts_by_job_id = {}
+    ready_at_by_job_id = {}
+    # Jobs that were running when the pool broke under several jobs; each runs alone so a crash is pinned on it
+    isolated_ids = set()
+    job_by_future = {}
+    start = monotonic()
+
+    def fail(job: CompileJob, error: str):
+        attempt = attempts_by_job_id[job.job_id]
+        if attempt < max_attempts:
+            queue.append(job)
+            ready_at_by_job_id[job.job_id] = monotonic() + retry_delay * attempt
+            state.update(job.job_id, "retrying", error=error)
+            print(f"Failed {job.job_id} (attempt {attempt}), retrying: {error}")
+        else:
+            outcome_by_job_id[job.job_id] = "failed"
+            state.update(job.job_id, "failed", error=error)
+            print(f"Gave up {job.job_id} after {attempt} attempts: {error}")
+
+    def settle(futures) -> list[CompileJob]:
+        """
+        Record the outcome of finished futures. Returns the jobs that failed because the pool broke.
+        """
+        crashed = []
+        for future in futures:
+            job = job_by_future.pop(future)
+            try:
+                seconds = future.result()
+            except BrokenProcessPool:
+                crashed.append(job)
+                continue
+            except Exception as e:
+                fail(job, f"{type(e).__name__}: {e}")
+                continue
+            outcome_by_job_id[job.job_id] = "done"
+            state.update(job.job_id, "done", seconds=seconds, error=None)
+            print(f"Finished {job.job_id} in {seconds:.1f}s")
+        return crashed
+
+    executor = ProcessPoolExecutor(max_workers=processes)
+    try:
+        while queue or job_by_future:
+            broken = False
+            now = monotonic()
+            for job in list(queue):
+                if len(job_by_future) >= processes or any(running.job_id in isolated_ids
+                                                           for running in job_by_future.values()):
+                    break
+                dependency_outcomes = [outcome_by_job_id.get(job_id) for job_id in dependency_ids[job.job_id]]
+                if "failed" in dependency_outcomes:
+                    queue.remove(job)
+                    outcome_by_job_id[job.job_id] = "failed"
+                    state.update(job.job_id, "failed", error="a job it depends on failed")
+                    print(f"Gave up {job.job_id}: a job it depends on failed")
+                    continue
+                if None in dependency_outcomes or ready_at_by_job_id.get(job.job_id, 0.0) > now:
+                    continue
+                if job.job_id in isolated_ids and job_by_future:
+                    # Let the pool drain instead of filling it with the jobs behind
+                    break
+                attempt = attempts_by_job_id.get(job.job_id, 0) + 1
+                log_path = os.path.join(log_dir, job.job_id.replace("/", "_") + ".log")
+                try:
+                    future = executor.submit(_run_job, job, log_path, attempt, options)
+                except BrokenProcessPool:
+                    # A worker died since the last wait; this job never started and stays queued
+                    broken = True
+                    break
+                queue.remove(job)
+                attempts_by_job_id[job.job_id] = attempt
+                state.update(job.job_id, "running", attempts=attempt, log_path=log_path)
+                job_by_future[future] = job
+                print(f"Started {job.job_id} (attempt {attempt})")
+
+            if broken:
+                done = set(job_by_future)
+            else:
+                retry_times = [ready_at_by_job_id[job.job_id] for job in queue if job.job_id in ready_at_by_job_id]
+                timeout = max(0.0, min(retry_times) - monotonic()) if retry_times else None
+                if not job_by_future:
+                    if timeout is not None:
+                        sleep(timeout)
+                    continue
+                done, _ = wait(job_by_future, timeout=timeout, return_when=FIRST_COMPLETED)
+
+            crashed = settle(done)
+            if crashed or broken:
+                # A worker died (e.g. out of memory). Every job still on the pool fails with it
+                wait(job_by_future)
+                crashed += settle(list(job_by_future))
+                if len(crashed) == 1:
+                    fail(crashed[0], "BrokenProcessPool: a worker process died")
+                else:
+                    # Which job killed the pool is unknown, so no attempt is counted and each runs alone next
+                    for job in crashed:
+                        attempts_by_job_id[job.job_id] -= 1
+                        isolated_ids.add(job.job_id)
+                        queue.append(job)
+                        state.update(job.job_id, "pending", error="the process pool broke")
+                executor.shutdown(wait=False)
+                executor = ProcessPoolExecutor(max_workers=processes)
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+        for job in job_by_future.values():
+            state.update(job.job_id, "interrupted")
+
+    summary = state.jobs([job.job_id for job in jobs])
+    state.close()
+    print_summary(summary, monotonic() - start)
+    return summary
+
+
+def _run_job(job: CompileJob, log_path: str, attempt: int, options: dict) -> float:
+    """
+    Run one job in a worker process with its output appended to log_path. Returns its wall time.
+    """
+    start = monotonic()
+    with open(log_path, "a") as log, redirect_stdout(log), redirect_stderr(log):
+        print(f"=== {job.job_id}, attempt {attempt}, started {datetime.now():%Y-%m-%d %H:%M:%S} ===", flush=True)
+        try:
+            JOB_RUNNERS[job.mode](job, **options)
+        except Exception:
+            traceback.print_exc()
+            raise
+        finally:
+            print(f"=== {job.job_id}, attempt {attempt}, {monotonic() - start:.1f}s ===", flush=True)
+    return monotonic() - start
+
+
+# Every runner gets the options of run_batch and ignores the ones of other modes
+
+def _compile_manual_thresh(job: CompileJob, use_cache: bool, max_workers: int, profile: bool, **_):
+    manual_thresh_compilation.compile_data(day=job.day, start_time=job.start_time, end_time=job.end_time,
+                                           experiment_filename=job.experiment, use_cache=use_cache,
+                                           max_workers=max_workers, profile=profile)
+
+
+def _compile_sorted_units(job: CompileJob, use_cache: bool, max_workers: int, profile: bool, **_):
+    sorted_units_compilation.compile_data(experiment_name=job.experiment, day=job.day, use_cache=use_cache,
+                                          max_workers=max_workers, profile=profile)
+
+
+def _plot_single_units(job: CompileJob, raster_mode: str, vector_overlay: bool, **_):
+    plot_sorted_units(job.day, job.experiment, show=False, raster_mode=raster_mode, vector_overlay=vector_overlay)
+
+
+JOB_RUNNERS = {
+    "manual_thresh": _compile_manual_thresh,
+    "sorted_units": _compile_sorted_units,
+    "single_unit": _plot_single_units,
+}
+
+
+def print_summary(summary: pd.DataFrame, total_seconds: float):
+    counts = summary["status"].value_counts()
+    print(f"Batch finished in {total_seconds:.1f}s: "
+          + ", ".join(f"{count} {status}" for status, count in counts.items()))
+    for _, row in summary[summary["status"] == "failed"].iterrows():
+        print(f"  {row['job_id']}: {row['error']} (log: {row['log_path']})")
+
+
+if __name__ == '__main__':
+    main()
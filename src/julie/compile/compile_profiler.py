@@ -0,0 +1,268 @@
+"""
+Instrumentation of the compile pipelines: wall time, calls, bytes read and database round trips per stage and per
+TaskField.
+
+    profiler = CompileProfiler(enabled=profile)
+    conn_xper = profiler.connection(conn_xper, "xper")
+    with profiler.stage("collect task ids"):
+        task_ids = task_id_collector.collect_complete_task_ids(time_range)
+    fields = profiler.task_fields(fields)
+    ...
+    profiler.report(trace_path)
+
+Wall time is inclusive (a stage includes the fields evaluated inside it). Bytes read and round trips are counted
+once, in the innermost stage or field active on the thread they happen on. Bytes read are those of the
+intan_stream readers (digitalin.dat and spike.dat). The time of each database is also listed on its own, so the
+time a stage spent outside the database (e.g. parsing StimSpec XML) is its wall time minus that.
+
+The trace file is JSON in the Chrome trace event format (chrome://tracing, https://ui.perfetto.dev), with the
+summary rows under "summary".
+
+A disabled profiler returns connections and fields unchanged and its stages are a shared no-op context, so a run
+without profiling does no extra work beyond those calls.
+"""
+
+import json
+import os
+import threading
+import time
+from contextlib import nullcontext
+from dataclasses import dataclass, asdict
+
+from clat.compile.task.task_field import TaskField, TaskFieldList
+
+MAX_TRACE_EVENTS = 200_000
+TRACE_SUFFIX = ".profile.json"
+
+_active_profiler = None
+
+
+def record_bytes_read(n_bytes: int):
+    """
+    Count n_bytes read from a file towards the active profiler, if any. Called by the intan_stream readers.
+    """
+    profiler = _active_profiler
+    if profiler is not None:
+        profiler.add(bytes_read=n_bytes)
+
+
+@dataclass
+class ProfileEntry:
+    kind: str
+    name: str
+    calls: int = 0
+    seconds: float = 0.0
+    bytes_read: int = 0
+    db_round_trips: int = 0
+
+
+class CompileProfiler:
+    """
+    Collects ProfileEntry rows of one compile run. Thread safe, so fields can be evaluated on a thread pool.
+
+    An enabled profiler counts the bytes read by intan_stream from its creation until report().
+    """
+
+    def __init__(self, enabled: bool = True, run_name: str = "compile_data"):
+        global _active_profiler
+        self.enabled = enabled
+        self.run_name = run_name
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.trace_events = []
+        self.local = threading.local()
+        self.started_at = time.time()
+        self.start = time.perf_counter()
+        if enabled:
+            _active_profiler = self
+
+    def stage(self, name: str):
+        """
+        Context manager timing one stage of the run.
+        """
+        if not self.enabled:
+            return nullcontext()
+        return _Span(self, "stage", name)
+
+    def task_fields(self, fields: TaskFieldList) -> TaskFieldList:
+        """
+        Wrap every field (except the plain task_id TaskField) so each get() is timed and counted. Wrap after
+        uncached_task_ids, which looks for CachedTaskFields.
+        """
+        if not self.enabled:
+            return fields
+        profiled_fields = TaskFieldList()
+        for field in fields:
+            if type(field) is TaskField:
+                profiled_fields.append(field)
+            else:
+                profiled_fields.append(ProfiledTaskField(field, self))
+        return profiled_fields
+
+    def connection(self, conn, label: str):
+        """
+        conn, with every execute counted as a round trip of label and of the current stage or field.
+        """
+        if not self.enabled:
+            return conn
+        return ProfiledConnection(conn, self, label)
+
+    def add(self, *, bytes_read: int = 0, db_round_trips: int = 0):
+        entry = self._current_entry()
+        with self.lock:
+            entry.bytes_read += bytes_read
+            entry.db_round_trips += db_round_trips
+
+    def record(self, kind: str, name: str, start: float, seconds: float, calls: int = 1):
+        """
+        Add one timed call (start from time.perf_counter()) to the entry of (kind, name) and to the trace.
+        """
+        entry = self._entry(kind, name)
+        with self.lock:
+            entry.calls += calls
+            entry.seconds += seconds
+            if len(self.trace_events) < MAX_TRACE_EVENTS:
+                self.trace_events.append({"name": name, "cat": kind, "ph": "X",
+                                          "ts": round((start - self.start) * 1e6, 1),
+                                          "dur": round(seconds * 1e6, 1),
+                                          "pid": os.getpid(), "tid": threading.get_ident()})
+
+    def summary(self) -> str:
+        """
+        Table of all entries: stages in the order they ran, then fields and databases by time.
+        """
+        total = time.perf_counter() - self.start
+        entries = self._sorted_entries()
+        name_width = max([len(f"{entry.kind}:{entry.name}") for entry in entries] + [len("name")])
+        lines = [f"{self.run_name}: {total:.2f} s",
+                 f"{'name':<{name_width}} {'calls':>8} {'seconds':>10} {'% run':>6} {'MB read':>9} {'db trips':>9}"]
+        for entry in entries:
+            share = 100 * entry.seconds / total if total > 0 else 0.0
+            lines.append(f"{entry.kind + ':' + entry.name:<{name_width}} {entry.calls:>8} {entry.seconds:>10.3f} "
+                         f"{share:>6.1f} {entry.bytes_read / 1e6:>9.1f} {entry.db_round_trips:>9}")
+        return "\n".join(lines)
+
+    def write_trace(self, path: str):
+        trace = {"traceEvents": self.trace_events,
+                 "displayTimeUnit": "ms",
+                 "run": self.run_name,
+                 "started_at": self.started_at,
+                 "total_seconds": time.perf_counter() - self.start,
+                 "summary": [asdict(entry) for entry in self._sorted_entries()]}
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(trace, f)
+        os.replace(tmp_path, path)
+
+    def report(self, trace_path: str = None):
+        """
+        Print the summary and write the trace to trace_path (if given), then stop counting bytes read.
+        """
+        global _active_profiler
+        if not self.enabled:
+            return
+        if _active_profiler is self:
+            _active_profiler = None
+        print(self.summary())
+        if trace_path is not None:
+            self.write_trace(trace_path)
+            print("trace written to", trace_path)
+
+    def _entry(self, kind: str, name: str) -> ProfileEntry:
+        key = (kind, name)
+        entry = self.entries.get(key)
+        if entry is None:
+            with self.lock:
+                entry = self.entries.setdefault(key, ProfileEntry(kind, name))
+        return entry
+
+    def _current_entry(self) -> ProfileEntry:
+        scopes = getattr(self.local, "scopes", None)
+        if scopes:
+            return scopes[-1]
+        return self._entry("stage", "(outside stages)")
+
+    def _scopes(self) -> list:
+        scopes = getattr(self.local, "scopes", None)
+        if scopes is None:
+            scopes = self.local.scopes = []
+        return scopes
+
+    def _sorted_entries(self) -> list[ProfileEntry]:
+        # Dicts keep insertion order, so stages stay in the order they first ran
+        entries = list(self.entries.values())
+        stages = [entry for entry in entries if entry.kind == "stage"]
+        others = sorted((entry for entry in entries if entry.kind != "stage"),
+                        key=lambda entry: (entry.kind, -entry.seconds))
+        return stages + others
+
+
+class _Span:
+    def __init__(self, profiler: CompileProfiler, kind: str, name: str):
+        self.profiler = profiler
+        self.kind = kind
+        self.name = name
+
+    def __enter__(self):
+        self.profiler._scopes().append(self.profiler._entry(self.kind, self.name))
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        seconds = time.perf_counter() - self.start
+        self.profiler._scopes().pop()
+        self.profiler.record(self.kind, self.name, self.start, seconds)
+        return False
+
+
+class ProfiledTaskField(TaskField):
+    """
+    Wraps a TaskField so every get() is recorded as a call of the field.
+    """
+
+    def __init__(self, field: TaskField, profiler: CompileProfiler):
+        super().__init__(field.name)
+        self.field = field
+        self.profiler = profiler
+
+    def get(self, task_id: int):
+        with _Span(self.profiler, "field", self.name):
+            return self.field.get(task_id)
+
+
+class ProfiledConnection:
+    """
+    Drop-in stand-in for a clat Connection that counts and times every query.
+    """
+
+    def __init__(self, conn, profiler: CompileProfiler, label: str):
+        self.conn = conn
+        self.profiler = profiler
+        self.label = label
+
+    def execute(self, statement, params=()):
+        start = time.perf_counter()
+        try:
+            self.conn.execute(statement, params)
+        finally:
+            self.profiler.add(db_round_trips=1)
+            self.profiler.record("database", self.label, start, time.perf_counter() - start)
+
+    def fetch_one(self):
+        start = time.perf_counter()
+        result = self.conn.fetch_one()
+        self.profiler.record("database", self.label, start, time.perf_counter() - start, calls=0)
+        return result
+
+    def fetch_all(self):
+        start = time.perf_counter()
+        result = self.conn.fetch_all()
+        self.profiler.record("database", self.label, start, time.perf_counter() - start, calls=0)
+        return result
+
+    def __getattr__(self, name):
+        return getattr(self.conn, name)
+
+
+def trace_path_for(save_path: str) -> str:
+    return os.path.splitext(str(save_path))[0] + TRACE_SUFFIX
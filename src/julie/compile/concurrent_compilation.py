@@ -0,0 +1,95 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+from clat.compile.task.task_field import TaskFieldList, Task
+from clat.util.connection import Connection
+
+
+class ThreadLocalConnection:
+    """
+    Drop-in stand-in for a clat Connection that opens one real Connection per thread.
+
+    Connection.execute and fetch_one/fetch_all take the lock separately, so threads sharing one Connection can
+    read each other's results. Fields built with a ThreadLocalConnection can be evaluated from a thread pool.
+    """
+
+    def __init__(self, database, user="xper_rw", password="up2nite", host="172.30.6.80"):
+        self.database = database
+        self.user = user
+        self.password = password
+        self.host = host
+        self._local = threading.local()
+        self._connections = []
+        self._connections_lock = threading.Lock()
+
+    @property
+    def connection(self) -> Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = Connection(self.database, user=self.user, password=self.password, host=self.host)
+            self._local.connection = connection
+            with self._connections_lock:
+                self._connections.append(connection)
+        return connection
+
+    def execute(self, statement, params=()):
+        self.connection.execute(statement, params)
+
+    def fetch_one(self):
+        return self.connection.fetch_one()
+
+    def fetch_all(self):
+        return self.connection.fetch_all()
+
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
+
+    def close(self):
+        with self._connections_lock:
+            for connection in self._connections:
+                try:
+                    connection.mydb.close()
+                except Exception:
+                    pass
+            self._connections = []
+
+
+def open_connection(database: str, host: str, max_workers: int = 1):
+    """
+    A plain Connection for serial compilation, or a ThreadLocalConnection when fields run on several threads.
+    """
+    if max_workers > 1:
+        return ThreadLocalConnection(database, host=host)
+    return Connection(database, host=host)
+
+
+def get_data_from_tasks_concurrently(fields: TaskFieldList, task_ids: list[int], max_workers: int = 8) -> pd.DataFrame:
+    """
+    Same result as clat's get_data_from_tasks, with tasks evaluated on a bounded thread pool.
+
+    All fields of one task run on the same thread, in order, so they keep sharing per-task work
+    (e.g. the Intan trial directory cache). Rows come back in task_ids order regardless of completion order.
+    """
+    if max_workers <= 1:
+        rows = []
+        for i, task_id in enumerate(task_ids):
+            print("working on", i, "out of", len(task_ids))
+            Task(task_id, fields).append_to_data(rows)
+        return pd.DataFrame(rows)
+
+    progress = {"done": 0}
+    progress_lock = threading.Lock()
+
+    def task_row(task_id: int):
+        row = []
+        Task(task_id, fields).append_to_data(row)
+        with progress_lock:
+            progress["done"] += 1
+            if progress["done"] % 100 == 0:
+                print("finished", progress["done"], "out of", len(task_ids))
+        return row[0]
+
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="compile") as executor:
+        rows = list(executor.map(task_row, task_ids))
+    return pd.DataFrame(rows)
@@ -0,0 +1,417 @@
+"""
+Chunked, memory-mapped readers for Intan digitalin.dat and spike.dat files.
+
+The clat readers load a whole file in one read (and epoch digitalin.dat one Python iteration per sample). Here a
+file is read through memory maps of at most one chunk at a time, so memory stays bounded by the chunk size
+however long the recording is:
+
+    stream_marker_epochs       yields (start, stop) sample indices of marker epochs as soon as they are certain
+    epoch_digitalin_file       the same as a list, a drop-in for marker_channels.epoch_using_marker_channels
+    iter_spike_records         yields decoded spike records chunk by chunk
+    FileTail                   reads whatever was appended to a growing file since the last read
+    read_spike_tstamps         drop-in for spike_file.fetch_spike_tstamps_from_file
+
+With follow=True the readers keep polling a file that is still being written (e.g. copied over sftp) and stop
+once it has not grown for idle_timeout seconds, so epoching starts before the transfer has finished.
+"""
+
+import os
+import struct
+import time
+from dataclasses import dataclass
+from typing import Iterator
+
+import numpy as np
+from clat.intan.channels import Channel
+from clat.intan.spike_file import str_to_channel_enum
+
+from julie.compile.compile_profiler import record_bytes_read
+
+DIGITALIN_CHUNK_SAMPLES = 1 << 20
+SPIKE_CHUNK_RECORDS = 1 << 16
+ARTIFACT_SPIKE_ID = 128
+SPIKE_FILE_MAGIC_MULTICHANNEL = 0x18f8474b
+SPIKE_FILE_MAGIC_SINGLE_CHANNEL = 0x18f88c00
+# Samples searched at once when looking for the next marker edge, doubled until one is found
+_EDGE_SEARCH_WINDOW = 4096
+
+
+def iter_memmap_chunks(path: str, dtype, offset: int = 0, chunk_items: int = DIGITALIN_CHUNK_SAMPLES,
+                       follow: bool = False, poll_interval: float = 1.0,
+                       idle_timeout: float = 30.0) -> Iterator[np.ndarray]:
+    """
+    Memory-mapped views of consecutive complete items of a binary file, at most chunk_items at a time.
+
+    Parameters:
+        path (str): File to read.
+        dtype: Item type, e.g. "<u2" or a structured record type.
+        offset (int): Bytes to skip at the start of the file (a header).
+        chunk_items (int): Maximum number of items per chunk.
+        follow (bool): Keep polling for items appended to the file until it has not grown for idle_timeout
+            seconds. Otherwise stop at the current end of the file.
+        poll_interval (float): Seconds between size checks while following.
+        idle_timeout (float): Seconds without growth after which a followed file is taken as complete.
+    """
+    dtype = np.dtype(dtype)
+    items_read = 0
+    last_growth = time.monotonic()
+    while True:
+        available_items = (os.path.getsize(path) - offset) // dtype.itemsize
+        if available_items > items_read:
+            n_items = min(chunk_items, available_items - items_read)
+            record_bytes_read(n_items * dtype.itemsize)
+            yield np.memmap(path, dtype=dtype, mode="r", offset=offset + items_read * dtype.itemsize,
+                            shape=(n_items,))
+            items_read += n_items
+            last_growth = time.monotonic()
+            continue
+        if not follow or time.monotonic() - last_growth >= idle_timeout:
+            return
+        time.sleep(poll_interval)
+
+
+class FileTail:
+    """
+    Reads the complete items appended to a file since the previous read, for files polled while they grow.
+    """
+
+    def __init__(self, path: str, dtype, offset: int = 0, chunk_items: int = DIGITALIN_CHUNK_SAMPLES):
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.offset = offset
+        self.chunk_items = chunk_items
+        self.items_read = 0
+
+    def read_new(self) -> Iterator[np.ndarray]:
+        if not os.path.exists(self.path):
+            return
+        offset = self.offset + self.items_read * self.dtype.itemsize
+        for chunk in iter_memmap_chunks(self.path, self.dtype, offset=offset, chunk_items=self.chunk_items):
+            self.items_read += len(chunk)
+            yield chunk
+
+
+class MarkerEpochDetector:
+    """
+    Incremental version of marker_channels.get_epochs_start_and_stop_indices.
+
+    The two marker channels are fed chunk by chunk and every epoch is returned as soon as the data seen so far
+    decides it, with exactly the start and stop indices the per-sample clat state machine gives on the whole
+    file. Instead of stepping through every sample, the detector jumps from one marker edge to the next, and
+    only keeps the samples from the current search position on (plus the correction durations of lookahead).
+    Samples before the first pulse are held until the first pulse tells which marker starts.
+    """
+
+    def __init__(self, false_negative_correction_duration: int = 40, false_positive_correction_duration: int = 2):
+        self.false_negative_correction_duration = false_negative_correction_duration
+        self.false_positive_correction_duration = false_positive_correction_duration
+        self._buffers = [np.empty(0, dtype=bool), np.empty(0, dtype=bool)]
+        self._offset = 0
+        self._position = 0
+        self._start = None
+        self._marker = None
+        self._finished = False
+
+    @property
+    def n_samples(self) -> int:
+        return self._offset + len(self._buffers[0])
+
+    def feed(self, marker1_data: np.ndarray, marker2_data: np.ndarray) -> list[tuple[int, int]]:
+        """
+        Add the next samples of both markers and return the epochs completed by them.
+        """
+        if self._finished:
+            raise ValueError("MarkerEpochDetector.feed called after finish")
+        marker1_data = np.asarray(marker1_data, dtype=bool)
+        marker2_data = np.asarray(marker2_data, dtype=bool)
+        if len(self._buffers[0]) == 0 and self._marker is None:
+            # Nothing can happen before the first high sample, so leading silence is not kept
+            highs = np.flatnonzero(marker1_data | marker2_data)
+            skipped = highs[0] if highs.size else len(marker1_data)
+            self._offset += skipped
+            self._position = self._offset
+            marker1_data = marker1_data[skipped:]
+            marker2_data = marker2_data[skipped:]
+        if self._marker is None:
+            exclusive = np.flatnonzero(marker1_data != marker2_data)
+            if exclusive.size:
+                self._marker = 1 if marker1_data[exclusive[0]] else 2
+
+        self._buffers = [np.concatenate((self._buffers[0], marker1_data)),
+                         np.concatenate((self._buffers[1], marker2_data))]
+        if self._marker is None:
+            return []
+        return self._advance(final=False)
+
+    def finish(self) -> list[tuple[int, int]]:
+        """
+        Mark the end of the file and return the remaining epochs, including one still open at the last sample.
+        """
+        if self._finished:
+            return []
+        self._finished = True
+        if self._marker is None:
+            # clat starts from marker 2 when no sample has exactly one marker high
+            self._marker = 2
+        return self._advance(final=True)
+
+    def _advance(self, final: bool) -> list[tuple[int, int]]:
+        fn_duration = self.false_negative_correction_duration
+        fp_duration = self.false_positive_correction_duration
+        epochs = []
+        n_samples = self.n_samples
+        while self._position < n_samples:
+            data = self._buffers[self._marker - 1]
+            position = self._position - self._offset
+            if self._start is None:
+                # Start at the first high sample that stays high for fp_duration samples (or to the end of file)
+                high = _find_first(data, True, position)
+                if high < 0:
+                    self._position = n_samples
+                    break
+                run_end = _find_first(data, False, high)
+                if run_end < 0:
+                    if not final and len(data) - high < fp_duration:
+                        self._position = self._offset + high
+                        break
+                    self._start = self._offset + high
+                    self._position = self._start + 1
+                elif run_end - high >= fp_duration:
+                    self._start = self._offset + high
+                    self._position = self._start + 1
+                else:
+                    self._position = self._offset + run_end
+                continue
+
+            # The epoch ends at sample j if sample j + 1 is low and no sample in the following
+            # fn_duration is high (a shorter gap is a false negative), or at the last sample of the file
+            low = _find_first(data, False, position + 1)
+            if low < 0:
+                if not final:
+                    self._position = max(self._position, n_samples - 1)
+                    break
+                epochs.append((self._start, n_samples - 1))
+                self._end_epoch(n_samples)
+                break
+            next_high = _find_first(data, True, low)
+            if next_high >= 0 and next_high - low < fn_duration:
+                self._position = self._offset + next_high
+                continue
+            if next_high < 0 and not final and len(data) - low < fn_duration:
+                self._position = self._offset + low - 1
+                break
+            epochs.append((self._start, self._offset + low - 1))
+            self._end_epoch(self._offset + low)
+
+        self._trim()
+        return epochs
+
+    def _end_epoch(self, next_position: int):
+        self._start = None
+        self._marker = 1 if self._marker == 2 else 2
+        self._position = next_position
+
+    def _trim(self):
+        kept_from = min(self._position, self.n_samples) - self._offset
+        if kept_from > 0:
+            self._buffers = [buffer[kept_from:] for buffer in self._buffers]
+            self._offset += kept_from
+
+
+def _find_first(values: np.ndarray, target: bool, start: int) -> int:
+    """
+    Index of the first element of a bool array at or after start that equals target, -1 if there is none.
+    """
+    window = _EDGE_SEARCH_WINDOW
+    while start < len(values):
+        chunk = values[start:start + window]
+        hits = np.flatnonzero(chunk if target else ~chunk)
+        if hits.size:
+            return start + int(hits[0])
+        start += len(chunk)
+        window *= 2
+    return -1
+
+
+def stream_marker_epochs(digitalin_path: str, false_negative_correction_duration: int = 40,
+                         false_positive_correction_duration: int = 2, chunk_samples: int = DIGITALIN_CHUNK_SAMPLES,
+                         follow: bool = False, poll_interval: float = 1.0,
+                         idle_timeout: float = 30.0) -> Iterator[tuple[int, int]]:
+    """
+    Yield the (start, stop) sample indices of the marker epochs of a digitalin.dat file as they are found.
+
+    Markers are bits 0 and 1 of the uint16 digital word, as in marker_channels.read_digitalin_file. See
+    iter_memmap_chunks for chunk_samples, follow, poll_interval and idle_timeout.
+    """
+    detector = MarkerEpochDetector(false_negative_correction_duration, false_positive_correction_duration)
+    for digital_words in iter_memmap_chunks(digitalin_path, "<u2", chunk_items=chunk_samples, follow=follow,
+                                            poll_interval=poll_interval, idle_timeout=idle_timeout):
+        yield from detector.feed((digital_words & 1) > 0, (digital_words & 2) > 0)
+    yield from detector.finish()
+
+
+def epoch_digitalin_file(digitalin_path: str, false_negative_correction_duration: int = 40,
+                         false_positive_correction_duration: int = 2, **stream_options) -> list[tuple[int, int]]:
+    """
+    Same result as marker_channels.epoch_using_marker_channels, read in bounded memory.
+    """
+    return list(stream_marker_epochs(digitalin_path, false_negative_correction_duration,
+                                     false_positive_correction_duration, **stream_options))
+
+
+@dataclass
+class SpikeFileHeader:
+    """
+    Header of an Intan RHX spike.dat file (the fields read by spike_file.read_intan_spike_file).
+    """
+    multichannel: bool
+    version: int
+    filename: str
+    channel_names: list[str]
+    custom_channel_names: list[str]
+    sample_rate: float
+    samples_pre_detect: int
+    samples_post_detect: int
+    header_bytes: int
+
+    @property
+    def record_dtype(self) -> np.dtype:
+        """
+        One spike record: native channel name (multichannel files only), timestamp in samples, spike ID and,
+        if snapshots were saved, the snapshot samples.
+        """
+        fields = [("channel", "S5")] if self.multichannel else []
+        fields += [("timestamp", "<i4"), ("spike_id", "u1")]
+        n_snapshot_samples = self.samples_pre_detect + self.samples_post_detect
+        if n_snapshot_samples:
+            fields.append(("snapshot", "<u2", (n_snapshot_samples,)))
+        return np.dtype(fields)
+
+
+def read_spike_file_header(spike_file_path: str) -> SpikeFileHeader:
+    """
+    Raises:
+        EOFError: If the file ends inside the header (e.g. it is still being written).
+        ValueError: If the file is not an Intan spike file.
+    """
+    with open(spike_file_path, "rb") as f:
+        magic_number, = struct.unpack("<I", _read_exactly(f, 4))
+        if magic_number == SPIKE_FILE_MAGIC_MULTICHANNEL:
+            multichannel = True
+        elif magic_number == SPIKE_FILE_MAGIC_SINGLE_CHANNEL:
+            multichannel = False
+        else:
+            raise ValueError(f"{spike_file_path} is not an Intan spike file")
+        version, = struct.unpack("<H", _read_exactly(f, 2))
+        filename = _read_string(f)
+        channel_names = _read_string(f).split(",")
+        custom_channel_names = _read_string(f).split(",")
+        sample_rate, samples_pre_detect, samples_post_detect = struct.unpack("<fII", _read_exactly(f, 12))
+        record_bytes_read(f.tell())
+        return SpikeFileHeader(multichannel, version, filename, channel_names, custom_channel_names, sample_rate,
+                               samples_pre_detect, samples_post_detect, f.tell())
+
+
+def _read_exactly(f, n_bytes: int) -> bytes:
+    data = f.read(n_bytes)
+    if len(data) < n_bytes:
+        raise EOFError(f"{f.name} ends inside its header")
+    return data
+
+
+def _read_string(f) -> str:
+    characters = bytearray()
+    while (character := _read_exactly(f, 1)) != b"\0":
+        characters += character
+    return characters.decode("utf-8")
+
+
+@dataclass
+class SpikeRecords:
+    """
+    Decoded spike records of one chunk of a spike.dat file, in file order.
+
+    channel_indices: Index into SpikeFileHeader.channel_names, -1 for a name not in the header.
+    timestamps: Spike times in samples.
+    spike_ids: 1 for normal spikes, ARTIFACT_SPIKE_ID for likely artifacts.
+    """
+    channel_indices: np.ndarray
+    timestamps: np.ndarray
+    spike_ids: np.ndarray
+
+
+def iter_spike_records(spike_file_path: str, chunk_records: int = SPIKE_CHUNK_RECORDS, follow: bool = False,
+                       poll_interval: float = 1.0,
+                       idle_timeout: float = 30.0) -> Iterator[tuple[SpikeFileHeader, SpikeRecords]]:
+    """
+    Decode a spike.dat file chunk by chunk. Snapshots are skipped over in the memory map, never read.
+
+    Yields:
+        tuple: (header, SpikeRecords of at most chunk_records spikes).
+    """
+    header = _wait_for_spike_file_header(spike_file_path, follow, poll_interval, idle_timeout)
+    for records in iter_memmap_chunks(spike_file_path, header.record_dtype, offset=header.header_bytes,
+                                      chunk_items=chunk_records, follow=follow, poll_interval=poll_interval,
+                                      idle_timeout=idle_timeout):
+        yield header, decode_spike_records(header, records)
+
+
+def decode_spike_records(header: SpikeFileHeader, records: np.ndarray) -> SpikeRecords:
+    """
+    Decode raw records of header.record_dtype, mapping channel names to their index in the header.
+    """
+    if header.multichannel:
+        index_by_name = {name.encode("utf-8"): index for index, name in enumerate(header.channel_names)}
+        names, name_codes = np.unique(records["channel"], return_inverse=True)
+        channel_indices = np.array([index_by_name.get(name, -1) for name in names],
+                                   dtype=np.int64)[name_codes.ravel()]
+    else:
+        channel_indices = np.zeros(len(records), dtype=np.int64)
+    return SpikeRecords(channel_indices, np.array(records["timestamp"]), np.array(records["spike_id"]))
+
+
+def _wait_for_spike_file_header(spike_file_path: str, follow: bool, poll_interval: float,
+                                idle_timeout: float) -> SpikeFileHeader:
+    waited = 0.0
+    while True:
+        try:
+            return read_spike_file_header(spike_file_path)
+        except (EOFError, FileNotFoundError):
+            if not follow or waited >= idle_timeout:
+                raise
+        time.sleep(poll_interval)
+        waited += poll_interval
+
+
+def read_spike_tstamps(spike_file_path: str, no_artifacts: bool = True,
+                       **stream_options) -> tuple[dict[Channel, list[float]], float]:
+    """
+    Same result as spike_file.fetch_spike_tstamps_from_file: spike times in seconds of every channel in the
+    header, in file order, and the sample rate. Records are decoded chunk by chunk and kept as int32 sample
+    indices until the end, so the peak memory is a small multiple of the spikes themselves.
+
+    stream_options are passed to iter_spike_records (chunk_records, follow, poll_interval, idle_timeout).
+    """
+    header = None
+    timestamps_by_channel_index = {}
+    for header, records in iter_spike_records(spike_file_path, **stream_options):
+        kept = records.channel_indices >= 0
+        if no_artifacts:
+            kept &= records.spike_ids != ARTIFACT_SPIKE_ID
+        channel_indices = records.channel_indices[kept]
+        timestamps = records.timestamps[kept]
+        order = np.argsort(channel_indices, kind="stable")
+        channel_indices, timestamps = channel_indices[order], timestamps[order]
+        present, starts = np.unique(channel_indices, return_index=True)
+        for channel_index, channel_timestamps in zip(present, np.split(timestamps, starts[1:])):
+            timestamps_by_channel_index.setdefault(int(channel_index), []).append(channel_timestamps)
+    if header is None:
+        header = read_spike_file_header(spike_file_path)
+
+    spike_tstamps_for_channels = {}
+    for channel_index, channel_name in enumerate(header.channel_names):
+        chunks = timestamps_by_channel_index.get(channel_index, [])
+        timestamps = np.concatenate(chunks) if chunks else np.empty(0, dtype=np.int32)
+        spike_tstamps_for_channels[str_to_channel_enum(channel_name)] = \
+            (timestamps.astype(np.float64) / header.sample_rate).tolist()
+    return spike_tstamps_for_channels, header.sample_rate
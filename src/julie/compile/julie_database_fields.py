@@ -1,61 +1,60 @@
+from dataclasses import dataclass
+from functools import lru_cache
+
 import xmltodict
 
 from clat.compile.task.base_database_fields import StimSpecField
 from clat.util.connection import Connection
 import re
 
+# Bumped when resolved metadata changes for the same database contents, so results cached by TaskResultCache and
+# PictureMetadataCache under an older version are computed again (2: zero-padded monkey ids in file names)
+RESOLVER_VERSION = 2
+
 
 class FileNameField(StimSpecField):
-    def __init__(self, *, conn_xper: Connection, name: str = "FileName"):
+    cache_version = RESOLVER_VERSION
+
+    def __init__(self, *, conn_xper: Connection, name: str = "FileName", resolver: "MonkeyMetadataResolver" = None):
         super().__init__(conn_xper, name)
+        self.resolver = resolver
 
     def get(self, task_id: int) -> str:
+        if self.resolver is not None:
+            return self.resolver.get(task_id).file_name
         stim_spec = super().get(task_id)
-        stim_spec_dict = xmltodict.parse(stim_spec)
-        picture_path = stim_spec_dict['StimSpec']['filePath']
-        file_name = self.extract_filename_from_filepath(picture_path)
-        if self.is_new_monkey_picture(picture_path):
-            #add new_monkey_ to the filename
-            file_name = "new_monkey_" + file_name
-
-        return file_name
+        return file_name_from_stim_spec(stim_spec)
 
     def is_new_monkey_picture(self, path: str):
-        is_in_new_monkey_path = "new_monkey" in path
-        is_macaque_in_filename = "macaque" in path
-        return is_in_new_monkey_path or is_macaque_in_filename
+        return is_new_monkey_picture(path)
 
     def extract_filename_from_filepath(self, filepath: str) -> str:
-        match = re.search(r'([^/]+)$', filepath)
-        if match:
-            return match.group(1)
-        return None
+        return extract_filename_from_filepath(filepath)
 
 
 class MonkeyIdField(FileNameField):
 
-    def __init__(self, *, conn_xper: Connection, conn_photo: Connection, name: str = "MonkeyId"):
-        super().__init__(conn_xper=conn_xper, name=name)
+    def __init__(self, *, conn_xper: Connection, conn_photo: Connection, name: str = "MonkeyId",
+                 resolver: "MonkeyMetadataResolver" = None):
+        super().__init__(conn_xper=conn_xper, name=name, resolver=resolver)
         self.conn_photo = conn_photo
 
     def get(self, task_id: int):
+        if self.resolver is not None:
+            return self.resolver.get(task_id).monkey_id
         filename = super().get(task_id)
-        if "new_monkey" in filename:
-            return -1
-        try:
-            monkey_id = re.search(r'(\d+)\.', filename).group(1)
-        except AttributeError:
-            monkey_id = None
-            print("WARNING! No monkey_id found for file_name: " + str(filename))
-        return monkey_id
+        return monkey_id_from_file_name(filename)
 
 
 class MonkeyNameField(MonkeyIdField):
 
-    def __init__(self, *, conn_xper: Connection, conn_photo: Connection, name: str = "MonkeyName"):
-        super().__init__(conn_xper=conn_xper, conn_photo=conn_photo, name=name)
+    def __init__(self, *, conn_xper: Connection, conn_photo: Connection, name: str = "MonkeyName",
+                 resolver: "MonkeyMetadataResolver" = None):
+        super().__init__(conn_xper=conn_xper, conn_photo=conn_photo, name=name, resolver=resolver)
 
     def get(self, task_id: int) -> str:
+        if self.resolver is not None:
+            return self.resolver.get(task_id).monkey_name
         monkey_id = super().get(task_id)
         if monkey_id == -1:
             return "NewMonkey"
@@ -70,11 +69,14 @@ class MonkeyNameField(MonkeyIdField):
 
 class JpgIdField(MonkeyIdField):
 
-    def __init__(self, *, conn_xper: Connection, conn_photo: Connection, name: str = "JpgId"):
-        super().__init__(conn_xper=conn_xper, conn_photo=conn_photo, name=name)
+    def __init__(self, *, conn_xper: Connection, conn_photo: Connection, name: str = "JpgId",
+                 resolver: "MonkeyMetadataResolver" = None):
+        super().__init__(conn_xper=conn_xper, conn_photo=conn_photo, name=name, resolver=resolver)
 
 
     def get(self, task_id: int) -> int:
+        if self.resolver is not None:
+            return self.resolver.get(task_id).jpg_id
         monkey_id = super().get(task_id)
         if monkey_id == -1:
             return -1
@@ -94,10 +96,13 @@ class JpgIdField(MonkeyIdField):
 
 class MonkeyGroupField(JpgIdField):
 
-        def __init__(self, *, conn_xper: Connection, conn_photo: Connection, name: str = "MonkeyGroup"):
-            super().__init__(conn_xper=conn_xper, conn_photo=conn_photo, name=name)
+        def __init__(self, *, conn_xper: Connection, conn_photo: Connection, name: str = "MonkeyGroup",
+                     resolver: "MonkeyMetadataResolver" = None):
+            super().__init__(conn_xper=conn_xper, conn_photo=conn_photo, name=name, resolver=resolver)
 
         def get(self, task_id: int) -> str:
+            if self.resolver is not None:
+                return self.resolver.get(task_id).monkey_group
             jpg_id = super().get(task_id)
             if jpg_id == -1:
                 return "Zombies"
@@ -109,3 +114,169 @@ class MonkeyGroupField(JpgIdField):
 
             return monkey_group
 
+
+def file_name_from_stim_spec(stim_spec: str) -> str:
+    return file_name_from_picture_path(picture_path_from_stim_spec(stim_spec))
+
+
+@lru_cache(maxsize=4096)
+def picture_path_from_stim_spec(stim_spec: str) -> str:
+    # Tasks showing the same picture share a spec, so each distinct spec is parsed once
+    stim_spec_dict = xmltodict.parse(stim_spec)
+    return stim_spec_dict['StimSpec']['filePath']
+
+
+def file_name_from_picture_path(picture_path: str) -> str:
+    file_name = extract_filename_from_filepath(picture_path)
+    if is_new_monkey_picture(picture_path):
+        #add new_monkey_ to the filename
+        file_name = "new_monkey_" + file_name
+    return file_name
+
+
+def is_new_monkey_picture(path: str):
+    is_in_new_monkey_path = "new_monkey" in path
+    is_macaque_in_filename = "macaque" in path
+    return is_in_new_monkey_path or is_macaque_in_filename
+
+
+def extract_filename_from_filepath(filepath: str) -> str:
+    match = re.search(r'([^/]+)$', filepath)
+    if match:
+        return match.group(1)
+    return None
+
+
+def monkey_id_from_file_name(filename: str):
+    if "new_monkey" in filename:
+        return -1
+    try:
+        monkey_id = re.search(r'(\d+)\.', filename).group(1)
+    except AttributeError:
+        monkey_id = None
+        print("WARNING! No monkey_id found for file_name: " + str(filename))
+    return monkey_id
+
+
+def _monkey_id_key(monkey_id):
+    # File names zero-pad the id ("066.jpg") while the database returns 66; compare numeric ids as ints
+    try:
+        return int(monkey_id)
+    except (TypeError, ValueError):
+        return str(monkey_id)
+
+
+@dataclass
+class MonkeyMetadata:
+    file_name: str
+    monkey_id: str | int | None
+    monkey_name: str | None
+    jpg_id: int | None
+    monkey_group: str | None
+
+
+class MonkeyMetadataResolver:
+    """
+    Resolves FileName, MonkeyId, MonkeyName, JpgId and MonkeyGroup for many task_ids with a handful of queries:
+    one query for all StimSpecs, one IN (...) query against combined_view and one against photos.
+    Gives the same values as the FileNameField -> MonkeyGroupField chain.
+
+    With a picture_cache (PictureMetadataCache), only pictures not cached yet are looked up in photo_metadata.
+    """
+    max_params_per_query = 1000
+
+    def __init__(self, *, conn_xper: Connection, conn_photo: Connection,
+                 picture_cache: "PictureMetadataCache" = None):
+        self.conn_xper = conn_xper
+        self.conn_photo = conn_photo
+        self.picture_cache = picture_cache
+        self.metadata_by_task_id = {}
+
+    def resolve(self, task_ids: list[int]) -> dict[int, MonkeyMetadata]:
+        """
+        Resolve metadata for every task_id not resolved yet. Returns metadata for all requested task_ids found.
+        """
+        missing_task_ids = list(dict.fromkeys(task_id for task_id in task_ids
+                                              if task_id not in self.metadata_by_task_id))
+        if missing_task_ids:
+            self._resolve_missing(missing_task_ids)
+        return {task_id: self.metadata_by_task_id[task_id] for task_id in task_ids
+                if task_id in self.metadata_by_task_id}
+
+    def get(self, task_id: int) -> MonkeyMetadata:
+        self.resolve([task_id])
+        return self.metadata_by_task_id[task_id]
+
+    def _resolve_missing(self, task_ids: list[int]):
+        rows = self._fetch_in(self.conn_xper,
+                              "SELECT t.task_id, s.spec FROM TaskToDo t JOIN StimSpec s ON s.id = t.stim_id "
+                              "WHERE t.task_id IN ({})", task_ids)
+        picture_path_by_task_id = {}
+        for task_id, stim_spec in rows:
+            picture_path_by_task_id.setdefault(int(task_id), picture_path_from_stim_spec(stim_spec))
+        picture_paths = list(dict.fromkeys(picture_path_by_task_id.values()))
+
+        metadata_by_picture_path = {}
+        if self.picture_cache is not None and picture_paths:
+            metadata_by_picture_path.update(self.picture_cache.get_many(self.conn_photo, picture_paths))
+        uncached_picture_paths = [picture_path for picture_path in picture_paths
+                                  if picture_path not in metadata_by_picture_path]
+        if uncached_picture_paths:
+            looked_up = self._look_up_pictures(uncached_picture_paths)
+            metadata_by_picture_path.update(looked_up)
+            if self.picture_cache is not None:
+                self.picture_cache.put_many(self.conn_photo, looked_up)
+
+        for task_id, picture_path in picture_path_by_task_id.items():
+            self.metadata_by_task_id[task_id] = metadata_by_picture_path[picture_path]
+
+    def _look_up_pictures(self, picture_paths: list[str]) -> dict[str, MonkeyMetadata]:
+        # picture path -> file name and monkey_id
+        file_name_by_picture_path = {picture_path: file_name_from_picture_path(picture_path)
+                                     for picture_path in picture_paths}
+        monkey_id_by_picture_path = {picture_path: monkey_id_from_file_name(file_name)
+                                     for picture_path, file_name in file_name_by_picture_path.items()}
+
+        # monkey_id -> monkey_name, jpg_id (first row per monkey_id, like fetch_one)
+        monkey_ids = list(dict.fromkeys(monkey_id for monkey_id in monkey_id_by_picture_path.values()
+                                        if monkey_id not in (-1, None)))
+        name_and_jpg_id_by_monkey_id = {}
+        for monkey_id, monkey_name, jpg_id in self._fetch_in(
+                self.conn_photo,
+                "SELECT monkey_id, monkey_name, jpg_id FROM photo_metadata.combined_view WHERE monkey_id IN ({})",
+                monkey_ids):
+            name_and_jpg_id_by_monkey_id.setdefault(_monkey_id_key(monkey_id), (monkey_name, jpg_id))
+
+        # jpg_id -> monkey_group
+        jpg_ids = list(dict.fromkeys(int(jpg_id) for _, jpg_id in name_and_jpg_id_by_monkey_id.values() if jpg_id))
+        monkey_group_by_jpg_id = {}
+        for jpg_id, monkey_group in self._fetch_in(
+                self.conn_photo,
+                "SELECT jpg_id, monkey_group FROM photo_metadata.photos WHERE jpg_id IN ({})",
+                jpg_ids):
+            monkey_group_by_jpg_id.setdefault(int(jpg_id), monkey_group)
+
+        metadata_by_picture_path = {}
+        for picture_path, file_name in file_name_by_picture_path.items():
+            monkey_id = monkey_id_by_picture_path[picture_path]
+            if monkey_id == -1:
+                metadata_by_picture_path[picture_path] = MonkeyMetadata(file_name, -1, "NewMonkey", -1, "Zombies")
+                continue
+            monkey_name, jpg_id = name_and_jpg_id_by_monkey_id.get(_monkey_id_key(monkey_id), (None, None))
+            if jpg_id:
+                jpg_id = int(jpg_id)
+            else:
+                jpg_id = None
+                print("WARNING! No jpg_id found for monkey_id: " + str(monkey_id))
+            monkey_group = monkey_group_by_jpg_id.get(jpg_id)
+            metadata_by_picture_path[picture_path] = MonkeyMetadata(file_name, monkey_id, monkey_name, jpg_id,
+                                                                    monkey_group)
+        return metadata_by_picture_path
+
+    def _fetch_in(self, conn: Connection, query: str, values: list) -> list[tuple]:
+        rows = []
+        for i in range(0, len(values), self.max_params_per_query):
+            chunk = values[i:i + self.max_params_per_query]
+            conn.execute(query.format(", ".join(["%s"] * len(chunk))), tuple(chunk))
+            rows.extend(conn.fetch_all())
+        return rows
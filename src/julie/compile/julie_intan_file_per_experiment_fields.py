@@ -1,4 +1,10 @@
+import os
+
+import numpy as np
 from clat.compile.task.task_field import TaskField
+from clat.intan.livenotes import map_task_id_to_epochs_with_livenotes
+
+from julie.compile.intan_stream import epoch_digitalin_file, read_spike_tstamps
 
 
 class SpikeTimesForChannelsField_Experiment(TaskField):
@@ -21,3 +27,39 @@ class EpochStartStopField_Experiment(TaskField):
         if task_id not in self.epoch_start_stop_by_task_id:
             return None
         return self.epoch_start_stop_by_task_id[task_id]
+
+
+def parse_intan_experiment_directory(intan_file_path: str, **stream_options) -> tuple[
+        dict[int, dict], dict[int, tuple[float, float]], float]:
+    """
+    Same result as clat's OneFileParser().parse for a single-file-per-experiment recording, with spike.dat and
+    digitalin.dat read through julie.compile.intan_stream.
+
+    Parameters:
+        intan_file_path (str): Directory with spike.dat, digitalin.dat and notes.txt.
+        stream_options: Passed to both readers, e.g. follow=True to start while the files are still being copied.
+
+    Returns:
+        tuple: (spike times by channel by task id, (epoch start, epoch stop) seconds by task id, sample rate)
+    """
+    spike_tstamps_by_channel, sample_rate = read_spike_tstamps(os.path.join(intan_file_path, "spike.dat"),
+                                                               **stream_options)
+    stim_epochs_from_markers = epoch_digitalin_file(os.path.join(intan_file_path, "digitalin.dat"),
+                                                    false_negative_correction_duration=2, **stream_options)
+    epochs_for_task_ids = map_task_id_to_epochs_with_livenotes(os.path.join(intan_file_path, "notes.txt"),
+                                                               stim_epochs_from_markers,
+                                                               require_trial_complete=False)
+
+    sorted_tstamps_by_channel = {channel: np.sort(np.asarray(tstamps, dtype=np.float64))
+                                 for channel, tstamps in spike_tstamps_by_channel.items()}
+    spike_tstamps_for_channels_by_task_id = {}
+    epoch_start_stop_by_task_id = {}
+    for task_id, epoch_indices in epochs_for_task_ids.items():
+        epoch_start = epoch_indices[0] / sample_rate
+        epoch_stop = epoch_indices[1] / sample_rate
+        spike_tstamps_for_channels_by_task_id[task_id] = {
+            channel: tstamps[np.searchsorted(tstamps, epoch_start, side="left"):
+                             np.searchsorted(tstamps, epoch_stop, side="right")].tolist()
+            for channel, tstamps in sorted_tstamps_by_channel.items()}
+        epoch_start_stop_by_task_id[task_id] = (epoch_start, epoch_stop)
+    return spike_tstamps_for_channels_by_task_id, epoch_start_stop_by_task_id, sample_rate
@@ -1,34 +1,34 @@
 from clat.compile.task.task_field import TaskField
-from clat.intan import spike_file
 from clat.intan.channels import Channel
 from clat.intan.livenotes import map_task_id_to_epochs_with_livenotes
-from clat.intan.marker_channels import epoch_using_marker_channels
+from julie.compile.intan_stream import epoch_digitalin_file, read_spike_tstamps
 import os
 import re
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
 
 
 class SpikeTimesForChannelsField(TaskField):
-    def __init__(self, intan_data_path: str, name: str = "SpikeTimes"):
+    def __init__(self, intan_data_path: str, name: str = "SpikeTimes",
+                 directory_cache: "IntanTrialDirectoryCache" = None,
+                 directory_index: "IntanDirectoryIndex" = None):
         super().__init__(name)
         self.intan_data_path = intan_data_path
+        self.directory_cache = directory_cache if directory_cache is not None else shared_directory_cache
+        self.directory_index = directory_index
 
     def get(self, task_id: int) -> dict[Channel, list[float]] | None:
-        matching_intan_file_paths = find_matching_directories(self.intan_data_path, task_id)
+        self.directory_index = directory_index_for(self.intan_data_path, self.directory_index)
+        matching_intan_file_paths = self.directory_index.find_matching_directories(task_id)
         if len(matching_intan_file_paths) == 0:
             return None
         intan_file_path = matching_intan_file_paths[-1]
-        spike_path = os.path.join(intan_file_path, "spike.dat")
-        digital_in_path = os.path.join(intan_file_path, "digitalin.dat")
-        notes_path = os.path.join(intan_file_path, "notes.txt")
-
-        spike_tstamps_for_channels, sample_rate = spike_file.fetch_spike_tstamps_from_file(spike_path)
-
-        stim_epochs_from_markers = epoch_using_marker_channels(digital_in_path)
-        epochs_for_task_ids = map_task_id_to_epochs_with_livenotes(notes_path,
-                                                                   stim_epochs_from_markers)
-        spikes_for_channels = filter_spikes_with_epochs(spike_tstamps_for_channels,
-                                                        epochs_for_task_ids, task_id,
-                                                        sample_rate=sample_rate)
+        parsed = self.directory_cache.get(intan_file_path)
+
+        spikes_for_channels = filter_spikes_with_epochs(parsed.spike_tstamps_for_channels,
+                                                        parsed.epochs_for_task_ids, task_id,
+                                                        sample_rate=parsed.sample_rate)
         return spikes_for_channels
 
 
@@ -49,33 +49,135 @@ def filter_spikes_with_epochs(spike_tstamps_for_channels: dict[Channel, list[flo
 
 
 class EpochStartStopField(TaskField):
-    # TODO: clean up a bit, we're duplicating the epoch retrieval between this and SpikeTimesForChannelsField
-    def __init__(self, intan_data_path: str, name: str = "EpochStartStop"):
+    def __init__(self, intan_data_path: str, name: str = "EpochStartStop",
+                 directory_cache: "IntanTrialDirectoryCache" = None,
+                 directory_index: "IntanDirectoryIndex" = None):
         super().__init__(name)
         self.intan_data_path = intan_data_path
+        self.directory_cache = directory_cache if directory_cache is not None else shared_directory_cache
+        self.directory_index = directory_index
 
     def get(self, task_id: int) -> tuple[float, float] | None:
-        matching_intan_file_paths = find_matching_directories(self.intan_data_path, task_id)
+        self.directory_index = directory_index_for(self.intan_data_path, self.directory_index)
+        matching_intan_file_paths = self.directory_index.find_matching_directories(task_id)
         if len(matching_intan_file_paths) == 0:
             return None
         intan_file_path = matching_intan_file_paths[-1]
-        spike_path = os.path.join(intan_file_path, "spike.dat")
-        digital_in_path = os.path.join(intan_file_path, "digitalin.dat")
-        notes_path = os.path.join(intan_file_path, "notes.txt")
+        parsed = self.directory_cache.get(intan_file_path)
 
-        if len(matching_intan_file_paths) == 0:
-            return None
-
-        _, sample_rate = spike_file.fetch_spike_tstamps_from_file(spike_path)
-        stim_epochs_from_markers = epoch_using_marker_channels(digital_in_path)
-        epochs_for_task_ids = map_task_id_to_epochs_with_livenotes(notes_path,
-                                                                   stim_epochs_from_markers)
-        epoch = epochs_for_task_ids[task_id]
-        epoch_start = epoch[0] / sample_rate
-        epoch_stop = epoch[1] / sample_rate
+        epoch = parsed.epochs_for_task_ids[task_id]
+        epoch_start = epoch[0] / parsed.sample_rate
+        epoch_stop = epoch[1] / parsed.sample_rate
         return epoch_start, epoch_stop
 
 
+@dataclass
+class ParsedIntanTrialDirectory:
+    spike_tstamps_for_channels: dict[Channel, list[float]]
+    sample_rate: float
+    epochs_for_task_ids: dict[int, tuple[int, int]]
+
+
+def parse_intan_trial_directory(intan_file_path: str) -> ParsedIntanTrialDirectory:
+    """
+    Read spike.dat, epoch digitalin.dat and parse notes.txt of a single trial directory.
+    """
+    spike_path = os.path.join(intan_file_path, "spike.dat")
+    digital_in_path = os.path.join(intan_file_path, "digitalin.dat")
+    notes_path = os.path.join(intan_file_path, "notes.txt")
+
+    spike_tstamps_for_channels, sample_rate = read_spike_tstamps(spike_path)
+    stim_epochs_from_markers = epoch_digitalin_file(digital_in_path)
+    epochs_for_task_ids = map_task_id_to_epochs_with_livenotes(notes_path,
+                                                               stim_epochs_from_markers)
+    return ParsedIntanTrialDirectory(spike_tstamps_for_channels, sample_rate, epochs_for_task_ids)
+
+
+def intan_file_mtimes(intan_file_path: str) -> tuple:
+    """
+    Modification times of spike.dat, digitalin.dat and notes.txt in an Intan directory (None if missing).
+    """
+    mtimes = []
+    for filename in ("spike.dat", "digitalin.dat", "notes.txt"):
+        try:
+            mtimes.append(os.stat(os.path.join(intan_file_path, filename)).st_mtime_ns)
+        except FileNotFoundError:
+            mtimes.append(None)
+    return tuple(mtimes)
+
+
+class IntanTrialDirectoryCache:
+    """
+    Keeps the parse of recently used trial directories, keyed by path and the mtimes of the files read,
+    so every field of a task shares one parse and edited files are re-read.
+    """
+
+    def __init__(self, max_entries: int = 32):
+        self.max_entries = max_entries
+        self._parsed_by_path = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, intan_file_path: str) -> ParsedIntanTrialDirectory:
+        key = (intan_file_path, intan_file_mtimes(intan_file_path))
+        with self._lock:
+            if key in self._parsed_by_path:
+                self._parsed_by_path.move_to_end(key)
+                return self._parsed_by_path[key]
+
+        # Parse outside the lock so different directories can be read concurrently
+        parsed = parse_intan_trial_directory(intan_file_path)
+        with self._lock:
+            self._parsed_by_path[key] = parsed
+            while len(self._parsed_by_path) > self.max_entries:
+                self._parsed_by_path.popitem(last=False)
+        return parsed
+
+    def clear(self):
+        with self._lock:
+            self._parsed_by_path.clear()
+
+
+shared_directory_cache = IntanTrialDirectoryCache()
+
+
+class IntanDirectoryIndex:
+    """
+    Maps task_id -> trial directories of a day folder from a single listing of that folder.
+
+    The listing is taken when the index is built (or refreshed), so build one per compilation; directories
+    written afterwards are not seen.
+    """
+
+    def __init__(self, root_folder: str):
+        self.root_folder = root_folder
+        self.refresh()
+
+    def refresh(self):
+        self.directory_names_by_task_id = {}
+        for dirname in os.listdir(self.root_folder):
+            match = re.match(r'^(\d+)_', dirname)
+            if match:
+                self.directory_names_by_task_id.setdefault(match.group(1), []).append(dirname)
+
+    def find_matching_directories(self, target_number: int) -> list:
+        """
+        Same result as find_matching_directories(self.root_folder, target_number) without listing the folder.
+        """
+        matching_dirs = [os.path.join(self.root_folder, dirname)
+                         for dirname in self.directory_names_by_task_id.get(str(target_number), [])]
+        matching_dirs.sort(key=lambda x: x.split(f'{target_number}_')[-1])
+        return matching_dirs
+
+
+def directory_index_for(intan_data_path: str, directory_index: IntanDirectoryIndex = None) -> IntanDirectoryIndex:
+    """
+    directory_index, or a new index of intan_data_path if it is None (a field used without a shared index).
+    """
+    if directory_index is not None:
+        return directory_index
+    return IntanDirectoryIndex(intan_data_path)
+
+
 def find_matching_directories(root_folder: str, target_number: int) -> list:
     """
     Search through a folder to find directories that start with the given target_number,
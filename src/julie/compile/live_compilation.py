@@ -0,0 +1,487 @@
+"""
+Online compilation of a single-file-per-experiment recording while it is being recorded.
+
+LiveSessionCompiler polls the experiment's Intan directory (spike.dat, digitalin.dat, notes.txt) and the
+{date}_recording database. It compiles a trial as soon as everything it needs is there: a TrialComplete in
+BehMsg, a livenote, a marker epoch and spikes up to the end of that epoch. Each poll only reads what was
+appended since the previous one. The rows are the ones collect_raw_data_single_file_for_experiment gives at the
+end of the day: tasks are mapped to epochs like map_task_id_to_epochs_with_livenotes with
+require_trial_complete=False, and spikes are filtered like OneFileParser. After every poll that compiles trials,
+a rolling raster and the per-group PSTH of the watched channels are redrawn into one PNG.
+
+To test against a local stand-in, point intan_file_path at a directory the Intan files are being copied into,
+and pass the SQLite connections from sqlite_stand_in.open_stand_in_connections.
+"""
+
+import os
+from collections import deque
+from datetime import date, time
+from pathlib import Path
+from time import monotonic, sleep
+
+import numpy as np
+import pandas as pd
+import xmltodict
+from clat.intan.channels import Channel
+from clat.intan.livenotes import parse_livenotes_to_events, filter_for_task_ids
+from clat.intan.spike_file import str_to_channel_enum
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+
+from julie.catalog import update_catalog
+from julie.compile.concurrent_compilation import open_connection
+from julie.compile.intan_stream import (FileTail, MarkerEpochDetector, read_spike_file_header, decode_spike_records,
+                                        ARTIFACT_SPIKE_ID, SPIKE_CHUNK_RECORDS)
+from julie.compile.julie_database_fields import MonkeyMetadataResolver
+from julie.compile.picture_metadata_cache import PictureMetadataCache
+from julie.compile.manual_thresh_compilation import calc_start_and_end_unix_times
+from julie.compiled_session import write_session, session_path_for
+from julie.group_statistics import group_rate_statistics
+from julie.raster import RasterPanel, align_spikes_to_epochs, draw_raster_image, RASTER_TIME_LIMIT
+from julie.spike_binning import calculate_binned_spike_rates
+
+LIVE_POLL_INTERVAL = 2.0
+# Same correction as OneFileParser uses for single-file recordings
+LIVE_FALSE_NEGATIVE_CORRECTION_DURATION = 2
+ROLLING_RASTER_TRIALS = 200
+
+
+def main():
+    compile_live(day=date.today(),
+                 experiment_name="1697058662909405_231011_171103",
+                 channels=[Channel.A_000, Channel.A_001, Channel.A_002, Channel.A_003])
+
+
+def compile_live(*, day: date, experiment_name: str, channels: list = None, poll_interval: float = LIVE_POLL_INTERVAL,
+                 idle_timeout: float = 120.0) -> pd.DataFrame:
+    """
+    Compile the experiment in progress until its files and the database have been idle for idle_timeout seconds,
+    then save it like compile_data (.pk1, .session and catalog).
+    """
+    day_path = day.strftime("%Y-%m-%d")
+    date_no_hyphens = day_path.replace('-', '')
+    conn_xper = open_connection(f"{date_no_hyphens}_recording", host="172.30.6.59")
+    conn_photo = open_connection("photo_metadata", host="172.30.6.59")
+    intan_base_path = "/run/user/1003/gvfs/sftp:host=172.30.6.58/home/connorlab/Documents/IntanData"
+    intan_file_path = os.path.join(intan_base_path, day_path, experiment_name)
+    start_unix, end_unix = calc_start_and_end_unix_times(day, time(0, 0, 0), time(23, 59, 59))
+
+    script_dir = Path(__file__).parent
+    plot_path = (script_dir / '..' / '..' / '..' / 'plots' / 'julie' / experiment_name / 'live_overview.png').resolve()
+    compiler = LiveSessionCompiler(intan_file_path=intan_file_path, conn_xper=conn_xper, conn_photo=conn_photo,
+                                   start_unix=start_unix, end_unix=end_unix, channels=channels,
+                                   save_path=os.path.join("/compiled/julie", f"{experiment_name}.pk1"),
+                                   plot_path=str(plot_path), title=experiment_name,
+                                   picture_cache=PictureMetadataCache())
+    return compiler.run(poll_interval=poll_interval, idle_timeout=idle_timeout)
+
+
+class CompleteTrialScanner:
+    """
+    Incremental PngSlideIdCollector.collect_complete_task_ids: every poll reads only the BehMsg rows after the
+    last one seen, and a SlideOff waiting for its TrialComplete carries over to the next poll.
+    """
+
+    def __init__(self, conn_xper, start_unix: int, end_unix: int):
+        self.conn_xper = conn_xper
+        self.last_tstamp = start_unix - 1
+        self.end_unix = end_unix
+        self._slide_off = None
+
+    def poll(self) -> list[int]:
+        self.conn_xper.execute("SELECT tstamp, type, msg FROM BehMsg WHERE tstamp > %s AND tstamp <= %s "
+                               "ORDER BY tstamp ASC", (self.last_tstamp, self.end_unix))
+        task_ids = []
+        for tstamp, msg_type, msg in self.conn_xper.fetch_all():
+            self.last_tstamp = tstamp
+            if msg_type == 'SlideOff':
+                self._slide_off = xmltodict.parse(msg)
+            elif msg_type == 'TrialComplete' and self._slide_off:
+                try:
+                    task_ids.append(int(self._slide_off['PngSlideEvent']['taskId']))
+                except KeyError:
+                    print("Ignored a non-PNG slide event")
+                self._slide_off = None
+            elif msg_type == 'TrialStop':
+                self._slide_off = None
+        return task_ids
+
+
+class LivenotesTail:
+    """
+    Task id livenotes of a growing notes.txt. Only whole entries (ending in a blank line) are parsed until the
+    final poll. A task id noted more than once keeps its latest timestamp, as map_task_id_to_epochs_with_livenotes
+    does with is_output_first_instance=False.
+    """
+
+    def __init__(self, notes_path: str):
+        self.notes_path = notes_path
+        self.tstamp_by_task_id = {}
+        self.bytes_read = 0
+
+    def poll(self, final: bool = False):
+        if not os.path.exists(self.notes_path):
+            return
+        with open(self.notes_path, "rb") as f:
+            f.seek(self.bytes_read)
+            data = f.read()
+        if not final:
+            data = data[:data.rfind(b"\n\n") + 2] if b"\n\n" in data else b""
+        self.bytes_read += len(data)
+        text = data.decode("utf-8")
+        if not text.strip():
+            return
+        for tstamp, task_id in filter_for_task_ids(parse_livenotes_to_events(text)):
+            if tstamp >= self.tstamp_by_task_id.get(task_id, tstamp):
+                self.tstamp_by_task_id[task_id] = tstamp
+
+
+class _GrowingArray:
+    """
+    float64 values appended in chunks with amortized doubling, kept sorted for searchsorted.
+    """
+
+    def __init__(self):
+        self._values = np.empty(1024, dtype=np.float64)
+        self._size = 0
+        self._sorted = True
+
+    def extend(self, values: np.ndarray):
+        if values.size == 0:
+            return
+        if self._size + values.size > self._values.size:
+            grown = np.empty(max(2 * self._values.size, self._size + values.size), dtype=np.float64)
+            grown[:self._size] = self._values[:self._size]
+            self._values = grown
+        if (self._size and values[0] < self._values[self._size - 1]) or np.any(np.diff(values) < 0):
+            self._sorted = False
+        self._values[self._size:self._size + values.size] = values
+        self._size += values.size
+
+    @property
+    def values(self) -> np.ndarray:
+        if not self._sorted:
+            self._values[:self._size].sort()
+            self._sorted = True
+        return self._values[:self._size]
+
+
+class IntanExperimentTail:
+    """
+    Follows spike.dat and digitalin.dat of a recording in progress: marker epochs are detected as digitalin.dat
+    grows and spike times are kept per channel, in seconds, as in fetch_spike_tstamps_from_file.
+    """
+
+    def __init__(self, intan_file_path: str,
+                 false_negative_correction_duration: int = LIVE_FALSE_NEGATIVE_CORRECTION_DURATION):
+        self.spike_path = os.path.join(intan_file_path, "spike.dat")
+        self.digitalin_tail = FileTail(os.path.join(intan_file_path, "digitalin.dat"), "<u2")
+        self.detector = MarkerEpochDetector(false_negative_correction_duration)
+        self.epochs = []
+        self.header = None
+        self.channels = []
+        self.spike_horizon = -1
+        self._spike_tail = None
+        self._spike_times = []
+
+    @property
+    def sample_rate(self) -> float:
+        return self.header.sample_rate if self.header is not None else None
+
+    def poll(self, final: bool = False):
+        for digital_words in self.digitalin_tail.read_new():
+            self.epochs.extend(self.detector.feed((digital_words & 1) > 0, (digital_words & 2) > 0))
+        if final:
+            self.epochs.extend(self.detector.finish())
+        self._read_spikes()
+
+    def _read_spikes(self):
+        if self.header is None:
+            try:
+                self.header = read_spike_file_header(self.spike_path)
+            except (EOFError, FileNotFoundError):
+                return
+            self._spike_tail = FileTail(self.spike_path, self.header.record_dtype, offset=self.header.header_bytes,
+                                        chunk_items=SPIKE_CHUNK_RECORDS)
+            self.channels = [str_to_channel_enum(name) for name in self.header.channel_names]
+            self._spike_times = [_GrowingArray() for _ in self.channels]
+
+        for records in self._spike_tail.read_new():
+            decoded = decode_spike_records(self.header, records)
+            if decoded.timestamps.size:
+                self.spike_horizon = max(self.spike_horizon, int(decoded.timestamps.max()))
+            kept = (decoded.channel_indices >= 0) & (decoded.spike_ids != ARTIFACT_SPIKE_ID)
+            channel_indices = decoded.channel_indices[kept]
+            spike_times = decoded.timestamps[kept].astype(np.float64) / self.header.sample_rate
+            for channel_index in np.unique(channel_indices):
+                self._spike_times[channel_index].extend(spike_times[channel_indices == channel_index])
+
+    def spikes_in_epoch(self, epoch: tuple[int, int]) -> dict[Channel, list[float]]:
+        """
+        Spike times of every channel with epoch start <= spike <= epoch stop, like OneFileParser.
+        """
+        epoch_start = epoch[0] / self.sample_rate
+        epoch_stop = epoch[1] / self.sample_rate
+        spikes_for_channels = {}
+        for channel, spike_times in zip(self.channels, self._spike_times):
+            tstamps = spike_times.values
+            spikes_for_channels[channel] = tstamps[np.searchsorted(tstamps, epoch_start, side="left"):
+                                                   np.searchsorted(tstamps, epoch_stop, side="right")].tolist()
+        return spikes_for_channels
+
+
+class LiveChannelView:
+    """
+    Rolling raster of the latest trials and running per-MonkeyGroup mean binned rates of the watched channels.
+    """
+
+    def __init__(self, channels: list = None, num_bins: int = 10, rolling_trials: int = ROLLING_RASTER_TRIALS):
+        self.channels = channels
+        self.num_bins = num_bins
+        self.metadata_frames = []
+        self.rate_arrays = []
+        self.recent_trials = deque(maxlen=rolling_trials)
+
+    def update(self, rows: pd.DataFrame):
+        if len(rows) == 0:
+            return
+        spike_times_column = rows["SpikeTimes"].tolist()
+        epochs = rows["EpochStartStop"].tolist()
+        if self.channels is None:
+            self.channels = list(spike_times_column[0])
+        rates = np.stack([calculate_binned_spike_rates([spike_times.get(channel) for spike_times in spike_times_column],
+                                                       epochs, self.num_bins)
+                          for channel in self.channels], axis=1)
+        self.metadata_frames.append(rows[["MonkeyGroup"]])
+        self.rate_arrays.append(rates)
+        for spike_times, epoch in zip(spike_times_column, epochs):
+            self.recent_trials.append((epoch, {channel: spike_times.get(channel) for channel in self.channels}))
+
+    def plot(self, title: str = ""):
+        if not self.metadata_frames:
+            return None
+        group_statistics = group_rate_statistics(pd.concat(self.metadata_frames, ignore_index=True),
+                                                 np.concatenate(self.rate_arrays))
+        epochs = [epoch for epoch, _ in self.recent_trials]
+        n_recent = len(epochs)
+        x_proportion = np.linspace(0, 1, self.num_bins)
+
+        # The overview is only ever written to a file: draw on an Agg canvas, whatever pyplot's backend is
+        fig = Figure(figsize=(12, 2.5 * len(self.channels)))
+        FigureCanvasAgg(fig)
+        axes = fig.subplots(len(self.channels), 2, squeeze=False)
+        raster_panels = []
+        for channel_index, channel in enumerate(self.channels):
+            aligned_spike_times, offsets = align_spikes_to_epochs(
+                [spike_times[channel] for _, spike_times in self.recent_trials], epochs)
+            panel = RasterPanel(group_name="", monkey_name="", column=0, row=0, trial_rows=np.arange(n_recent),
+                                spike_times=[aligned_spike_times[offsets[i]:offsets[i + 1]] for i in range(n_recent)])
+            raster_ax, psth_ax = axes[channel_index]
+            raster_panels.append((raster_ax, panel))
+            raster_ax.set_xlim(0, RASTER_TIME_LIMIT)
+            raster_ax.set_ylim(-0.5, n_recent - 0.5)
+            raster_ax.set_ylabel(channel.value)
+            for group_index, group_name in enumerate(group_statistics.labels):
+                psth_ax.errorbar(x_proportion, group_statistics.mean[group_index, channel_index],
+                                 yerr=group_statistics.sem[group_index, channel_index], label=f'{group_name}',
+                                 alpha=0.75)
+
+        axes[0, 0].set_title(f'Last {n_recent} trials')
+        axes[0, 1].set_title(f'Average Spike Rates Among Groups (N: {int(group_statistics.n.sum())})')
+        if group_statistics.labels:
+            axes[0, 1].legend(fontsize=8)
+        axes[-1, 0].set_xlabel('Time (s)')
+        axes[-1, 1].set_xlabel('Proportion of Total Time')
+        fig.suptitle(title)
+        fig.tight_layout()
+        # Images are binned to the pixel size of their axes, which is only final after tight_layout
+        for raster_ax, panel in raster_panels:
+            draw_raster_image(raster_ax, panel)
+        return fig
+
+    def save(self, path: str, title: str = ""):
+        """
+        Redraw the view into path, replacing the previous image only once the new one is complete.
+        """
+        fig = self.plot(title)
+        if fig is None:
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + ".tmp.png"
+        fig.savefig(tmp_path)
+        os.replace(tmp_path, path)
+
+
+class LiveSessionCompiler:
+    def __init__(self, *, intan_file_path: str, conn_xper, conn_photo, start_unix: int, end_unix: int,
+                 channels: list = None, num_bins: int = 10, save_path: str = None, plot_path: str = None,
+                 title: str = None, picture_cache: PictureMetadataCache = None,
+                 false_negative_correction_duration: int = LIVE_FALSE_NEGATIVE_CORRECTION_DURATION):
+        """
+        Parameters:
+            intan_file_path (str): Experiment directory being recorded (or copied) into.
+            conn_xper: Connection to the {date}_recording database (or a SqliteConnection stand-in).
+            conn_photo: Connection to photo_metadata (or a SqliteConnection stand-in).
+            start_unix, end_unix (int): BehMsg time range to take trials from.
+            channels (list): Channels of the live view, all channels of spike.dat if None.
+            num_bins (int): Bins per epoch of the live PSTH.
+            save_path (str): Compiled .pk1 written (with its .session) by save() and at the end of run().
+            plot_path (str): PNG the live view is redrawn into after every poll that compiled trials.
+            picture_cache (PictureMetadataCache): Optional cache of monkey metadata by picture path.
+        """
+        self.intan_file_path = intan_file_path
+        self.trial_scanner = CompleteTrialScanner(conn_xper, start_unix, end_unix)
+        self.notes = LivenotesTail(os.path.join(intan_file_path, "notes.txt"))
+        self.intan = IntanExperimentTail(intan_file_path, false_negative_correction_duration)
+        self.resolver = MonkeyMetadataResolver(conn_xper=conn_xper, conn_photo=conn_photo,
+                                               picture_cache=picture_cache)
+        self.view = LiveChannelView(channels, num_bins)
+        self.save_path = save_path
+        self.plot_path = plot_path
+        self.title = title if title is not None else os.path.basename(os.path.normpath(intan_file_path))
+        self.rows = []
+        self.pending_task_ids = []
+        self.unmatched_task_ids = []
+        self._order_by_task_id = {}
+
+    def poll(self, final: bool = False) -> pd.DataFrame:
+        """
+        Read everything appended since the last poll and compile the trials that became complete.
+
+        With final=True the files are taken as complete: the last epoch is closed and tasks still without a
+        livenote or epoch are given up (kept in unmatched_task_ids).
+
+        Returns:
+            pd.DataFrame: The rows compiled by this poll.
+        """
+        for task_id in self.trial_scanner.poll():
+            if task_id not in self._order_by_task_id:
+                self._order_by_task_id[task_id] = len(self._order_by_task_id)
+                self.pending_task_ids.append(task_id)
+        self.notes.poll(final)
+        self.intan.poll(final)
+
+        epoch_starts = np.array([epoch[0] for epoch in self.intan.epochs], dtype=np.int64)
+        ready = []
+        still_pending = []
+        for task_id in self.pending_task_ids:
+            epoch = self._epoch_for_task(task_id, epoch_starts, final)
+            if epoch is not None:
+                ready.append((task_id, epoch))
+            elif final:
+                self.unmatched_task_ids.append(task_id)
+            else:
+                still_pending.append(task_id)
+        self.pending_task_ids = still_pending
+
+        rows = self._compile_rows(ready)
+        self.rows.extend(rows.to_dict("records"))
+        self.view.update(rows)
+        return rows
+
+    def _epoch_for_task(self, task_id: int, epoch_starts: np.ndarray, final: bool) -> tuple[int, int] | None:
+        """
+        The epoch whose start is closest to the task's livenote (the earlier one on a tie, as in
+        map_task_id_to_epochs_with_livenotes), once no later epoch can be closer and its spikes have been read.
+        """
+        tstamp = self.notes.tstamp_by_task_id.get(task_id)
+        if tstamp is None or epoch_starts.size == 0 or self.intan.sample_rate is None:
+            return None
+        next_index = int(np.searchsorted(epoch_starts, tstamp, side="left"))
+        if next_index == epoch_starts.size and not final:
+            # An epoch still to come could start closer to the note
+            return None
+        if next_index == 0:
+            epoch_index = 0
+        elif next_index == epoch_starts.size:
+            epoch_index = next_index - 1
+        elif tstamp - epoch_starts[next_index - 1] <= epoch_starts[next_index] - tstamp:
+            epoch_index = next_index - 1
+        else:
+            epoch_index = next_index
+        epoch = self.intan.epochs[epoch_index]
+        if not final and self.intan.spike_horizon < epoch[1]:
+            return None
+        return epoch
+
+    def _compile_rows(self, ready: list[tuple[int, tuple[int, int]]]) -> pd.DataFrame:
+        columns = ["TaskField", "FileName", "MonkeyId", "MonkeyName", "MonkeyGroup", "SpikeTimes", "EpochStartStop"]
+        if not ready:
+            return pd.DataFrame(columns=columns)
+        metadata_by_task_id = self.resolver.resolve([task_id for task_id, _ in ready])
+        sample_rate = self.intan.sample_rate
+        rows = []
+        for task_id, epoch in ready:
+            metadata = metadata_by_task_id.get(task_id)
+            rows.append({
+                "TaskField": task_id,
+                "FileName": metadata.file_name if metadata else None,
+                "MonkeyId": metadata.monkey_id if metadata else None,
+                "MonkeyName": metadata.monkey_name if metadata else None,
+                "MonkeyGroup": metadata.monkey_group if metadata else None,
+                "SpikeTimes": self.intan.spikes_in_epoch(epoch),
+                "EpochStartStop": (epoch[0] / sample_rate, epoch[1] / sample_rate),
+            })
+        return pd.DataFrame(rows, columns=columns)
+
+    @property
+    def data(self) -> pd.DataFrame:
+        """
+        Every trial compiled so far, in the order the trials completed in the database.
+        """
+        rows = sorted(self.rows, key=lambda row: self._order_by_task_id[row["TaskField"]])
+        return pd.DataFrame(rows, columns=["TaskField", "FileName", "MonkeyId", "MonkeyName", "MonkeyGroup",
+                                           "SpikeTimes", "EpochStartStop"])
+
+    def save(self) -> pd.DataFrame:
+        data = self.data
+        if self.save_path is not None:
+            data.to_pickle(self.save_path)
+            write_session(data, session_path_for(self.save_path))
+            update_catalog(self.save_path, session_path_for(self.save_path))
+        return data
+
+    def draw(self):
+        if self.plot_path is not None:
+            self.view.save(self.plot_path, self.title)
+
+    def finish(self) -> pd.DataFrame:
+        """
+        Final poll with the files taken as complete, then save and draw.
+        """
+        self.poll(final=True)
+        if self.unmatched_task_ids:
+            print(f"{len(self.unmatched_task_ids)} complete tasks had no livenote or epoch and were left out")
+        self.draw()
+        return self.save()
+
+    def run(self, poll_interval: float = LIVE_POLL_INTERVAL, idle_timeout: float = 120.0,
+            max_duration: float = None) -> pd.DataFrame:
+        """
+        Poll until nothing new has arrived (no file growth and no new trials) for idle_timeout seconds or
+        max_duration seconds have passed, then finish.
+        """
+        started = monotonic()
+        last_activity = started
+        last_progress = None
+        while True:
+            poll_started = monotonic()
+            rows = self.poll()
+            progress = (self.trial_scanner.last_tstamp, self.intan.digitalin_tail.items_read,
+                        self.intan.spike_horizon, self.notes.bytes_read)
+            if progress != last_progress or len(rows):
+                last_activity = monotonic()
+                last_progress = progress
+            if len(rows):
+                self.draw()
+                print(f"Compiled {len(rows)} trials ({len(self.rows)} total, {len(self.pending_task_ids)} pending) "
+                      f"in {monotonic() - poll_started:.2f}s")
+            now = monotonic()
+            if now - last_activity >= idle_timeout or (max_duration is not None and now - started >= max_duration):
+                break
+            sleep(max(0.0, poll_interval - (now - poll_started)))
+        return self.finish()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,17 +1,32 @@
 import os
 from datetime import datetime, time, date
+from functools import lru_cache
 
 import pytz
 from clat.compile.task.compile_task_id import PngSlideIdCollector
-from clat.compile.task.julie_database_fields import FileNameField, MonkeyIdField, MonkeyNameField, MonkeyGroupField
+from julie.compile.compile_profiler import CompileProfiler, trace_path_for
+from julie.compile.concurrent_compilation import open_connection, get_data_from_tasks_concurrently
+from julie.compile.julie_database_fields import FileNameField, MonkeyIdField, MonkeyNameField, MonkeyGroupField, \
+    MonkeyMetadataResolver
 from clat.compile.task.julie_intan_file_per_experiment_fields import SpikeTimesForChannelsField_Experiment, \
     EpochStartStopField_Experiment
-from julie.compile.julie_intan_file_per_trial_fields import SpikeTimesForChannelsField, EpochStartStopField
-from clat.compile.task.task_field import TaskFieldList, get_data_from_tasks, TaskField
-from clat.intan.one_file_spike_parsing import OneFileParser
+from julie.compile.julie_intan_file_per_experiment_fields import parse_intan_experiment_directory
+from julie.compile.julie_intan_file_per_trial_fields import SpikeTimesForChannelsField, EpochStartStopField, \
+    IntanDirectoryIndex
+from julie.compile.picture_metadata_cache import PictureMetadataCache, photo_metadata_version
+from julie.compile.task_result_cache import TaskResultCache, cache_task_fields, uncached_task_ids, \
+    database_fingerprint, file_fingerprint
+from julie.catalog import update_catalog
+from julie.compiled_session import write_session, session_path_for
+from julie.data_quality import assess_quality
+from clat.compile.task.task_field import TaskFieldList, TaskField
 from clat.util import time_util
 from clat.util.connection import Connection
 
+COMPILED_DIR = "/compiled/julie"
+TASK_CACHE_FILENAME = "task_cache.sqlite"
+METADATA_FIELD_NAMES = ["FileName", "MonkeyId", "MonkeyName", "MonkeyGroup"]
+
 
 def main():
     # Main Parameters
@@ -29,41 +44,83 @@ def main():
 def compile_data(day: date = None,
                  start_time: time = None,
                  end_time: time = None,
-                 experiment_filename: str = None):
+                 experiment_filename: str = None,
+                 use_cache: bool = True,
+                 max_workers: int = 1,
+                 profile: bool = False):
     """
     if providing experiment_filename, only day is required. start and end_time can be provided to speed up code but is optional.
         -this is for compiling from a single file per experiment.
 
     if NOT providing experiment_filename, day, start_time, and end_time are required
         - this is for compiling data from a single file per trial.
+
+    if use_cache is True, field results are kept in a per-task cache next to the compiled files, and reruns only
+    recompute tasks whose database, Intan files or photo_metadata changed. Monkey metadata of pictures seen in
+    earlier sessions comes from the shared PictureMetadataCache instead of photo_metadata.
+
+    max_workers > 1 evaluates the fields of different tasks on that many threads, each with its own database
+    connections. Row order is the same as with a single worker.
+
+    if profile is True, the time, calls, bytes read and database round trips of every stage and field are printed
+    at the end and written to a .profile.json trace next to the compiled file.
     """
+    profiler = CompileProfiler(enabled=profile)
+    save_dir = COMPILED_DIR
+    cache = TaskResultCache(os.path.join(save_dir, TASK_CACHE_FILENAME)) if use_cache else None
+    picture_cache = PictureMetadataCache() if use_cache else None
 
     if experiment_filename is not None:
         data = collect_raw_data_single_file_for_experiment(day=day, start_time=time(0, 0, 0), end_time=time(23, 59, 59),
-                                                           experiment_name=experiment_filename)
-        filename = f"{experiment_filename}.pk1"
+                                                           experiment_name=experiment_filename, cache=cache,
+                                                           picture_cache=picture_cache, max_workers=max_workers,
+                                                           profiler=profiler)
     else:
-        data = collect_raw_data_new_file_per_trial(day=day, start_time=start_time, end_time=end_time)
-        filename = f"{day.strftime('%Y-%m-%d')}_{start_time.strftime('%H-%M-%S')}_to_{end_time.strftime('%H-%M-%S')}.pk1"
+        data = collect_raw_data_new_file_per_trial(day=day, start_time=start_time, end_time=end_time, cache=cache,
+                                                   picture_cache=picture_cache, max_workers=max_workers,
+                                                   profiler=profiler)
 
     # Clean rows with empty SpikeTimes
     data = data[data['SpikeTimes'].notna()]
+    print(assess_quality(data).summary())
 
     # Save Data
-    save_dir = "/compiled/julie"
-    # filename = f"{day.strftime('%Y-%m-%d')}_{start_time.strftime('%H-%M-%S')}_to_{end_time.strftime('%H-%M-%S')}.pk1"
-    save_path = os.path.join(save_dir, filename)
-    data.to_pickle(save_path)
+    save_path = compiled_path(day, start_time, end_time, experiment_filename)
+    with profiler.stage("save pickle"):
+        data.to_pickle(save_path)
+    with profiler.stage("write session"):
+        write_session(data, session_path_for(save_path))
+    with profiler.stage("update catalog"):
+        update_catalog(save_path, session_path_for(save_path))
+    profiler.report(trace_path_for(save_path))
 
     return data
 
 
-def collect_raw_data_single_file_for_experiment(*, day: date, start_time: time, end_time: time, experiment_name: str):
+def compiled_path(day: date = None, start_time: time = None, end_time: time = None,
+                  experiment_filename: str = None) -> str:
+    """
+    Where compile_data saves the pickle for these arguments (the session directory is next to it).
+    """
+    if experiment_filename is not None:
+        filename = f"{experiment_filename}.pk1"
+    else:
+        filename = f"{day.strftime('%Y-%m-%d')}_{start_time.strftime('%H-%M-%S')}_to_{end_time.strftime('%H-%M-%S')}.pk1"
+    return os.path.join(COMPILED_DIR, filename)
+
+
+def collect_raw_data_single_file_for_experiment(*, day: date, start_time: time, end_time: time, experiment_name: str,
+                                                cache: TaskResultCache = None,
+                                                picture_cache: PictureMetadataCache = None, max_workers: int = 1,
+                                                profiler: CompileProfiler = None):
     # Find path of intan files to read from
     day_path = day.strftime("%Y-%m-%d")
     date_no_hyphens = day_path.replace('-', '')
-    conn_xper = Connection(f"{date_no_hyphens}_recording", host="172.30.6.59")
-    conn_photo = Connection("photo_metadata", host="172.30.6.59")
+    profiler = profiler if profiler is not None else CompileProfiler(enabled=False)
+    conn_xper = profiler.connection(
+        open_connection(f"{date_no_hyphens}_recording", host="172.30.6.59", max_workers=max_workers), "recording")
+    conn_photo = profiler.connection(
+        open_connection("photo_metadata", host="172.30.6.59", max_workers=max_workers), "photo_metadata")
     intan_base_path = "/run/user/1003/gvfs/sftp:host=172.30.6.58/home/connorlab/Documents/IntanData"
     intan_data_path = os.path.join(intan_base_path, day_path)
     intan_file_path = os.path.join(intan_data_path, experiment_name)
@@ -74,26 +131,67 @@ def collect_raw_data_single_file_for_experiment(*, day: date, start_time: time,
     # Collect task Ids
     task_id_collector = PngSlideIdCollector(conn_xper)
     time_range = (start_unix, end_unix)
-    task_ids = task_id_collector.collect_complete_task_ids(time_range)
+    with profiler.stage("collect task ids"):
+        task_ids = task_id_collector.collect_complete_task_ids(time_range)
 
-    # Parse Spikes
-    parser = OneFileParser()
-    spike_tstamps_for_channels_by_task_id, epoch_start_stop_by_task_id, sample_rate = parser.parse(intan_file_path)
+    # Spikes are parsed below, only if some task is missing from the cache
+    spike_tstamps_for_channels_by_task_id = {}
+    epoch_start_stop_by_task_id = {}
+    resolver = MonkeyMetadataResolver(conn_xper=conn_xper, conn_photo=conn_photo, picture_cache=picture_cache)
 
     # Task Fields
     fields = TaskFieldList()
     fields.append(TaskField())
-    fields.append(FileNameField(conn_xper=conn_xper))
-    fields.append(MonkeyIdField(conn_xper=conn_xper, conn_photo=conn_photo))
-    fields.append(MonkeyNameField(conn_xper=conn_xper, conn_photo=conn_photo))
-    fields.append(MonkeyGroupField(conn_xper=conn_xper, conn_photo=conn_photo))
+    fields.append(FileNameField(conn_xper=conn_xper, resolver=resolver))
+    fields.append(MonkeyIdField(conn_xper=conn_xper, conn_photo=conn_photo, resolver=resolver))
+    fields.append(MonkeyNameField(conn_xper=conn_xper, conn_photo=conn_photo, resolver=resolver))
+    fields.append(MonkeyGroupField(conn_xper=conn_xper, conn_photo=conn_photo, resolver=resolver))
     fields.append(SpikeTimesForChannelsField_Experiment(spike_tstamps_for_channels_by_task_id))
     fields.append(EpochStartStopField_Experiment(epoch_start_stop_by_task_id))
+
+    metadata_task_ids = task_ids
+    spike_task_ids = task_ids
+    if cache is not None:
+        database = database_fingerprint(conn_xper)
+        intan_files = database + "|" + file_fingerprint([os.path.join(intan_file_path, filename) for filename in
+                                                         ("spike.dat", "digitalin.dat", "notes.txt")])
+        fields = cache_task_fields(fields, cache, lambda task_id: database,
+                                   {**metadata_fingerprints(conn_xper, conn_photo, picture_cache),
+                                    "SpikeTimes": lambda task_id: intan_files,
+                                    "EpochStartStop": lambda task_id: intan_files})
+        metadata_task_ids = uncached_task_ids(fields, task_ids, METADATA_FIELD_NAMES)
+        spike_task_ids = uncached_task_ids(fields, task_ids, ["SpikeTimes", "EpochStartStop"])
+
+    # Resolve monkey metadata for all tasks in bulk
+    with profiler.stage("resolve metadata"):
+        resolver.resolve(metadata_task_ids)
+
+    # Parse Spikes
+    if spike_task_ids:
+        with profiler.stage("parse intan files"):
+            parsed_spikes, parsed_epochs, sample_rate = parse_intan_experiment_directory(intan_file_path)
+        spike_tstamps_for_channels_by_task_id.update(parsed_spikes)
+        epoch_start_stop_by_task_id.update(parsed_epochs)
+
     # Get data
-    data = get_data_from_tasks(fields, task_ids)
+    fields = profiler.task_fields(fields)
+    with profiler.stage("evaluate fields"):
+        data = get_data_from_tasks_concurrently(fields, task_ids, max_workers=max_workers)
     return data
 
 
+def metadata_fingerprints(conn_xper: Connection, conn_photo: Connection,
+                          picture_cache: PictureMetadataCache = None) -> dict:
+    """
+    Fingerprints of the METADATA_FIELD_NAMES fields for cache_task_fields: the recording database and the version
+    of photo_metadata, so editing photo_metadata recomputes them. Checks the version once, through picture_cache
+    if given so it drops its own stale entries first.
+    """
+    version = picture_cache.version(conn_photo) if picture_cache is not None else photo_metadata_version(conn_photo)
+    fingerprint = f"{database_fingerprint(conn_xper)}|{database_fingerprint(conn_photo)}|{version}"
+    return {name: lambda task_id: fingerprint for name in METADATA_FIELD_NAMES}
+
+
 def calc_start_and_end_unix_times(day, start_time, end_time):
     timezone = pytz.timezone('US/Eastern')
     start_datetime = datetime.combine(day, start_time)
@@ -105,14 +203,20 @@ def calc_start_and_end_unix_times(day, start_time, end_time):
     return start_unix, end_unix
 
 
-def collect_raw_data_new_file_per_trial(*, day: date = date.today(), start_time: time = time(0, 0, 0), end_time: time = time(23, 59, 59)):
+def collect_raw_data_new_file_per_trial(*, day: date = date.today(), start_time: time = time(0, 0, 0), end_time: time = time(23, 59, 59),
+                                        cache: TaskResultCache = None,
+                                        picture_cache: PictureMetadataCache = None, max_workers: int = 1,
+                                        profiler: CompileProfiler = None):
     # day to string
     day_path = day.strftime("%Y-%m-%d")
 
     # remove hyphens from date
     date_no_hyphens = day_path.replace('-', '')
-    conn_xper = Connection(f"{date_no_hyphens}_recording", host="172.30.6.59")
-    conn_photo = Connection("photo_metadata", host="172.30.6.59")
+    profiler = profiler if profiler is not None else CompileProfiler(enabled=False)
+    conn_xper = profiler.connection(
+        open_connection(f"{date_no_hyphens}_recording", host="172.30.6.59", max_workers=max_workers), "recording")
+    conn_photo = profiler.connection(
+        open_connection("photo_metadata", host="172.30.6.59", max_workers=max_workers), "photo_metadata")
     intan_base_path = "/run/user/1003/gvfs/sftp:host=172.30.6.58/home/connorlab/Documents/IntanData"
     intan_data_path = os.path.join(intan_base_path, day_path)
 
@@ -122,19 +226,49 @@ def collect_raw_data_new_file_per_trial(*, day: date = date.today(), start_time:
 
     task_id_collector = PngSlideIdCollector(conn_xper)
     time_range = (start_unix, end_unix)
-    task_ids = task_id_collector.collect_complete_task_ids(time_range)
+    with profiler.stage("collect task ids"):
+        task_ids = task_id_collector.collect_complete_task_ids(time_range)
+
+    resolver = MonkeyMetadataResolver(conn_xper=conn_xper, conn_photo=conn_photo, picture_cache=picture_cache)
+    # One listing of the day folder per compilation, taken after the task ids so their directories are in it
+    directory_index = IntanDirectoryIndex(intan_data_path)
 
     # Task Fields
     fields = TaskFieldList()
     fields.append(TaskField())
-    fields.append(FileNameField(conn_xper=conn_xper))
-    fields.append(MonkeyIdField(conn_xper=conn_xper, conn_photo=conn_photo))
-    fields.append(MonkeyNameField(conn_xper=conn_xper, conn_photo=conn_photo))
-    fields.append(MonkeyGroupField(conn_xper=conn_xper, conn_photo=conn_photo))
-    fields.append(SpikeTimesForChannelsField(intan_data_path=intan_data_path))
-    fields.append(EpochStartStopField(intan_data_path=intan_data_path))
+    fields.append(FileNameField(conn_xper=conn_xper, resolver=resolver))
+    fields.append(MonkeyIdField(conn_xper=conn_xper, conn_photo=conn_photo, resolver=resolver))
+    fields.append(MonkeyNameField(conn_xper=conn_xper, conn_photo=conn_photo, resolver=resolver))
+    fields.append(MonkeyGroupField(conn_xper=conn_xper, conn_photo=conn_photo, resolver=resolver))
+    fields.append(SpikeTimesForChannelsField(intan_data_path=intan_data_path, directory_index=directory_index))
+    fields.append(EpochStartStopField(intan_data_path=intan_data_path, directory_index=directory_index))
+
+    metadata_task_ids = task_ids
+    if cache is not None:
+        database = database_fingerprint(conn_xper)
+
+        @lru_cache(maxsize=None)
+        def trial_files(task_id: int) -> str:
+            # Each trial has its own directory, so only that directory's files matter
+            matching_intan_file_paths = directory_index.find_matching_directories(task_id)
+            if len(matching_intan_file_paths) == 0:
+                return database + "|missing"
+            return database + "|" + file_fingerprint([os.path.join(matching_intan_file_paths[-1], filename)
+                                                      for filename in ("spike.dat", "digitalin.dat", "notes.txt")])
+
+        fields = cache_task_fields(fields, cache, lambda task_id: database,
+                                   {**metadata_fingerprints(conn_xper, conn_photo, picture_cache),
+                                    "SpikeTimes": trial_files, "EpochStartStop": trial_files})
+        metadata_task_ids = uncached_task_ids(fields, task_ids, METADATA_FIELD_NAMES)
+
+    # Resolve monkey metadata for all tasks in bulk
+    with profiler.stage("resolve metadata"):
+        resolver.resolve(metadata_task_ids)
+
     # Get data
-    data = get_data_from_tasks(fields, task_ids)
+    fields = profiler.task_fields(fields)
+    with profiler.stage("evaluate fields"):
+        data = get_data_from_tasks_concurrently(fields, task_ids, max_workers=max_workers)
     print(data.to_string())
     return data
 
@@ -1,8 +1,10 @@
 import os
-import pickle
 
 import pandas as pd
 
+from julie.catalog import update_catalog
+from julie.compiled_session import SessionWriter, SESSION_SUFFIX, read_compiled, session_path_for, write_session
+
 
 def main():
     round_one = ["1696954960635002_231010_122242_round1_1.pk1",
@@ -23,27 +25,80 @@ def main():
     file_paths = ["/home/r2_allen/git/EStimShape/EStimShapeAnalysis/compiled/julie/%s" % experiment_data_filename for
                   experiment_data_filename in experiment_data_filenames]
 
-    data = add_pickled_dataframes(file_paths)
-    print("Combined Dataframe number of trials:", len(data))
     combined_filename = "&".join(experiment_names) + ".pk1"
     save_dir = "/compiled/julie"
     save_path = os.path.join(save_dir, combined_filename)
+    # Inputs are read once; the pickle keeps the name analyses open and the session directory goes next to it
+    data = add_pickled_dataframes(file_paths)
+    print("Combined Dataframe number of trials:", len(data))
     data.to_pickle(save_path)
+    write_session(data, session_path_for(save_path))
+    update_catalog(save_path, session_path_for(save_path))
+
 
+def add_pickled_dataframes(paths, source_column: str = "Session"):
+    """
+    Merge compiled sessions (pickles or session directories) into one DataFrame.
 
-def add_pickled_dataframes(paths):
-    result = None
+    Sessions are read one at a time and concatenated once at the end. Every session must have the same columns.
+    If source_column is not None, each row is tagged with the name of the session it came from, unless it already
+    has a tag (an input that is itself a merge keeps the sessions its rows came from).
+    """
+    frames = [data for _, data in iter_sessions(paths, source_column)]
+    if not frames:
+        return None
+    return pd.concat(frames, axis=0, ignore_index=True)
 
+
+def merge_to_file(paths, output_path: str, source_column: str = "Session"):
+    """
+    Merge compiled sessions straight into output_path.
+
+    A session directory output (ending in .session) is written while streaming, so only one input is held in
+    memory at a time. Any other output path is written as a pickle.
+    """
+    if str(output_path).endswith(SESSION_SUFFIX):
+        writer = SessionWriter(output_path)
+        n_trials = 0
+        for _, data in iter_sessions(paths, source_column):
+            writer.append(data)
+            n_trials += len(data)
+        writer.close()
+        print("Merged", n_trials, "trials into", output_path)
+        return
+    data = add_pickled_dataframes(paths, source_column)
+    data.to_pickle(output_path)
+
+
+def iter_sessions(paths, source_column: str = None):
+    """
+    Yield (path, DataFrame) for each compiled session, checking that all of them share one column schema.
+    source_column is left out of the check, since only merged inputs have it.
+    """
+    columns = None
     for path in paths:
-        with open(path, 'rb') as file:
-            data = pickle.load(file)
-            if result is None:
-                result = data
+        data = read_compiled(path)
+        if columns is None:
+            columns = [column for column in data.columns if column != source_column]
+        elif set(data.columns) - {source_column} != set(columns):
+            missing = sorted(set(columns) - set(data.columns))
+            extra = sorted(set(data.columns) - set(columns) - {source_column})
+            raise ValueError(f"Column mismatch in {path}: missing {missing}, unexpected {extra}")
+
+        if source_column is not None:
+            if source_column in data:
+                tags = data[source_column].fillna(session_name(path))
             else:
-                # Concatenate the DataFrames vertically (later ones below earlier ones)
-                result = pd.concat([result, data], axis=0, ignore_index=True)
+                tags = session_name(path)
+            data = data[columns].copy()
+            data[source_column] = tags
+        else:
+            data = data[columns]
+        yield path, data
+
 
-    return result
+def session_name(path) -> str:
+    return os.path.basename(str(path).rstrip(os.sep)).split(".")[0]
 
 
 if __name__ == '__main__':
@@ -0,0 +1,206 @@
+"""
+Persistent cache of picture file path -> MonkeyMetadata (FileName, MonkeyId, MonkeyName, JpgId, MonkeyGroup).
+
+The stimulus set barely changes between days, so MonkeyMetadataResolver looks pictures up here before asking
+photo_metadata. Entries live in a local SQLite file shared by every session, with the most recently used ones
+kept in memory as well:
+
+    cache = PictureMetadataCache(DEFAULT_PICTURE_CACHE_PATH)
+    resolver = MonkeyMetadataResolver(conn_xper=conn_xper, conn_photo=conn_photo, picture_cache=cache)
+
+Entries are stored per photo_metadata database (host/database) together with a version of its contents. When
+the version changes, every entry of that database is dropped and looked up again.
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import astuple
+
+from clat.util.connection import Connection
+
+from julie.compile.julie_database_fields import MonkeyMetadata, RESOLVER_VERSION
+from julie.compile.task_result_cache import database_fingerprint
+
+DEFAULT_PICTURE_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".cache", "julie", "picture_metadata.sqlite")
+MAX_MEMORY_ENTRIES = 4096
+VERSION_CHECK_INTERVAL = 600.0
+
+
+def photo_metadata_version(conn_photo: Connection) -> str:
+    """
+    Version of the photo_metadata contents the resolver reads: a hash of the combined_view and photos rows.
+
+    Any change to a row the resolver can return (adding, removing or renaming a monkey, two monkeys swapping
+    names, reassigning a jpg_id, moving a picture to another group) changes the version. Works on MySQL and on
+    the SQLite stand-in alike.
+    """
+    digest = hashlib.sha256()
+    for query in ("SELECT monkey_id, monkey_name, jpg_id FROM photo_metadata.combined_view "
+                  "ORDER BY monkey_id, jpg_id, monkey_name",
+                  "SELECT jpg_id, monkey_group FROM photo_metadata.photos ORDER BY jpg_id, monkey_group"):
+        conn_photo.execute(query)
+        for row in conn_photo.fetch_all():
+            digest.update(json.dumps(list(row), default=str).encode())
+            digest.update(b"\n")
+        # Rows of one table can't be mistaken for rows of the other
+        digest.update(b"--\n")
+    return digest.hexdigest()
+
+
+class PictureMetadataCache:
+    """
+    MonkeyMetadata by picture path: an in-memory LRU of max_memory_entries over a SQLite store.
+
+    The photo_metadata version is checked the first time a cache instance sees a database, and again once
+    version_check_interval seconds have passed. Caches opened within that interval of the last check (e.g. by
+    the sessions of a batch) skip it, so their cached pictures cost no photo_metadata queries at all; edits to
+    photo_metadata are seen at most that much later. With an interval of 0 every instance checks once.
+    """
+
+    def __init__(self, path: str = DEFAULT_PICTURE_CACHE_PATH, max_memory_entries: int = MAX_MEMORY_ENTRIES,
+                 version_check_interval: float = VERSION_CHECK_INTERVAL):
+        self.path = path
+        self.max_memory_entries = max_memory_entries
+        self.version_check_interval = version_check_interval
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.lock = threading.Lock()
+        self.memory = OrderedDict()
+        self.checked_at_by_source = {}
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS PhotoMetadataVersion (
+              source TEXT PRIMARY KEY,
+              version TEXT NOT NULL,
+              checked_at REAL NOT NULL
+            )""")
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS PictureMetadata (
+              source TEXT NOT NULL,
+              picture_path TEXT NOT NULL,
+              metadata TEXT NOT NULL,
+              PRIMARY KEY (source, picture_path)
+            )""")
+        self.db.commit()
+
+    def get_many(self, conn_photo: Connection, picture_paths: list[str]) -> dict[str, MonkeyMetadata]:
+        """
+        Cached metadata of the picture_paths found, for the photo_metadata database behind conn_photo.
+        """
+        source = self._current_source(conn_photo)
+        found = {}
+        missing_paths = []
+        with self.lock:
+            for picture_path in picture_paths:
+                key = (source, picture_path)
+                if key in self.memory:
+                    self.memory.move_to_end(key)
+                    found[picture_path] = self.memory[key]
+                else:
+                    missing_paths.append(picture_path)
+
+            for i in range(0, len(missing_paths), 500):
+                chunk = missing_paths[i:i + 500]
+                rows = self.db.execute("SELECT picture_path, metadata FROM PictureMetadata WHERE source = ? "
+                                       f"AND picture_path IN ({', '.join('?' * len(chunk))})",
+                                       (source, *chunk)).fetchall()
+                for picture_path, metadata in rows:
+                    found[picture_path] = MonkeyMetadata(*json.loads(metadata))
+                    self._remember((source, picture_path), found[picture_path])
+        return found
+
+    def put_many(self, conn_photo: Connection, metadata_by_picture_path: dict[str, MonkeyMetadata]):
+        source = self._current_source(conn_photo)
+        with self.lock:
+            self.db.executemany("INSERT OR REPLACE INTO PictureMetadata (source, picture_path, metadata) "
+                                "VALUES (?, ?, ?)",
+                                [(source, picture_path, json.dumps(astuple(metadata)))
+                                 for picture_path, metadata in metadata_by_picture_path.items()])
+            self.db.commit()
+            for picture_path, metadata in metadata_by_picture_path.items():
+                self._remember((source, picture_path), metadata)
+
+    def version(self, conn_photo: Connection) -> str:
+        """
+        The photo_metadata version of conn_photo, checked now whatever version_check_interval says (entries of an
+        older version are dropped). Per-task caches of monkey metadata key their results on it.
+        """
+        source = _source(conn_photo)
+        with self.lock:
+            row = self.db.execute("SELECT version FROM PhotoMetadataVersion WHERE source = ?", (source,)).fetchone()
+        return self._check_version(conn_photo, source, row[0] if row is not None else None, time.time())
+
+    def invalidate(self, conn_photo: Connection = None):
+        """
+        Drop the entries of one photo_metadata database, or of all of them.
+        """
+        with self.lock:
+            if conn_photo is None:
+                self.db.execute("DELETE FROM PictureMetadata")
+                self.db.execute("DELETE FROM PhotoMetadataVersion")
+                self.memory.clear()
+                self.checked_at_by_source.clear()
+            else:
+                self._drop_source(_source(conn_photo))
+            self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+    def _current_source(self, conn_photo: Connection) -> str:
+        """
+        The source key of conn_photo, after dropping its entries if photo_metadata changed since they were stored.
+        """
+        source = _source(conn_photo)
+        now = time.time()
+        checked_at = self.checked_at_by_source.get(source)
+        if checked_at is not None and (self.version_check_interval <= 0
+                                       or now - checked_at < self.version_check_interval):
+            return source
+
+        with self.lock:
+            row = self.db.execute("SELECT version, checked_at FROM PhotoMetadataVersion WHERE source = ?",
+                                  (source,)).fetchone()
+        if checked_at is None and row is not None and now - row[1] < self.version_check_interval:
+            self.checked_at_by_source[source] = row[1]
+            return source
+
+        self._check_version(conn_photo, source, row[0] if row is not None else None, now)
+        return source
+
+    def _check_version(self, conn_photo: Connection, source: str, stored_version: str | None, now: float) -> str:
+        version = photo_metadata_version(conn_photo)
+        with self.lock:
+            if stored_version is not None and stored_version != version:
+                self._drop_source(source)
+            self.db.execute("INSERT OR REPLACE INTO PhotoMetadataVersion (source, version, checked_at) "
+                            "VALUES (?, ?, ?)", (source, version, now))
+            self.db.commit()
+            self.checked_at_by_source[source] = now
+        return version
+
+    def _drop_source(self, source: str):
+        self.db.execute("DELETE FROM PictureMetadata WHERE source = ?", (source,))
+        self.db.execute("DELETE FROM PhotoMetadataVersion WHERE source = ?", (source,))
+        for key in [key for key in self.memory if key[0] == source]:
+            del self.memory[key]
+        self.checked_at_by_source.pop(source, None)
+
+    def _remember(self, key: tuple[str, str], metadata: MonkeyMetadata):
+        self.memory[key] = metadata
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_memory_entries:
+            self.memory.popitem(last=False)
+
+
+def _source(conn_photo: Connection) -> str:
+    # Entries resolved by an older MonkeyMetadataResolver live under another source and are never served
+    return f"{database_fingerprint(conn_photo)}|v{RESOLVER_VERSION}"
@@ -0,0 +1,151 @@
+"""
+Memory-mapped store for sorted spikes (sorted_spikes.pkl: channel -> unit name -> spike sample indices).
+
+A store is a directory (sorted_spikes.store) containing:
+    manifest.json       units in order, as (channel key, unit name)
+    indices.i8          int64 spike sample indices of every unit, unit after unit, sorted within each unit
+    offsets.npy         int64 offsets (n_units + 1) into indices.i8
+    times_<rate>.f8     float64 spike times in seconds at a given sample rate, written on first use
+
+Unit arrays are read-only views into one memory map, so a whole-day sorting costs only the pages actually
+touched, and per-trial spikes from spike_epoching are views into those arrays.
+"""
+
+import json
+import os
+import pickle
+import shutil
+
+import numpy as np
+
+from julie.compiled_session import encode_spike_key, decode_spike_key
+
+STORE_SUFFIX = ".store"
+TIMES_CHUNK_SIZE = 1 << 22
+
+
+def store_path_for(pickle_path: str) -> str:
+    return os.path.splitext(str(pickle_path))[0] + STORE_SUFFIX
+
+
+def write_sorted_spike_store(spike_indices_by_unit_by_channel: dict, path: str):
+    """
+    Write a store one unit at a time, replacing any existing store at path once complete.
+    """
+    path = str(path)
+    tmp_path = path + ".tmp"
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+
+    units = []
+    counts = []
+    with open(os.path.join(tmp_path, "indices.i8"), "wb") as f:
+        for channel, spike_indices_by_unit in spike_indices_by_unit_by_channel.items():
+            for unit_name, spike_indices in spike_indices_by_unit.items():
+                spike_indices = np.sort(np.asarray(spike_indices, dtype=np.int64).ravel())
+                spike_indices.astype("<i8", copy=False).tofile(f)
+                units.append({"channel": encode_spike_key(channel), "unit": str(unit_name)})
+                counts.append(spike_indices.size)
+
+    offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(np.asarray(counts, dtype=np.int64), out=offsets[1:])
+    np.save(os.path.join(tmp_path, "offsets.npy"), offsets)
+    with open(os.path.join(tmp_path, "manifest.json"), "w") as f:
+        json.dump({"units": units}, f, indent=1)
+
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.rename(tmp_path, path)
+
+
+class SortedSpikeStore:
+    """
+    Read access to a store. Unit spike indices are views into a single read-only memory map.
+    """
+
+    def __init__(self, path: str):
+        self.path = str(path)
+        with open(os.path.join(self.path, "manifest.json")) as f:
+            manifest = json.load(f)
+        self.units = [(decode_spike_key(unit["channel"]), unit["unit"]) for unit in manifest["units"]]
+        self.offsets = np.load(os.path.join(self.path, "offsets.npy"))
+        if self.offsets[-1] > 0:
+            self.indices = np.memmap(os.path.join(self.path, "indices.i8"), dtype="<i8", mode="r",
+                                     shape=(int(self.offsets[-1]),))
+        else:
+            self.indices = np.empty(0, dtype=np.int64)
+
+    def unit_spike_indices(self, unit_position: int) -> np.ndarray:
+        return self.indices[self.offsets[unit_position]:self.offsets[unit_position + 1]]
+
+    def spike_indices_by_unit_by_channel(self) -> dict:
+        """
+        The store in the layout of sorted_spikes.pkl (channel -> unit name -> spike indices), with memory-mapped
+        views in place of in-memory arrays. Accepted anywhere the unpickled dict is, e.g.
+        spike_epoching.assign_sorted_spikes_to_epochs.
+        """
+        spike_indices_by_unit_by_channel = {}
+        for unit_position, (channel, unit_name) in enumerate(self.units):
+            spike_indices_by_unit_by_channel.setdefault(channel, {})[unit_name] = self.unit_spike_indices(unit_position)
+        return spike_indices_by_unit_by_channel
+
+    def spike_times_by_unit(self, sample_rate: float, reverse_channels: bool = False) -> dict[str, np.ndarray]:
+        """
+        Memory-mapped spike times in seconds of every unit, keyed "{channel}_{unit name}" like
+        spike_epoching.assign_sorted_spikes_to_epochs.
+
+        The times are converted from the indices once per sample rate and kept in the store, so they are
+        not held in memory next to the indices.
+        """
+        times = self._spike_times(sample_rate)
+        positions_by_channel = {}
+        for unit_position, (channel, _) in enumerate(self.units):
+            positions_by_channel.setdefault(channel, []).append(unit_position)
+        channels = list(positions_by_channel)
+        if reverse_channels:
+            channels.reverse()
+
+        spike_times_by_unit = {}
+        for channel in channels:
+            for unit_position in positions_by_channel[channel]:
+                unit_name = self.units[unit_position][1]
+                spike_times_by_unit[f"{channel}_{unit_name}"] = \
+                    times[self.offsets[unit_position]:self.offsets[unit_position + 1]]
+        return spike_times_by_unit
+
+    def _spike_times(self, sample_rate: float) -> np.ndarray:
+        if self.offsets[-1] == 0:
+            return np.empty(0, dtype=np.float64)
+        times_path = os.path.join(self.path, f"times_{float(sample_rate):g}.f8")
+        if not os.path.exists(times_path):
+            tmp_path = times_path + ".tmp"
+            with open(tmp_path, "wb") as f:
+                # Convert in chunks so only one chunk of times is in memory at once
+                for chunk_start in range(0, self.indices.size, TIMES_CHUNK_SIZE):
+                    chunk = self.indices[chunk_start:chunk_start + TIMES_CHUNK_SIZE]
+                    (np.asarray(chunk, dtype=np.float64) / sample_rate).astype("<f8", copy=False).tofile(f)
+            os.replace(tmp_path, times_path)
+        return np.memmap(times_path, dtype="<f8", mode="r", shape=(int(self.offsets[-1]),))
+
+    @property
+    def nbytes(self) -> int:
+        return int(self.offsets[-1]) * 8
+
+
+def load_sorted_spikes(pickle_path: str) -> SortedSpikeStore:
+    """
+    Sorted spikes of a recording, memory-mapped.
+
+    The store next to pickle_path is used if it is at least as new as the pickle, otherwise the pickle is
+    converted once (which loads it in full a single time) and the new store is used from then on.
+    """
+    store_path = store_path_for(pickle_path)
+    manifest_path = os.path.join(store_path, "manifest.json")
+    if not os.path.exists(manifest_path) or (os.path.exists(pickle_path) and
+                                             os.path.getmtime(pickle_path) > os.path.getmtime(manifest_path)):
+        with open(pickle_path, "rb") as f:
+            spike_indices_by_unit_by_channel = pickle.load(f)
+        write_sorted_spike_store(spike_indices_by_unit_by_channel, store_path)
+        del spike_indices_by_unit_by_channel
+    return SortedSpikeStore(store_path)
@@ -6,12 +6,26 @@ from typing import Optional
 
 from clat.compile.task.compile_task_id import PngSlideIdCollector
 from clat.compile.task.task_field import TaskFieldList, TaskField
-from clat.compile.task.julie_database_fields import FileNameField, MonkeyIdField, MonkeyNameField, MonkeyGroupField
+from julie.compile.compile_profiler import CompileProfiler, trace_path_for
+from julie.compile.concurrent_compilation import open_connection, get_data_from_tasks_concurrently
+from julie.compile.julie_database_fields import FileNameField, MonkeyIdField, MonkeyNameField, MonkeyGroupField, \
+    MonkeyMetadataResolver
 from clat.intan.livenotes import map_task_id_to_epochs_with_livenotes
-from clat.intan.marker_channels import epoch_using_marker_channels
 from clat.intan.rhd import load_intan_rhd_format
-from julie.compile.manual_thresh_compilation import calc_start_and_end_unix_times
-from clat.util.connection import Connection
+from julie.compile.manual_thresh_compilation import calc_start_and_end_unix_times, TASK_CACHE_FILENAME, \
+    METADATA_FIELD_NAMES, metadata_fingerprints
+from julie.compile.intan_stream import epoch_digitalin_file
+from julie.compile.picture_metadata_cache import PictureMetadataCache
+from julie.compile.sorted_spike_store import SortedSpikeStore
+from julie.compile.spike_epoching import assign_sorted_spikes_to_epochs, assign_spike_times_to_epochs
+from julie.compile.task_result_cache import TaskResultCache, cache_task_fields, uncached_task_ids, \
+    database_fingerprint, file_fingerprint
+from julie.catalog import update_catalog
+from julie.compiled_session import write_session, session_path_for
+from julie.data_quality import assess_quality
+
+
+INTAN_BASE_PATH = "/home/r2_allen/Documents/JulieIntanData/Cortana"
 
 
 def main():
@@ -19,15 +33,24 @@ def main():
                  day=date(2023, 10, 11))
 
 
-def compile_data(*, experiment_name: str, day: date):
+def compiled_path(day: date, experiment_name: str) -> str:
+    """
+    Where compile_data saves the pickle of a round (the session directory is next to it).
+    """
+    return os.path.join(INTAN_BASE_PATH, day.strftime("%Y-%m-%d"), experiment_name, "compiled.pk1")
+
+
+def compile_data(*, experiment_name: str, day: date, use_cache: bool = True, max_workers: int = 1,
+                 profile: bool = False):
+    profiler = CompileProfiler(enabled=profile)
     # Extract YYYY-MM-DD from filepath
     date_path = day.strftime("%Y-%m-%d")
     date_no_hyphens = date_path.replace('-', '')
-    conn_xper = Connection(f"{date_no_hyphens}_recording", host="172.30.6.59")
-    conn_photo = Connection("photo_metadata", host="172.30.6.59")
-    intan_base_path = "/home/r2_allen/Documents/JulieIntanData/Cortana"
-    intan_day_path = os.path.join(intan_base_path, date_path)
-    intan_file_path = os.path.join(intan_day_path, experiment_name)
+    conn_xper = profiler.connection(
+        open_connection(f"{date_no_hyphens}_recording", host="172.30.6.59", max_workers=max_workers), "recording")
+    conn_photo = profiler.connection(
+        open_connection("photo_metadata", host="172.30.6.59", max_workers=max_workers), "photo_metadata")
+    intan_file_path = os.path.dirname(compiled_path(day, experiment_name))
     digital_in_path = os.path.join(intan_file_path, "digitalin.dat")
     notes_path = os.path.join(intan_file_path, "notes.txt")
     rhd_file_path = os.path.join(intan_file_path, "info.rhd")
@@ -35,38 +58,73 @@ def compile_data(*, experiment_name: str, day: date):
     # Determine Start and End Unix Times to Collect Data From - DATABASE
     start_unix, end_unix = calc_start_and_end_unix_times(day, time(0, 0, 0), time(23, 59, 59))
 
-    # Collect Epoch Start Stop Times - INTAN
-    sample_rate = load_intan_rhd_format.read_data(rhd_file_path)["frequency_parameters"]['amplifier_sample_rate']
-    stim_epochs_from_markers = epoch_using_marker_channels(digital_in_path,
-                                                           false_negative_correction_duration=10)
-    epochs_for_task_ids = map_task_id_to_epochs_with_livenotes(notes_path,
-                                                               stim_epochs_from_markers)
+    # Collect Epoch Start Stop Times - INTAN (epoched below, only if some task is missing from the cache)
+    with profiler.stage("read rhd header"):
+        sample_rate = load_intan_rhd_format.read_data(rhd_file_path)["frequency_parameters"]['amplifier_sample_rate']
+    epochs_for_task_ids = {}
 
     # # Collect Sorted Spikes - SPIKE SORTER
-    # sorted_spikes = read_pickle(os.path.join(intan_file_path, "sorted_spikes.pkl"))
+    # sorted_spikes = load_sorted_spikes(os.path.join(intan_file_path, "sorted_spikes.pkl"))
 
     # Collect task Ids
     task_id_collector = PngSlideIdCollector(conn_xper)
     time_range = (start_unix, end_unix)
-    task_ids = task_id_collector.collect_complete_task_ids(time_range)
+    with profiler.stage("collect task ids"):
+        task_ids = task_id_collector.collect_complete_task_ids(time_range)
+
+    picture_cache = PictureMetadataCache() if use_cache else None
+    resolver = MonkeyMetadataResolver(conn_xper=conn_xper, conn_photo=conn_photo, picture_cache=picture_cache)
 
     # Task Fields
     fields = TaskFieldList()
     fields.append(TaskField())
-    fields.append(FileNameField(conn_xper=conn_xper))
-    fields.append(MonkeyIdField(conn_xper=conn_xper, conn_photo=conn_photo))
-    fields.append(MonkeyNameField(conn_xper=conn_xper, conn_photo=conn_photo))
-    fields.append(MonkeyGroupField(conn_xper=conn_xper, conn_photo=conn_photo))
+    fields.append(FileNameField(conn_xper=conn_xper, resolver=resolver))
+    fields.append(MonkeyIdField(conn_xper=conn_xper, conn_photo=conn_photo, resolver=resolver))
+    fields.append(MonkeyNameField(conn_xper=conn_xper, conn_photo=conn_photo, resolver=resolver))
+    fields.append(MonkeyGroupField(conn_xper=conn_xper, conn_photo=conn_photo, resolver=resolver))
     fields.append(EpochStartStopTimesField(epochs_for_task_ids, sample_rate))
     # fields.append(SortedSpikeTStampField(sorted_spikes, sample_rate, epochs_for_task_ids))
 
+    metadata_task_ids = task_ids
+    epoch_task_ids = task_ids
+    if use_cache:
+        cache = TaskResultCache(os.path.join(intan_file_path, TASK_CACHE_FILENAME))
+        database = database_fingerprint(conn_xper)
+        intan_files = database + "|" + file_fingerprint([digital_in_path, notes_path, rhd_file_path])
+        fields = cache_task_fields(fields, cache, lambda task_id: database,
+                                   {**metadata_fingerprints(conn_xper, conn_photo, picture_cache),
+                                    "EpochStartStop": lambda task_id: intan_files})
+        metadata_task_ids = uncached_task_ids(fields, task_ids, METADATA_FIELD_NAMES)
+        epoch_task_ids = uncached_task_ids(fields, task_ids, ["EpochStartStop"])
+
+    # Resolve monkey metadata for all tasks in bulk
+    with profiler.stage("resolve metadata"):
+        resolver.resolve(metadata_task_ids)
+
+    if epoch_task_ids:
+        with profiler.stage("epoch digitalin"):
+            stim_epochs_from_markers = epoch_digitalin_file(digital_in_path, false_negative_correction_duration=10)
+        with profiler.stage("map livenotes"):
+            epochs_for_task_ids.update(map_task_id_to_epochs_with_livenotes(notes_path,
+                                                                            stim_epochs_from_markers))
+
     # Get data
-    data = fields.to_data(task_ids)
+    fields = profiler.task_fields(fields)
+    with profiler.stage("evaluate fields"):
+        data = get_data_from_tasks_concurrently(fields, task_ids, max_workers=max_workers)
 
     # Clean rows with empty EpochStartStop
     data = data[data['EpochStartStop'].notna()]
-    save_path = os.path.join(intan_file_path, "compiled.pk1")
-    data.to_pickle(save_path)
+    # One report of short/long epochs instead of a warning per task
+    print(assess_quality(data).summary())
+    save_path = compiled_path(day, experiment_name)
+    with profiler.stage("save pickle"):
+        data.to_pickle(save_path)
+    with profiler.stage("write session"):
+        write_session(data, session_path_for(save_path))
+    with profiler.stage("update catalog"):
+        update_catalog(save_path, session_path_for(save_path))
+    profiler.report(trace_path_for(save_path))
 
     print(data.to_string())
 
@@ -83,36 +141,36 @@ class EpochStartStopTimesField(TaskField):
             epoch_stop_index = self.epoch_start_stop_by_task_id[task_id][1]
             epoch_start_time = epoch_start_index / self.sample_rate
             epoch_stop_time = epoch_stop_index / self.sample_rate
-            if epoch_stop_time - epoch_start_time < 1:
-                print("Warning, epoch start and stop times are less than 1 second apart.")
             return epoch_start_time, epoch_stop_time
         except KeyError:
             return None
 
 
 class SortedSpikeTStampField(EpochStartStopTimesField):
-    def __init__(self, spike_indices_by_unit_by_channel: dict, sample_rate: int, epoch_times_for_task_ids: dict,
+    def __init__(self, spike_indices_by_unit_by_channel: dict | SortedSpikeStore, sample_rate: int,
+                 epoch_times_for_task_ids: dict,
                  name='SpikeTimes'):
         super().__init__(epoch_times_for_task_ids, sample_rate, name=name)
         self.spike_indices_by_unit_by_channel = spike_indices_by_unit_by_channel
         self.sample_rate = sample_rate
+        self._spike_tstamps_by_unit_by_task_id = None
 
     def get(self, task_id: int):
-        spikes_tstamps_by_unit = {}
-        epoch_start_stop_times = super().get(task_id)
-        if epoch_start_stop_times is None:
+        if task_id not in self.epoch_start_stop_by_task_id:
             return None
-
-        for channel, spike_indices_by_unit in self.spike_indices_by_unit_by_channel.items():
-            for unit_name, spike_indices in spike_indices_by_unit.items():
-                new_unit_name = f"{channel}_{unit_name}"
-                for spike_index in spike_indices:
-                    if spike_index >= epoch_start_stop_times[0] or spike_index < epoch_start_stop_times[1]:
-                        spike_tstamp = spike_index / self.sample_rate
-                        if new_unit_name not in spikes_tstamps_by_unit:
-                            spikes_tstamps_by_unit[new_unit_name] = []
-                        spikes_tstamps_by_unit[new_unit_name].append(spike_tstamp)
-        return spikes_tstamps_by_unit
+        if self._spike_tstamps_by_unit_by_task_id is None:
+            # Assign spikes for every task in one sweep the first time any task is requested
+            epoch_start_stop_times_by_task_id = {
+                epoch_task_id: (epoch[0] / self.sample_rate, epoch[1] / self.sample_rate)
+                for epoch_task_id, epoch in self.epoch_start_stop_by_task_id.items()}
+            if isinstance(self.spike_indices_by_unit_by_channel, SortedSpikeStore):
+                self._spike_tstamps_by_unit_by_task_id = assign_spike_times_to_epochs(
+                    self.spike_indices_by_unit_by_channel.spike_times_by_unit(self.sample_rate),
+                    epoch_start_stop_times_by_task_id)
+            else:
+                self._spike_tstamps_by_unit_by_task_id = assign_sorted_spikes_to_epochs(
+                    self.spike_indices_by_unit_by_channel, self.sample_rate, epoch_start_stop_times_by_task_id)
+        return self._spike_tstamps_by_unit_by_task_id[task_id]
 
 
 def read_pickle(path: str):
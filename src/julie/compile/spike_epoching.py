@@ -0,0 +1,89 @@
+import numpy as np
+
+
+class EpochSweep:
+    """
+    Assigns sorted spike time arrays to every epoch at once.
+
+    Epochs are sorted a single time on construction. Each spike array is then split into all trials with
+    two searchsorted calls, and the per-trial results are views into that array rather than copies.
+    Spikes are assigned to an epoch if epoch_start <= spike_time < epoch_stop.
+    """
+
+    def __init__(self, epoch_start_stop_by_task_id: dict[int, tuple[float, float]]):
+        """
+        Parameters:
+            epoch_start_stop_by_task_id (dict): task_id -> (epoch_start, epoch_stop) in seconds.
+        """
+        items = sorted(epoch_start_stop_by_task_id.items(), key=lambda item: item[1][0])
+        self.task_ids = [task_id for task_id, _ in items]
+        self.starts = np.array([epoch[0] for _, epoch in items], dtype=np.float64)
+        self.stops = np.array([epoch[1] for _, epoch in items], dtype=np.float64)
+        self.position_by_task_id = {task_id: position for position, task_id in enumerate(self.task_ids)}
+
+    def bounds(self, spike_times: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Returns the (lower, upper) slice bounds of every epoch in sorted spike_times.
+        """
+        lower = np.searchsorted(spike_times, self.starts, side='left')
+        upper = np.searchsorted(spike_times, self.stops, side='left')
+        return lower, np.maximum(lower, upper)
+
+    def split(self, spike_times: np.ndarray) -> dict[int, np.ndarray]:
+        """
+        Split sorted spike_times into per-task_id views.
+        """
+        lower, upper = self.bounds(spike_times)
+        return {task_id: spike_times[lo:hi] for task_id, lo, hi in zip(self.task_ids, lower, upper)}
+
+
+def spike_indices_to_times(spike_indices, sample_rate: float) -> np.ndarray:
+    """
+    Convert a unit's spike sample indices to sorted spike times in seconds, once per unit.
+    """
+    spike_times = np.asarray(spike_indices, dtype=np.float64) / sample_rate
+    if spike_times.size > 1 and np.any(spike_times[1:] < spike_times[:-1]):
+        spike_times.sort()
+    return spike_times
+
+
+def assign_sorted_spikes_to_epochs(spike_indices_by_unit_by_channel: dict, sample_rate: float,
+                                   epoch_start_stop_by_task_id: dict[int, tuple[float, float]],
+                                   reverse_channels: bool = False) -> dict[int, dict[str, np.ndarray]]:
+    """
+    Assign every sorted unit's spikes to every trial in one sweep.
+
+    Parameters:
+        spike_indices_by_unit_by_channel (dict): channel -> unit name -> spike sample indices.
+        sample_rate (float): The sample rate of the spike indices.
+        epoch_start_stop_by_task_id (dict): task_id -> (epoch_start, epoch_stop) in seconds.
+        reverse_channels (bool): Iterate channels in reverse order (controls the unit order of the output).
+
+    Returns:
+        dict: task_id -> {"{channel}_{unit_name}": view of that unit's spike times within the epoch}
+    """
+    channel_items = spike_indices_by_unit_by_channel.items()
+    if reverse_channels:
+        channel_items = reversed(channel_items)
+    spike_times_by_unit = {}
+    for channel, spike_indices_by_unit in channel_items:
+        for unit_name, spike_indices in spike_indices_by_unit.items():
+            spike_times_by_unit[f"{channel}_{unit_name}"] = spike_indices_to_times(spike_indices, sample_rate)
+    return assign_spike_times_to_epochs(spike_times_by_unit, epoch_start_stop_by_task_id)
+
+
+def assign_spike_times_to_epochs(spike_times_by_unit: dict[str, np.ndarray],
+                                 epoch_start_stop_by_task_id: dict[int, tuple[float, float]]
+                                 ) -> dict[int, dict[str, np.ndarray]]:
+    """
+    Split sorted per-unit spike times (in seconds) into every epoch in one sweep.
+
+    Returns:
+        dict: task_id -> {unit name: view of that unit's spike times within the epoch}
+    """
+    sweep = EpochSweep(epoch_start_stop_by_task_id)
+    spike_tstamps_by_unit_by_task_id = {task_id: {} for task_id in sweep.task_ids}
+    for unit_name, spike_times in spike_times_by_unit.items():
+        for task_id, spike_times_in_epoch in sweep.split(spike_times).items():
+            spike_tstamps_by_unit_by_task_id[task_id][unit_name] = spike_times_in_epoch
+    return spike_tstamps_by_unit_by_task_id
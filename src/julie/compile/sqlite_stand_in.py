@@ -0,0 +1,123 @@
+"""
+SQLite stand-ins for the {date}_recording and photo_metadata MySQL databases.
+
+SqliteConnection answers the queries the compilation code sends to a clat Connection (BehMsg, TaskToDo, StimSpec,
+photo_metadata.combined_view and photo_metadata.photos), so compile_data and the live compiler can run against
+local files:
+
+    conn_xper, conn_photo = open_stand_in_connections("/tmp/stand_in")
+    insert_picture(conn_photo, monkey_id=12, monkey_name="Bart", jpg_id=3, monkey_group="Zombies")
+    insert_trial(conn_xper, task_id=1, stim_id=1, picture_path="/pictures/12.png",
+                 slide_off_tstamp=..., trial_complete_tstamp=...)
+"""
+
+import os
+import sqlite3
+import threading
+
+RECORDING_DATABASE_FILENAME = "recording.sqlite"
+PHOTO_DATABASE_FILENAME = "photo_metadata.sqlite"
+
+RECORDING_SCHEMA = """
+CREATE TABLE IF NOT EXISTS BehMsg (tstamp INTEGER PRIMARY KEY, type TEXT, msg TEXT);
+CREATE TABLE IF NOT EXISTS TaskToDo (task_id INTEGER PRIMARY KEY, stim_id INTEGER, xfm_id INTEGER,
+                                     gen_id INTEGER, done INTEGER);
+CREATE TABLE IF NOT EXISTS StimSpec (id INTEGER PRIMARY KEY, spec TEXT, util TEXT);
+"""
+
+PHOTO_SCHEMA = """
+CREATE TABLE IF NOT EXISTS combined_view (monkey_id INTEGER, monkey_name TEXT, jpg_id INTEGER);
+CREATE TABLE IF NOT EXISTS photos (jpg_id INTEGER PRIMARY KEY, monkey_group TEXT);
+"""
+
+
+class SqliteConnection:
+    """
+    Drop-in stand-in for a clat Connection backed by a SQLite file.
+
+    MySQL-style %s placeholders are rewritten to ?, and other databases can be attached under the schema names
+    the queries use (e.g. photo_metadata), so the same SQL runs unchanged.
+    """
+
+    def __init__(self, path: str, attached: dict[str, str] = None):
+        self.database = str(path)
+        self.host = "sqlite"
+        self.lock = threading.Lock()
+        self.mydb = sqlite3.connect(self.database, check_same_thread=False, isolation_level=None)
+        for schema_name, attached_path in (attached or {}).items():
+            self.mydb.execute("ATTACH DATABASE ? AS " + schema_name, (str(attached_path),))
+        self.my_cursor = None
+
+    def execute(self, statement, params=()):
+        with self.lock:
+            self.my_cursor = self.mydb.execute(statement.replace("%s", "?"), tuple(params))
+
+    def executescript(self, script: str):
+        with self.lock:
+            self.mydb.executescript(script)
+
+    def fetch_one(self):
+        with self.lock:
+            result = self.my_cursor.fetchone()
+            if result:
+                return result[0]
+            return None
+
+    def fetch_all(self):
+        with self.lock:
+            return self.my_cursor.fetchall()
+
+    def truncate(self, table_name):
+        self.execute(f"DELETE FROM {table_name}")
+
+    def close(self):
+        self.mydb.close()
+
+
+def open_stand_in_connections(directory: str) -> tuple[SqliteConnection, SqliteConnection]:
+    """
+    Open (creating if needed) the recording and photo_metadata stand-ins in directory.
+
+    Returns:
+        tuple: (conn_xper, conn_photo). conn_photo has its own file attached as photo_metadata, as the photo
+        queries name their tables photo_metadata.combined_view and photo_metadata.photos.
+    """
+    os.makedirs(directory, exist_ok=True)
+    recording_path = os.path.join(directory, RECORDING_DATABASE_FILENAME)
+    photo_path = os.path.join(directory, PHOTO_DATABASE_FILENAME)
+
+    conn_xper = SqliteConnection(recording_path)
+    conn_xper.executescript(RECORDING_SCHEMA)
+    conn_photo = SqliteConnection(photo_path, attached={"photo_metadata": photo_path})
+    conn_photo.executescript(PHOTO_SCHEMA)
+    return conn_xper, conn_photo
+
+
+def insert_picture(conn_photo: SqliteConnection, *, monkey_id: int, monkey_name: str, jpg_id: int,
+                   monkey_group: str):
+    conn_photo.execute("INSERT INTO combined_view (monkey_id, monkey_name, jpg_id) VALUES (%s, %s, %s)",
+                       (monkey_id, monkey_name, jpg_id))
+    conn_photo.execute("INSERT OR REPLACE INTO photos (jpg_id, monkey_group) VALUES (%s, %s)",
+                       (jpg_id, monkey_group))
+
+
+def insert_trial(conn_xper: SqliteConnection, *, task_id: int, stim_id: int, picture_path: str,
+                 slide_off_tstamp: int, trial_complete_tstamp: int = None):
+    """
+    Add a PNG slide task, its StimSpec and its SlideOff message, plus TrialComplete if trial_complete_tstamp
+    is given (a trial without it is still running or was aborted).
+    """
+    conn_xper.execute("INSERT OR REPLACE INTO StimSpec (id, spec, util) VALUES (%s, %s, %s)",
+                      (stim_id, f"<StimSpec><filePath>{picture_path}</filePath></StimSpec>", ""))
+    conn_xper.execute("INSERT OR REPLACE INTO TaskToDo (task_id, stim_id, xfm_id, gen_id, done) "
+                      "VALUES (%s, %s, %s, %s, %s)", (task_id, stim_id, 0, 0, 1))
+    conn_xper.execute("INSERT INTO BehMsg (tstamp, type, msg) VALUES (%s, %s, %s)",
+                      (slide_off_tstamp, "SlideOff",
+                       f"<PngSlideEvent><taskId>{task_id}</taskId></PngSlideEvent>"))
+    if trial_complete_tstamp is not None:
+        insert_trial_complete(conn_xper, trial_complete_tstamp)
+
+
+def insert_trial_complete(conn_xper: SqliteConnection, tstamp: int):
+    conn_xper.execute("INSERT INTO BehMsg (tstamp, type, msg) VALUES (%s, %s, %s)",
+                      (tstamp, "TrialComplete", "<TrialMessage/>"))
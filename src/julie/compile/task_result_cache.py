@@ -0,0 +1,156 @@
+import os
+import pickle
+import sqlite3
+import threading
+from typing import Callable
+
+from clat.compile.task.task_field import TaskField, TaskFieldList
+from clat.util.connection import Connection
+
+
+class TaskResultCache:
+    """
+    Persistent cache of TaskField results in a local SQLite file.
+
+    Values are keyed on (task_id, field name) and stored with the fingerprint of the sources they were
+    computed from. A cached value is only used while its fingerprint still matches, so editing a source file
+    or pointing at another database recomputes just the affected tasks.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        # Every put commits; WAL keeps those commits cheap
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS TaskFieldResult (
+              task_id INTEGER NOT NULL,
+              name TEXT NOT NULL,
+              fingerprint TEXT NOT NULL,
+              value BLOB,
+              PRIMARY KEY (task_id, name)
+            )""")
+        self.db.commit()
+
+    def get(self, task_id: int, name: str, fingerprint: str) -> tuple[bool, object]:
+        """
+        Returns (True, value) if a value with a matching fingerprint is cached, otherwise (False, None).
+        """
+        with self.lock:
+            row = self.db.execute("SELECT fingerprint, value FROM TaskFieldResult WHERE task_id = ? AND name = ?",
+                                  (int(task_id), name)).fetchone()
+        if row is None or row[0] != fingerprint:
+            return False, None
+        return True, pickle.loads(row[1])
+
+    def contains(self, task_id: int, name: str, fingerprint: str) -> bool:
+        with self.lock:
+            row = self.db.execute("SELECT 1 FROM TaskFieldResult WHERE task_id = ? AND name = ? AND fingerprint = ?",
+                                  (int(task_id), name, fingerprint)).fetchone()
+        return row is not None
+
+    def put(self, task_id: int, name: str, fingerprint: str, value):
+        blob = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO TaskFieldResult (task_id, name, fingerprint, value) "
+                            "VALUES (?, ?, ?, ?)", (int(task_id), name, fingerprint, blob))
+            self.db.commit()
+
+    def invalidate(self, name: str = None):
+        """
+        Drop cached values of one field (by cache name) or of every field.
+        """
+        with self.lock:
+            if name is None:
+                self.db.execute("DELETE FROM TaskFieldResult")
+            else:
+                self.db.execute("DELETE FROM TaskFieldResult WHERE name = ?", (name,))
+            self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+
+class CachedTaskField(TaskField):
+    """
+    Wraps a TaskField so its results are served from a TaskResultCache while their fingerprint matches.
+    """
+
+    def __init__(self, field: TaskField, cache: TaskResultCache, fingerprint: Callable[[int], str]):
+        super().__init__(field.name)
+        self.field = field
+        self.cache = cache
+        self.fingerprint = fingerprint
+        # The field class is part of the key so two fields sharing a column name don't share results, and a
+        # field's cache_version (if any) so results of an older version of it are not served
+        self.cache_name = f"{type(field).__name__}:{field.name}"
+        cache_version = getattr(field, "cache_version", None)
+        if cache_version is not None:
+            self.cache_name += f":v{cache_version}"
+
+    def get(self, task_id: int):
+        fingerprint = self.fingerprint(task_id)
+        hit, value = self.cache.get(task_id, self.cache_name, fingerprint)
+        if hit:
+            return value
+        value = self.field.get(task_id)
+        self.cache.put(task_id, self.cache_name, fingerprint, value)
+        return value
+
+    def is_cached(self, task_id: int) -> bool:
+        return self.cache.contains(task_id, self.cache_name, self.fingerprint(task_id))
+
+
+def cache_task_fields(fields: TaskFieldList, cache: TaskResultCache, default_fingerprint: Callable[[int], str],
+                      fingerprints_by_name: dict[str, Callable[[int], str]] = None) -> TaskFieldList:
+    """
+    Wrap every field (except the plain task_id TaskField) in a CachedTaskField.
+
+    Parameters:
+        fields (TaskFieldList): Fields to wrap, in column order.
+        cache (TaskResultCache): Where results are stored.
+        default_fingerprint: task_id -> fingerprint for fields without an entry in fingerprints_by_name.
+        fingerprints_by_name (dict): field name -> task_id -> fingerprint, for fields read from files.
+    """
+    fingerprints_by_name = fingerprints_by_name or {}
+    cached_fields = TaskFieldList()
+    for field in fields:
+        if type(field) is TaskField:
+            cached_fields.append(field)
+        else:
+            fingerprint = fingerprints_by_name.get(field.name, default_fingerprint)
+            cached_fields.append(CachedTaskField(field, cache, fingerprint))
+    return cached_fields
+
+
+def uncached_task_ids(fields: TaskFieldList, task_ids: list[int], names: list[str] = None) -> list[int]:
+    """
+    The task_ids for which at least one cached field (restricted to names, if given) has to be computed.
+    """
+    cached_fields = [field for field in fields if isinstance(field, CachedTaskField)
+                     and (names is None or field.name in names)]
+    return [task_id for task_id in task_ids
+            if not all(field.is_cached(task_id) for field in cached_fields)]
+
+
+def database_fingerprint(conn: Connection) -> str:
+    return f"{conn.host}/{conn.database}"
+
+
+def file_fingerprint(paths: list[str]) -> str:
+    """
+    Fingerprint of a set of source files from their paths, sizes and modification times.
+    """
+    parts = []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+            parts.append(f"{path}:{stat.st_size}:{stat.st_mtime_ns}")
+        except FileNotFoundError:
+            parts.append(f"{path}:missing")
+    return "|".join(parts)
@@ -0,0 +1,306 @@
+"""
+Columnar on-disk format for compiled sessions.
+
+A session is a directory (<experiment_name>.session) containing:
+    manifest.json       number of trials, spike keys and their files
+    metadata.pkl        DataFrame of the task fields (everything except SpikeTimes and EpochStartStop)
+    epochs.npy          (n_trials x 2) float64 EpochStartStop, NaN where missing
+    has_spikes.npy      bool per trial, False where SpikeTimes was not a dict
+    spikes/<i>.f8       flat float64 spike times of spike key i, trial after trial
+    spikes/<i>.offsets.npy  int64 offsets (n_trials + 1) into spikes/<i>.f8
+
+Spike files are plain float64 so one channel can be memory-mapped without reading the rest of the session.
+"""
+
+import glob
+import json
+import os
+import pickle
+import shutil
+from enum import Enum
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from clat.intan.channels import Channel
+
+SESSION_SUFFIX = ".session"
+FORMAT_VERSION = 1
+
+
+def session_path_for(path: str) -> str:
+    """
+    The session directory that sits next to a compiled .pk1 file.
+    """
+    return os.path.splitext(str(path))[0] + SESSION_SUFFIX
+
+
+def is_session(path) -> bool:
+    return os.path.isdir(path) and os.path.isfile(os.path.join(path, "manifest.json"))
+
+
+class SessionWriter:
+    """
+    Writes a session incrementally. Call append() with DataFrames (rows are appended in order), then close().
+    Spike times are streamed to disk on every append, so only the metadata is kept in memory.
+    """
+
+    def __init__(self, path: str):
+        self.path = str(path)
+        self.tmp_path = self.path + ".tmp"
+        if os.path.exists(self.tmp_path):
+            shutil.rmtree(self.tmp_path)
+        os.makedirs(os.path.join(self.tmp_path, "spikes"))
+        self.n_trials = 0
+        self.spike_keys = []
+        self.counts_by_key_index = []
+        self.metadata_frames = []
+        self.epoch_arrays = []
+        self.has_spikes_arrays = []
+
+    def append(self, data: pd.DataFrame):
+        data = data.reset_index(drop=True)
+        n_rows = len(data)
+
+        metadata = data.drop(columns=[column for column in ("SpikeTimes", "EpochStartStop") if column in data])
+        self.metadata_frames.append(metadata)
+
+        epochs = np.full((n_rows, 2), np.nan, dtype=np.float64)
+        if "EpochStartStop" in data:
+            for row, epoch in enumerate(data["EpochStartStop"]):
+                if isinstance(epoch, (tuple, list, np.ndarray)) and len(epoch) == 2:
+                    epochs[row] = epoch
+        self.epoch_arrays.append(epochs)
+
+        has_spikes = np.zeros(n_rows, dtype=bool)
+        if "SpikeTimes" in data:
+            spike_times_column = data["SpikeTimes"].tolist()
+            has_spikes[:] = [isinstance(spike_times, dict) for spike_times in spike_times_column]
+            self._append_spikes(spike_times_column, has_spikes)
+        self.has_spikes_arrays.append(has_spikes)
+
+        self.n_trials += n_rows
+        for counts in self.counts_by_key_index:
+            counts.extend([0] * (self.n_trials - len(counts)))
+
+    def _append_spikes(self, spike_times_column: list, has_spikes: np.ndarray):
+        keys_in_chunk = {}
+        for row, spike_times_by_key in enumerate(spike_times_column):
+            if not has_spikes[row]:
+                continue
+            for key in spike_times_by_key:
+                keys_in_chunk.setdefault(key, None)
+
+        for key in keys_in_chunk:
+            key_index = self._key_index(key)
+            counts = self.counts_by_key_index[key_index]
+            counts.extend([0] * (self.n_trials - len(counts)))
+            arrays = []
+            for row, spike_times_by_key in enumerate(spike_times_column):
+                spike_times = spike_times_by_key.get(key) if has_spikes[row] else None
+                if spike_times is None or isinstance(spike_times, str):
+                    counts.append(0)
+                    continue
+                spike_times = np.asarray(spike_times, dtype=np.float64).ravel()
+                counts.append(spike_times.size)
+                arrays.append(spike_times)
+            if arrays:
+                with open(self._spike_file(self.tmp_path, key_index), "ab") as f:
+                    np.concatenate(arrays).astype("<f8", copy=False).tofile(f)
+
+    def _key_index(self, key) -> int:
+        encoded_key = encode_spike_key(key)
+        if encoded_key in self.spike_keys:
+            return self.spike_keys.index(encoded_key)
+        self.spike_keys.append(encoded_key)
+        self.counts_by_key_index.append([])
+        open(self._spike_file(self.tmp_path, len(self.spike_keys) - 1), "wb").close()
+        return len(self.spike_keys) - 1
+
+    @staticmethod
+    def _spike_file(session_path: str, key_index: int) -> str:
+        return os.path.join(session_path, "spikes", f"{key_index:03d}.f8")
+
+    def close(self):
+        for key_index, counts in enumerate(self.counts_by_key_index):
+            offsets = np.zeros(self.n_trials + 1, dtype=np.int64)
+            np.cumsum(np.asarray(counts, dtype=np.int64), out=offsets[1:])
+            np.save(os.path.join(self.tmp_path, "spikes", f"{key_index:03d}.offsets.npy"), offsets)
+
+        if self.metadata_frames:
+            metadata = pd.concat(self.metadata_frames, axis=0, ignore_index=True)
+        else:
+            metadata = pd.DataFrame()
+        metadata.to_pickle(os.path.join(self.tmp_path, "metadata.pkl"))
+        np.save(os.path.join(self.tmp_path, "epochs.npy"), _concatenate(self.epoch_arrays, (0, 2), np.float64))
+        np.save(os.path.join(self.tmp_path, "has_spikes.npy"), _concatenate(self.has_spikes_arrays, (0,), bool))
+
+        manifest = {
+            "version": FORMAT_VERSION,
+            "n_trials": self.n_trials,
+            "spike_keys": self.spike_keys,
+        }
+        with open(os.path.join(self.tmp_path, "manifest.json"), "w") as f:
+            json.dump(manifest, f, indent=1)
+
+        # Replace any previous session only once the new one is complete
+        if os.path.exists(self.path):
+            shutil.rmtree(self.path)
+        os.rename(self.tmp_path, self.path)
+
+
+def _concatenate(arrays: list, empty_shape: tuple, dtype) -> np.ndarray:
+    if not arrays:
+        return np.empty(empty_shape, dtype=dtype)
+    return np.concatenate(arrays)
+
+
+def write_session(data: pd.DataFrame, path: str):
+    writer = SessionWriter(path)
+    writer.append(data)
+    writer.close()
+
+
+def encode_spike_key(key) -> dict:
+    # Older pickles hold Channel enums from a different module path, so match any Enum by value
+    if isinstance(key, Enum):
+        return {"kind": "channel", "value": key.value}
+    return {"kind": "str", "value": str(key)}
+
+
+def decode_spike_key(encoded_key: dict):
+    if encoded_key["kind"] == "channel":
+        return Channel(encoded_key["value"])
+    return encoded_key["value"]
+
+
+class CompiledSession:
+    """
+    Read access to a session directory. Spike arrays are memory-mapped and only opened for the keys requested.
+    """
+
+    def __init__(self, path, mmap: bool = True):
+        self.path = str(path)
+        self.mmap = mmap
+        with open(os.path.join(self.path, "manifest.json")) as f:
+            self.manifest = json.load(f)
+        self.n_trials = self.manifest["n_trials"]
+        self.keys = [decode_spike_key(encoded_key) for encoded_key in self.manifest["spike_keys"]]
+        self._key_index_by_value = {spike_key_value(key): key_index for key_index, key in enumerate(self.keys)}
+        self._metadata = None
+        self.epochs = np.load(os.path.join(self.path, "epochs.npy"))
+        self.has_spikes = np.load(os.path.join(self.path, "has_spikes.npy"))
+
+    @property
+    def metadata(self) -> pd.DataFrame:
+        if self._metadata is None:
+            self._metadata = pd.read_pickle(os.path.join(self.path, "metadata.pkl"))
+        return self._metadata
+
+    def key_for(self, key):
+        """
+        Find the stored spike key matching key (a Channel, a channel value such as "A-000" or a unit name).
+        """
+        return self.keys[self._key_index(key)]
+
+    def _key_index(self, key) -> int:
+        try:
+            return self._key_index_by_value[spike_key_value(key)]
+        except KeyError:
+            raise KeyError(f"{key} is not in session {self.path}") from None
+
+    def spike_arrays(self, key) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Returns (spike_times, offsets) for one spike key. Trial i is spike_times[offsets[i]:offsets[i + 1]].
+        """
+        key_index = self._key_index(key)
+        spike_path = os.path.join(self.path, "spikes", f"{key_index:03d}.f8")
+        offsets = np.load(os.path.join(self.path, "spikes", f"{key_index:03d}.offsets.npy"))
+        if offsets[-1] == 0:
+            spike_times = np.empty(0, dtype=np.float64)
+        elif self.mmap:
+            spike_times = np.memmap(spike_path, dtype="<f8", mode="r", shape=(int(offsets[-1]),))
+        else:
+            spike_times = np.fromfile(spike_path, dtype="<f8")
+        return spike_times, offsets
+
+    def spike_trains(self, key) -> list:
+        """
+        Per-trial views of one spike key's spike times (None for trials without SpikeTimes).
+        """
+        spike_times, offsets = self.spike_arrays(key)
+        return [spike_times[offsets[row]:offsets[row + 1]] if self.has_spikes[row] else None
+                for row in range(self.n_trials)]
+
+    def epoch_start_stop(self) -> list:
+        return [None if np.isnan(start) else (float(start), float(stop)) for start, stop in self.epochs]
+
+    def to_dataframe(self, keys: list = None) -> pd.DataFrame:
+        """
+        DataFrame in the same layout as the compiled pickles, restricted to the given spike keys (default all).
+        """
+        keys = self.keys if keys is None else [self.key_for(key) for key in keys]
+        data = self.metadata.copy()
+
+        spike_trains_by_key = {key: self.spike_trains(key) for key in keys}
+        if self.keys:
+            data["SpikeTimes"] = [
+                {key: spike_trains[row] for key, spike_trains in spike_trains_by_key.items()}
+                if self.has_spikes[row] else None
+                for row in range(self.n_trials)]
+        data["EpochStartStop"] = self.epoch_start_stop()
+        return data
+
+
+def spike_key_value(key) -> str:
+    """
+    The comparable value of a spike key: the channel value for Channel enums, the name for sorted units.
+    """
+    if isinstance(key, Enum):
+        return key.value
+    return str(key)
+
+
+def read_compiled(path, channels: list = None) -> pd.DataFrame:
+    """
+    Load a compiled session as a DataFrame, from either a session directory or a pickle.
+    For session directories, only the spike keys in channels (default all) are read.
+    """
+    if is_session(path):
+        return CompiledSession(path).to_dataframe(channels)
+    return pd.read_pickle(path).reset_index(drop=True)
+
+
+def convert_pickle_to_session(pickle_path: str, session_path: str = None) -> str:
+    if session_path is None:
+        session_path = session_path_for(pickle_path)
+    data = pd.read_pickle(pickle_path)
+    write_session(data, session_path)
+    return session_path
+
+
+def convert_directory(compiled_dir: str, overwrite: bool = False) -> list[str]:
+    """
+    Convert every .pk1 file in compiled_dir to a session directory next to it.
+    """
+    session_paths = []
+    for pickle_path in sorted(glob.glob(os.path.join(compiled_dir, "*.pk1"))):
+        session_path = session_path_for(pickle_path)
+        if os.path.exists(session_path) and not overwrite:
+            continue
+        try:
+            session_paths.append(convert_pickle_to_session(pickle_path, session_path))
+            print("Converted", pickle_path)
+        except (pickle.UnpicklingError, ValueError, TypeError) as e:
+            print(f"Could not convert {pickle_path}: {e}")
+    return session_paths
+
+
+def main():
+    script_dir = Path(__file__).parent
+    compiled_dir = (script_dir / '..' / '..' / 'compiled' / 'julie').resolve()
+    convert_directory(str(compiled_dir))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,244 @@
+"""
+Data-quality stage for compiled sessions: flags (and optionally drops) noisy trials and channels right after
+loading, with one aggregated report.
+
+    data, report = reject_noisy_data(ChannelAccessor.open(file_path), drop=True)
+
+Trials are flagged for a missing epoch, an epoch shorter than min_epoch_duration or much longer than the median,
+no SpikeTimes or no spikes on any channel, and runaway spike counts (a rate far above the channel's usual rate on
+a large fraction of the channels at once, as with a movement or line-noise artifact). Channels are flagged when
+they are empty in almost every trial or run away in many trials.
+
+Everything is computed from one (n_trials x n_channels) spike count matrix. Compiled SpikeTimes only hold the
+spikes inside each epoch, so the counts are the lengths of the spike lists (the offsets of a session directory)
+and no spike times are read.
+"""
+
+from dataclasses import dataclass, field
+
+import numpy as np
+import pandas as pd
+
+from julie.channel_access import ChannelAccessor
+from julie.compiled_session import spike_key_value
+from julie.spike_binning import epochs_to_array
+
+# Scales a median absolute deviation to the standard deviation of a normal distribution
+MAD_TO_SD = 1.4826
+
+
+@dataclass
+class QualityThresholds:
+    """
+    min_epoch_duration (float): Seconds; shorter epochs are flagged.
+    max_epoch_duration_factor (float): Epochs longer than this times the median epoch duration are flagged.
+    runaway_mad (float): A trial's rate on a channel runs away above the channel's median rate plus this many
+        (MAD-estimated) standard deviations...
+    min_runaway_rate (float): ...and above this rate in Hz.
+    runaway_channel_fraction (float): Trials running away on at least this fraction of the channels are flagged.
+    max_runaway_trial_fraction (float): Channels running away in more than this fraction of trials are flagged.
+    min_active_trial_fraction (float): Channels with spikes in fewer than this fraction of trials are empty.
+    """
+    min_epoch_duration: float = 1.0
+    max_epoch_duration_factor: float = 3.0
+    runaway_mad: float = 10.0
+    min_runaway_rate: float = 200.0
+    runaway_channel_fraction: float = 0.25
+    max_runaway_trial_fraction: float = 0.05
+    min_active_trial_fraction: float = 0.01
+
+
+TRIAL_FLAGS = ("missing_epoch", "short_epoch", "long_epoch", "no_spikes", "runaway")
+CHANNEL_FLAGS = ("empty", "runaway")
+
+
+@dataclass
+class QualityReport:
+    """
+    keys: Channel names along axis 1 of counts.
+    durations: Epoch duration of every trial (NaN where missing).
+    counts: (n_trials x n_channels) spikes in each epoch.
+    runaway: (n_trials x n_channels) runaway (trial, channel) pairs.
+    trial_flags, channel_flags: Boolean array per name in TRIAL_FLAGS and CHANNEL_FLAGS.
+    """
+    keys: list
+    durations: np.ndarray
+    counts: np.ndarray
+    runaway: np.ndarray
+    trial_flags: dict
+    channel_flags: dict
+    thresholds: QualityThresholds = field(default_factory=QualityThresholds)
+
+    @property
+    def bad_trials(self) -> np.ndarray:
+        return np.logical_or.reduce([flags for flags in self.trial_flags.values()])
+
+    @property
+    def bad_channels(self) -> np.ndarray:
+        if not self.keys:
+            return np.zeros(0, dtype=bool)
+        return np.logical_or.reduce([flags for flags in self.channel_flags.values()])
+
+    @property
+    def bad_keys(self) -> list:
+        return [key for key, bad in zip(self.keys, self.bad_channels) if bad]
+
+    def to_frame(self) -> pd.DataFrame:
+        """
+        One row per trial: its duration, total spike count and flags.
+        """
+        frame = pd.DataFrame({"Duration": self.durations, "SpikeCount": self.counts.sum(axis=1)})
+        for name, flags in self.trial_flags.items():
+            frame[name] = flags
+        return frame
+
+    def summary(self) -> str:
+        n_trials = len(self.durations)
+        lines = [f"Data quality: {int(self.bad_trials.sum())} of {n_trials} trials and "
+                 f"{int(self.bad_channels.sum())} of {len(self.keys)} channels flagged"]
+        valid = ~np.isnan(self.durations)
+        if valid.any():
+            durations = self.durations[valid]
+            lines.append(f"  epoch duration: median {np.median(durations):.3f} s, "
+                         f"range {durations.min():.3f} - {durations.max():.3f} s")
+        for name, flags in self.trial_flags.items():
+            if flags.any():
+                rows = np.flatnonzero(flags)
+                shown = ", ".join(str(row) for row in rows[:10]) + (", ..." if len(rows) > 10 else "")
+                lines.append(f"  {name}: {len(rows)} trials (rows {shown})")
+        for name, flags in self.channel_flags.items():
+            if flags.any():
+                lines.append(f"  {name} channels: {', '.join(key for key, bad in zip(self.keys, flags) if bad)}")
+        return "\n".join(lines)
+
+
+def spike_count_matrix(data, channels: list = None) -> tuple[list, np.ndarray, np.ndarray]:
+    """
+    Spike counts of every trial and channel.
+
+    Parameters:
+        data: Compiled DataFrame, CompiledSession or ChannelAccessor.
+        channels (list): Channels or units along axis 1, every one in the session if None.
+
+    Returns:
+        tuple: (keys, counts, has_spikes). counts is (n_trials x n_channels) int64, has_spikes is False for
+        trials without SpikeTimes.
+    """
+    accessor = ChannelAccessor.of(data)
+    channels = accessor.channels if channels is None else channels
+    n_trials = len(accessor.metadata)
+    counts = np.zeros((n_trials, len(channels)), dtype=np.int64)
+    if accessor.session is not None:
+        has_spikes = np.asarray(accessor.session.has_spikes, dtype=bool)
+        for channel_index, channel in enumerate(channels):
+            if spike_key_value(channel) in accessor.key_by_value:
+                _, offsets = accessor.session.spike_arrays(channel)
+                counts[:, channel_index] = np.diff(offsets)
+    else:
+        spike_times_column = accessor.data['SpikeTimes'] if 'SpikeTimes' in accessor.data else [None] * n_trials
+        has_spikes = np.array([isinstance(spike_times_by_key, dict) for spike_times_by_key in spike_times_column],
+                              dtype=bool)
+        for channel_index, channel in enumerate(channels):
+            counts[:, channel_index] = [0 if spikes is None or isinstance(spikes, str) else len(spikes)
+                                        for spikes in accessor.spike_trains(channel)]
+    counts[~has_spikes] = 0
+    return [spike_key_value(channel) for channel in channels], counts, has_spikes
+
+
+def assess_quality(data, channels: list = None, thresholds: QualityThresholds = None) -> QualityReport:
+    """
+    Flag noisy trials and channels of a session (see the module docstring). Nothing is dropped.
+
+    Parameters:
+        data: Compiled DataFrame (with or without SpikeTimes), CompiledSession or ChannelAccessor.
+        channels (list): Channels or units to check, every one in the session if None.
+        thresholds (QualityThresholds): Defaults if None.
+    """
+    thresholds = thresholds if thresholds is not None else QualityThresholds()
+    accessor = ChannelAccessor.of(data)
+    keys, counts, has_spikes = spike_count_matrix(accessor, channels)
+    epochs = epochs_to_array(accessor.metadata['EpochStartStop'].tolist())
+    durations = epochs[:, 1] - epochs[:, 0]
+    n_trials, n_keys = counts.shape
+
+    missing_epoch = np.isnan(durations)
+    valid_durations = durations[~missing_epoch]
+    median_duration = np.median(valid_durations) if valid_durations.size else np.nan
+    with np.errstate(invalid='ignore'):
+        short_epoch = durations < thresholds.min_epoch_duration
+        long_epoch = durations > thresholds.max_epoch_duration_factor * median_duration
+
+    # Rates of the trials with an epoch and SpikeTimes; the others are NaN and ignored by the channel statistics
+    usable = has_spikes & ~missing_epoch & (np.nan_to_num(durations) > 0)
+    rates = np.full((n_trials, n_keys), np.nan)
+    rates[usable] = counts[usable] / durations[usable, None]
+
+    active_fraction = (counts[usable] > 0).mean(axis=0) if usable.any() else np.zeros(n_keys)
+    empty_channels = active_fraction < thresholds.min_active_trial_fraction
+
+    runaway = np.zeros((n_trials, n_keys), dtype=bool)
+    if usable.any() and n_keys:
+        median_rate = np.median(rates[usable], axis=0)
+        mad = np.median(np.abs(rates[usable] - median_rate), axis=0)
+        limits = np.maximum(median_rate + thresholds.runaway_mad * MAD_TO_SD * mad, thresholds.min_runaway_rate)
+        runaway[usable] = rates[usable] > limits
+    runaway[:, empty_channels] = False
+
+    checked_channels = ~empty_channels
+    n_checked = int(checked_channels.sum())
+    if n_checked:
+        runaway_fraction = runaway[:, checked_channels].sum(axis=1) / n_checked
+        runaway_trials = runaway_fraction >= thresholds.runaway_channel_fraction
+        no_spikes = ~has_spikes | (counts[:, checked_channels].sum(axis=1) == 0)
+    else:
+        runaway_trials = np.zeros(n_trials, dtype=bool)
+        no_spikes = np.zeros(n_trials, dtype=bool) if n_keys == 0 else ~has_spikes
+    runaway_channels = (runaway.sum(axis=0) > thresholds.max_runaway_trial_fraction * max(int(usable.sum()), 1))
+
+    trial_flags = {"missing_epoch": missing_epoch, "short_epoch": short_epoch, "long_epoch": long_epoch,
+                   "no_spikes": no_spikes & ~missing_epoch, "runaway": runaway_trials}
+    channel_flags = {"empty": empty_channels, "runaway": runaway_channels}
+    return QualityReport(keys, durations, counts, runaway, trial_flags, channel_flags, thresholds)
+
+
+def drop_flagged(data, report: QualityReport, drop_trials: bool = True, drop_channels: bool = True):
+    """
+    data without the trials and/or channels flagged in report.
+
+    Returns:
+        A DataFrame for a DataFrame, otherwise a ChannelAccessor holding only the kept channels (spike times of a
+        session directory are then read into memory).
+    """
+    keep_rows = ~report.bad_trials if drop_trials else np.ones(len(report.durations), dtype=bool)
+    bad_keys = set(report.bad_keys) if drop_channels else set()
+
+    if isinstance(data, pd.DataFrame):
+        kept = data.reset_index(drop=True).loc[keep_rows].reset_index(drop=True)
+        if bad_keys and 'SpikeTimes' in kept:
+            kept['SpikeTimes'] = [
+                {key: spikes for key, spikes in spike_times_by_key.items() if spike_key_value(key) not in bad_keys}
+                if isinstance(spike_times_by_key, dict) else spike_times_by_key
+                for spike_times_by_key in kept['SpikeTimes']]
+        return kept
+
+    accessor = ChannelAccessor.of(data)
+    kept_channels = [channel for channel in accessor.channels if spike_key_value(channel) not in bad_keys]
+    subset = accessor.subset(kept_channels) if (accessor.session is not None or bad_keys) else accessor
+    return ChannelAccessor(subset.data.reset_index(drop=True).loc[keep_rows].reset_index(drop=True))
+
+
+def reject_noisy_data(data, channels: list = None, thresholds: QualityThresholds = None, drop: bool = True,
+                      drop_channels: bool = False, verbose: bool = True):
+    """
+    The data-quality stage of the analysis entry points: assess, print one report, and drop flagged trials
+    (and channels, with drop_channels).
+
+    Returns:
+        tuple: (data, report). data is unchanged when drop and drop_channels are False.
+    """
+    report = assess_quality(data, channels, thresholds)
+    if verbose:
+        print(report.summary())
+    if drop or drop_channels:
+        data = drop_flagged(data, report, drop_trials=drop, drop_channels=drop_channels)
+    return data, report
@@ -0,0 +1,152 @@
+"""
+Per-monkey and per-group statistics of binned spike rates.
+
+Rates are kept as one contiguous (n_trials x n_channels x num_bins) array. Trials are ordered by label once and
+every statistic is a single np.add.reduceat over the label segments, for all channels at the same time.
+"""
+
+from dataclasses import dataclass
+
+import numpy as np
+import pandas as pd
+
+from julie.channel_access import ChannelAccessor
+from julie.spike_binning import calculate_binned_spike_rates
+
+
+@dataclass
+class RateStatistics:
+    """
+    Statistics of the trials sharing each label, with np.std's default ddof=0 and sem = std / sqrt(n).
+
+    labels: One entry per segment, e.g. a MonkeyGroup or a (MonkeyGroup, MonkeyName) tuple.
+    n: (n_labels,) number of trials.
+    mean, std, sem: (n_labels x n_channels x num_bins).
+    trial_rows: Row positions of each label's trials, in row order.
+    """
+    labels: list
+    n: np.ndarray
+    mean: np.ndarray
+    std: np.ndarray
+    sem: np.ndarray
+    trial_rows: list[np.ndarray]
+
+    def index(self, label) -> int:
+        return self.labels.index(label)
+
+
+def summarize_rates(rates: np.ndarray, codes: np.ndarray, labels: list) -> RateStatistics:
+    """
+    Mean, std, sem and n of rates for every label.
+
+    Parameters:
+        rates (np.ndarray): (n_trials x n_channels x num_bins) binned rates.
+        codes (np.ndarray): Label index of every trial, -1 for trials that belong to no label.
+        labels (list): Labels, indexed by code. Every label must have at least one trial.
+    """
+    rates = np.asarray(rates, dtype=np.float64)
+    codes = np.asarray(codes, dtype=np.int64)
+    kept_rows = np.flatnonzero(codes >= 0)
+    trial_rows = kept_rows[np.argsort(codes[kept_rows], kind='stable')]
+    n = np.bincount(codes[kept_rows], minlength=len(labels))
+    if len(labels) == 0:
+        empty = np.empty((0,) + rates.shape[1:])
+        return RateStatistics([], n, empty, empty, empty, [])
+
+    starts = np.concatenate(([0], np.cumsum(n)[:-1]))
+    ordered = rates[trial_rows]
+    counts = n.reshape((-1,) + (1,) * (rates.ndim - 1))
+    mean = np.add.reduceat(ordered, starts, axis=0) / counts
+    deviations = ordered - np.repeat(mean, n, axis=0)
+    std = np.sqrt(np.add.reduceat(deviations * deviations, starts, axis=0) / counts)
+    sem = std / np.sqrt(counts)
+    return RateStatistics(list(labels), n, mean, std, sem, np.split(trial_rows, np.cumsum(n)[:-1]))
+
+
+def monkey_labels(metadata: pd.DataFrame) -> tuple[list, np.ndarray]:
+    """
+    (MonkeyGroup, MonkeyName) labels, groups in order of appearance and monkeys in order of appearance within
+    their group, and the label code of every trial (-1 for trials without a group or name).
+    """
+    monkeys = metadata[['MonkeyGroup', 'MonkeyName']].reset_index(drop=True)
+    group_names = monkeys['MonkeyGroup'].dropna().unique().tolist()
+    labels = []
+    for group_name in group_names:
+        group_monkeys = monkeys.loc[monkeys['MonkeyGroup'] == group_name, 'MonkeyName'].dropna().unique()
+        labels.extend((group_name, monkey_name) for monkey_name in group_monkeys)
+    code_by_label = {label: code for code, label in enumerate(labels)}
+    codes = np.array([code_by_label.get(label, -1) for label in zip(monkeys['MonkeyGroup'], monkeys['MonkeyName'])],
+                     dtype=np.int64)
+    return labels, codes
+
+
+def group_labels(metadata: pd.DataFrame) -> tuple[list, np.ndarray]:
+    """
+    MonkeyGroup labels sorted by name like DataFrame.groupby, and the label code of every trial (-1 for trials
+    without a group).
+    """
+    groups = metadata['MonkeyGroup'].reset_index(drop=True)
+    labels = sorted(groups.dropna().unique().tolist())
+    code_by_label = {label: code for code, label in enumerate(labels)}
+    codes = np.array([code_by_label.get(group_name, -1) for group_name in groups], dtype=np.int64)
+    return labels, codes
+
+
+def monkey_rate_statistics(metadata: pd.DataFrame, rates: np.ndarray) -> RateStatistics:
+    """
+    Statistics per (MonkeyGroup, MonkeyName): groups in order of appearance, monkeys in order of appearance
+    within their group. Trials without a group or name are left out.
+    """
+    labels, codes = monkey_labels(metadata)
+    return summarize_rates(rates, codes, labels)
+
+
+def group_rate_statistics(metadata: pd.DataFrame, rates: np.ndarray) -> RateStatistics:
+    """
+    Statistics per MonkeyGroup, groups sorted by name like DataFrame.groupby. Trials without a group are left out.
+    """
+    labels, codes = group_labels(metadata)
+    return summarize_rates(rates, codes, labels)
+
+
+def binned_rates_for_channels(data, channels: list, num_bins: int, psth_cube=None) -> np.ndarray:
+    """
+    (n_trials x n_channels x num_bins) binned spike rates of every channel of a session.
+
+    Parameters:
+        data: Compiled DataFrame, CompiledSession or ChannelAccessor.
+        channels (list): Channels, in the order of axis 1.
+        num_bins (int): Bins per epoch.
+        psth_cube (PsthCube): Optional cube of the same session to sum the rates from.
+    """
+    accessor = ChannelAccessor.of(data)
+    n_trials = len(accessor.metadata)
+    rates = np.zeros((n_trials, len(channels), num_bins), dtype=np.float64)
+    epochs = accessor.metadata['EpochStartStop'].tolist()
+    for channel_index, channel in enumerate(channels):
+        if psth_cube is not None:
+            rates[:, channel_index, :] = psth_cube.binned_rates(channel, num_bins)
+        else:
+            rates[:, channel_index, :] = calculate_binned_spike_rates(accessor.spike_trains(channel), epochs, num_bins)
+    return rates
+
+
+def channel_rate_statistics(data, channels: list = None, num_bins: int = 10, psth_cube=None,
+                            quality=None) -> tuple[list, RateStatistics, RateStatistics]:
+    """
+    Monkey and group statistics of every channel of a session in one pass.
+
+    Trials flagged in quality (a data_quality.QualityReport of the session) are dropped first, so trial_rows
+    index the kept trials, as in single_channel_analysis.plot_channel_histograms.
+
+    Returns:
+        tuple: (channels, monkey statistics, group statistics). Axis 1 of the statistics follows channels.
+    """
+    accessor = ChannelAccessor.of(data)
+    channels = accessor.channels if channels is None else channels
+    rates = binned_rates_for_channels(accessor, channels, num_bins, psth_cube)
+    metadata = accessor.metadata
+    if quality is not None:
+        rates = rates[~quality.bad_trials]
+        metadata = metadata[~quality.bad_trials].reset_index(drop=True)
+    return channels, monkey_rate_statistics(metadata, rates), group_rate_statistics(metadata, rates)
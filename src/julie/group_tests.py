@@ -0,0 +1,326 @@
+"""
+Tests of MonkeyGroup differences in binned spike rates, for every channel and bin of a session at once.
+
+The statistic is the one-way ANOVA F of each (channel, bin). Its permutation p-value shuffles the group labels
+of the trials: a batch of permutations is one (permutations x groups, trials) one-hot matrix times the
+(trials x tests) rate matrix, and batches are spread over a process pool. Group sizes and the total sum of
+squares do not change under permutation, so each permuted F is only a few array operations on the group sums.
+
+The parametric p-value from the F distribution is always computed too (numpy only, no scipy). It is used
+when n_permutations is 0.
+
+    test = group_differences_for_session(ChannelAccessor.open(file_path), num_bins=10, n_permutations=5000)
+    test.significant(alpha=0.05)  # (n_channels x num_bins) after the multiple-comparison correction
+"""
+
+import math
+import os
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+
+import numpy as np
+
+from julie.channel_access import ChannelAccessor
+from julie.compiled_session import spike_key_value
+from julie.group_statistics import binned_rates_for_channels, group_labels
+
+CORRECTIONS = ("fdr_bh", "holm", "bonferroni", "max_t", "none")
+PERMUTATION_BATCH_SIZE = 256
+PERMUTATION_CHUNK_SIZE = 1024
+# Relative tolerance when comparing permuted to observed F, so the observed labelling counts as an exceedance
+F_TOLERANCE = 1e-9
+
+
+def main():
+    experiment_data_filename = "1697058662909405_231011_171103_round3.pk1"
+    script_dir = Path(__file__).parent
+    file_path = (script_dir / '..' / '..' / 'compiled' / 'julie' / experiment_data_filename).resolve()
+
+    test = group_differences_for_session(ChannelAccessor.open(file_path), num_bins=10, n_permutations=5000)
+    significant = test.significant(alpha=0.05)
+    for channel_index, key in enumerate(test.keys):
+        if significant[channel_index].any():
+            bins = np.flatnonzero(significant[channel_index]).tolist()
+            print(f"{key}: groups differ in bins {bins}, min corrected p {test.p_corrected[channel_index].min():.4f}")
+
+
+@dataclass
+class GroupDifferenceTest:
+    """
+    One-way tests of group differences. Arrays are (n_channels x num_bins).
+
+    labels, n: Groups and their trial counts.
+    f: Observed ANOVA F (0 where a channel has no variance in a bin).
+    p_parametric: From the F(n_groups - 1, n_trials - n_groups) distribution.
+    p_permutation: (1 + permutations with F >= observed) / (1 + n_permutations), None without permutations.
+    p_corrected: p_values after correction (one of CORRECTIONS) over all channels and bins.
+    """
+    keys: list
+    labels: list
+    n: np.ndarray
+    f: np.ndarray
+    p_parametric: np.ndarray
+    p_permutation: np.ndarray | None
+    n_permutations: int
+    correction: str
+    p_corrected: np.ndarray
+
+    @property
+    def p_values(self) -> np.ndarray:
+        return self.p_permutation if self.p_permutation is not None else self.p_parametric
+
+    def significant(self, alpha: float = 0.05) -> np.ndarray:
+        return self.p_corrected < alpha
+
+
+def group_differences_for_session(data, channels: list = None, num_bins: int = 10, n_permutations: int = 5000,
+                                  correction: str = "fdr_bh", processes: int = None, seed: int = 0,
+                                  psth_cube=None, quality=None) -> GroupDifferenceTest:
+    """
+    Test every channel and bin of a session for MonkeyGroup differences in binned rate.
+
+    Parameters:
+        data: Compiled DataFrame, CompiledSession or ChannelAccessor.
+        channels (list): Channels or units to test, all of the session if None.
+        num_bins (int): Bins per epoch.
+        n_permutations (int): Label permutations. 0 uses the parametric p-values only.
+        correction (str): One of CORRECTIONS. max_t needs permutations.
+        processes (int): Worker processes for the permutations, the number of CPUs if None.
+        seed (int): Seed of the permutations; the same seed gives the same p-values for any processes.
+        psth_cube (PsthCube): Optional cube of the same session to sum the rates from.
+        quality (QualityReport): Trials it flags (see data_quality) are left out.
+    """
+    accessor = ChannelAccessor.of(data)
+    channels = accessor.channels if channels is None else channels
+    rates = binned_rates_for_channels(accessor, channels, num_bins, psth_cube)
+    labels, codes = group_labels(accessor.metadata)
+    if quality is not None:
+        codes[quality.bad_trials] = -1
+    return group_difference_test(rates, codes, labels, [spike_key_value(channel) for channel in channels],
+                                 n_permutations, correction, processes, seed)
+
+
+def group_difference_test(rates: np.ndarray, codes: np.ndarray, labels: list, keys: list = None,
+                          n_permutations: int = 5000, correction: str = "fdr_bh", processes: int = None,
+                          seed: int = 0) -> GroupDifferenceTest:
+    """
+    Parameters:
+        rates (np.ndarray): (n_trials x n_channels x num_bins) binned rates.
+        codes (np.ndarray): Group index of every trial, -1 for trials left out.
+        labels (list): Groups, indexed by code.
+        keys (list): Channel names along axis 1.
+    """
+    if correction not in CORRECTIONS:
+        raise ValueError(f"correction must be one of {CORRECTIONS}, not {correction}")
+    if correction == "max_t" and n_permutations <= 0:
+        raise ValueError("max_t correction needs n_permutations > 0")
+    codes = np.asarray(codes, dtype=np.int64)
+    kept = codes >= 0
+    test_shape = rates.shape[1:]
+    values = np.asarray(rates, dtype=np.float64)[kept].reshape(int(kept.sum()), -1)
+    codes = codes[kept]
+    n_groups = len(labels)
+    group_sizes = np.bincount(codes, minlength=n_groups)
+    if n_groups < 2 or (group_sizes == 0).any() or len(codes) <= n_groups:
+        raise ValueError(f"Need at least two groups with trials and more trials than groups, got {group_sizes}")
+
+    # Centered, so the between-group sum of squares is sum(group_sum ** 2 / group_size)
+    values = values - values.mean(axis=0)
+    total_ss = np.einsum('ij,ij->j', values, values)
+    f = anova_f(_group_sums(values, codes[None, :], n_groups)[0], group_sizes, total_ss)
+    df_between, df_within = n_groups - 1, len(codes) - n_groups
+    p_parametric = np.where(total_ss > 0, f_distribution_sf(f, df_between, df_within), 1.0)
+
+    p_permutation = None
+    max_f = None
+    if n_permutations > 0:
+        exceedances, max_f = run_permutations(values, codes, group_sizes, total_ss, f, n_permutations, processes,
+                                              seed)
+        p_permutation = (1 + exceedances) / (1 + n_permutations)
+
+    p_values = p_permutation if p_permutation is not None else p_parametric
+    if correction == "max_t":
+        # Westfall-Young single step: compare each F to the permutation distribution of the largest F
+        sorted_max_f = np.sort(max_f)
+        at_least = n_permutations - np.searchsorted(sorted_max_f, f * (1 - F_TOLERANCE), side='left')
+        p_corrected = (1 + at_least) / (1 + n_permutations)
+    else:
+        p_corrected = correct_p_values(p_values, correction)
+
+    keys = list(keys) if keys is not None else list(range(test_shape[0]))
+    return GroupDifferenceTest(keys, list(labels), group_sizes, f.reshape(test_shape),
+                               p_parametric.reshape(test_shape),
+                               None if p_permutation is None else p_permutation.reshape(test_shape),
+                               n_permutations, correction, p_corrected.reshape(test_shape))
+
+
+def anova_f(group_sums: np.ndarray, group_sizes: np.ndarray, total_ss: np.ndarray) -> np.ndarray:
+    """
+    One-way ANOVA F from the group sums of centered values (... x n_groups x n_tests). 0 where total_ss is 0.
+    """
+    n_groups = len(group_sizes)
+    df_between, df_within = n_groups - 1, int(group_sizes.sum()) - n_groups
+    between_ss = np.einsum('...gt,g->...t', group_sums * group_sums, 1.0 / group_sizes)
+    within_ss = np.maximum(total_ss - between_ss, 0.0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        f = (between_ss / df_between) / (within_ss / df_within)
+    f = np.where(total_ss > 0, f, 0.0)
+    # All variance between groups (every group constant): F is infinite
+    return np.where(np.isnan(f), np.inf, f)
+
+
+def _group_sums(values: np.ndarray, codes: np.ndarray, n_groups: int) -> np.ndarray:
+    """
+    (n_labelings x n_groups x n_tests) sums of values per group, for a (n_labelings x n_trials) batch of codes.
+    """
+    one_hot = (codes[:, None, :] == np.arange(n_groups)[None, :, None]).astype(np.float64)
+    return (one_hot.reshape(-1, codes.shape[1]) @ values).reshape(codes.shape[0], n_groups, values.shape[1])
+
+
+def permutation_chunk(values: np.ndarray, codes: np.ndarray, group_sizes: np.ndarray, total_ss: np.ndarray,
+                      observed_f: np.ndarray, n_permutations: int, seed_sequence,
+                      batch_size: int = PERMUTATION_BATCH_SIZE) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Run n_permutations label permutations in batches.
+
+    Returns:
+        tuple: (exceedances, max_f). exceedances counts per test the permutations with F >= observed F, max_f is
+        the largest F over all tests of every permutation.
+    """
+    rng = np.random.default_rng(seed_sequence)
+    threshold = observed_f * (1 - F_TOLERANCE)
+    exceedances = np.zeros(values.shape[1], dtype=np.int64)
+    max_f = np.empty(n_permutations, dtype=np.float64)
+    for batch_start in range(0, n_permutations, batch_size):
+        n_batch = min(batch_size, n_permutations - batch_start)
+        permuted_codes = rng.permuted(np.broadcast_to(codes, (n_batch, codes.size)), axis=1)
+        f = anova_f(_group_sums(values, permuted_codes, len(group_sizes)), group_sizes, total_ss)
+        exceedances += (f >= threshold).sum(axis=0)
+        max_f[batch_start:batch_start + n_batch] = f.max(axis=1)
+    return exceedances, max_f
+
+
+_worker_arrays = None
+
+
+def _init_permutation_worker(values, codes, group_sizes, total_ss, observed_f):
+    global _worker_arrays
+    _worker_arrays = (values, codes, group_sizes, total_ss, observed_f)
+
+
+def _permutation_job(n_permutations: int, seed_sequence) -> tuple[np.ndarray, np.ndarray]:
+    return permutation_chunk(*_worker_arrays, n_permutations, seed_sequence)
+
+
+def run_permutations(values: np.ndarray, codes: np.ndarray, group_sizes: np.ndarray, total_ss: np.ndarray,
+                     observed_f: np.ndarray, n_permutations: int, processes: int = None,
+                     seed: int = 0) -> tuple[np.ndarray, np.ndarray]:
+    """
+    permutation_chunk over a process pool. The permutations are split into fixed chunks with their own seeds,
+    so the result does not depend on the number of processes. The arrays are sent to each worker once.
+    """
+    processes = processes if processes is not None else (os.cpu_count() or 1)
+    chunk_sizes = [min(PERMUTATION_CHUNK_SIZE, n_permutations - start)
+                   for start in range(0, n_permutations, PERMUTATION_CHUNK_SIZE)]
+    seed_sequences = np.random.SeedSequence(seed).spawn(len(chunk_sizes))
+
+    if processes <= 1 or len(chunk_sizes) == 1:
+        results = [permutation_chunk(values, codes, group_sizes, total_ss, observed_f, n, seed_sequence)
+                   for n, seed_sequence in zip(chunk_sizes, seed_sequences)]
+    else:
+        with ProcessPoolExecutor(max_workers=min(processes, len(chunk_sizes)), initializer=_init_permutation_worker,
+                                 initargs=(values, codes, group_sizes, total_ss, observed_f)) as executor:
+            results = list(executor.map(_permutation_job, chunk_sizes, seed_sequences))
+
+    exceedances = np.sum([result[0] for result in results], axis=0)
+    max_f = np.concatenate([result[1] for result in results])
+    return exceedances, max_f
+
+
+def correct_p_values(p_values: np.ndarray, correction: str = "fdr_bh") -> np.ndarray:
+    """
+    Correct p_values (any shape) for the number of tests: Benjamini-Hochberg FDR, Holm or Bonferroni.
+    """
+    p_values = np.asarray(p_values, dtype=np.float64)
+    flat = p_values.ravel()
+    m = flat.size
+    if correction == "none" or m == 0:
+        return p_values.copy()
+    if correction == "bonferroni":
+        return np.minimum(p_values * m, 1.0)
+
+    order = np.argsort(flat, kind='stable')
+    sorted_p = flat[order]
+    ranks = np.arange(1, m + 1)
+    if correction == "holm":
+        adjusted = np.maximum.accumulate(sorted_p * (m - ranks + 1))
+    elif correction == "fdr_bh":
+        adjusted = np.minimum.accumulate((sorted_p * m / ranks)[::-1])[::-1]
+    else:
+        raise ValueError(f"Unknown correction {correction}")
+    corrected = np.empty(m, dtype=np.float64)
+    corrected[order] = np.minimum(adjusted, 1.0)
+    return corrected.reshape(p_values.shape)
+
+
+def f_distribution_sf(f: np.ndarray, df_between: int, df_within: int) -> np.ndarray:
+    """
+    P(F >= f) for the F(df_between, df_within) distribution, as the regularized incomplete beta
+    I_x(df_within / 2, df_between / 2) at x = df_within / (df_within + df_between * f).
+    """
+    f = np.asarray(f, dtype=np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        x = df_within / (df_within + df_between * f)
+    x = np.where(np.isinf(f), 0.0, np.where(f <= 0, 1.0, x))
+    return regularized_incomplete_beta(df_within / 2, df_between / 2, x)
+
+
+def regularized_incomplete_beta(a: float, b: float, x: np.ndarray) -> np.ndarray:
+    """
+    I_x(a, b) for scalar a, b > 0 and an array of x in [0, 1], by the continued fraction of Numerical Recipes
+    (Lentz's method), using I_x(a, b) = 1 - I_{1-x}(b, a) where the fraction converges slowly.
+    """
+    x = np.clip(np.asarray(x, dtype=np.float64), 0.0, 1.0)
+    result = np.where(x >= 1.0, 1.0, 0.0)
+    inside = (x > 0.0) & (x < 1.0)
+    if not inside.any():
+        return result
+
+    xi = x[inside]
+    log_front = (math.lgamma(a + b) - math.lgamma(a) - math.lgamma(b)
+                 + a * np.log(xi) + b * np.log1p(-xi))
+    front = np.exp(log_front)
+    direct = xi < (a + 1) / (a + b + 2)
+    values = np.empty_like(xi)
+    values[direct] = front[direct] * _beta_continued_fraction(a, b, xi[direct]) / a
+    values[~direct] = 1.0 - front[~direct] * _beta_continued_fraction(b, a, 1.0 - xi[~direct]) / b
+    result[inside] = values
+    return result
+
+
+def _beta_continued_fraction(a: float, b: float, x: np.ndarray, max_iterations: int = 10000,
+                             epsilon: float = 1e-15) -> np.ndarray:
+    tiny = 1e-300
+    qab, qap, qam = a + b, a + 1.0, a - 1.0
+    c = np.ones_like(x)
+    d = 1.0 - qab * x / qap
+    d = 1.0 / np.where(np.abs(d) < tiny, tiny, d)
+    h = d.copy()
+    for m in range(1, max_iterations + 1):
+        m2 = 2 * m
+        for aa in (m * (b - m) * x / ((qam + m2) * (a + m2)),
+                   -(a + m) * (qab + m) * x / ((a + m2) * (qap + m2))):
+            d = 1.0 + aa * d
+            d = 1.0 / np.where(np.abs(d) < tiny, tiny, d)
+            c = 1.0 + aa / c
+            c = np.where(np.abs(c) < tiny, tiny, c)
+            delta = d * c
+            h *= delta
+        if np.all(np.abs(delta - 1.0) < epsilon):
+            break
+    return h
+
+
+if __name__ == '__main__':
+    main()
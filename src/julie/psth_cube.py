@@ -0,0 +1,169 @@
+"""
+Precomputed spike-count cube of a compiled session: trial x channel (or unit) x fine normalized-time bin.
+
+Each trial's epoch is split into FINE_BINS equal bins and the cube holds the number of spikes in each
+(epoch_start <= spike < epoch_stop, like calculate_binned_spike_rate). Any bin count dividing FINE_BINS
+(1-6, 8-10, 12, 15, 18, 20, 24, 30, 36, 40, ...) is then a reshape and sum of the cube, so changing num_bins or
+switching channels does not go back to the spike lists.
+
+The cube is saved next to the compiled session as <experiment_name>.psth.npz and rebuilt when the session
+changes.
+"""
+
+import os
+
+import numpy as np
+
+from julie.channel_access import ChannelAccessor
+from julie.compiled_session import is_session, spike_key_value
+from julie.spike_binning import epochs_to_array, flatten_spike_trains
+
+FINE_BINS = 360
+PSTH_SUFFIX = ".psth.npz"
+
+
+class PsthCube:
+    def __init__(self, counts: np.ndarray, keys: list[str], epochs: np.ndarray, has_spikes: np.ndarray,
+                 source_signature: str = ""):
+        """
+        Parameters:
+            counts (np.ndarray): (n_trials x n_keys x n_fine_bins) spike counts.
+            keys (list[str]): Spike key values (channel values such as "A-000", or unit names) along axis 1.
+            epochs (np.ndarray): (n_trials x 2) epoch start and stop, NaN where missing.
+            has_spikes (np.ndarray): (n_trials x n_keys) bool, False where a trial had no spike list for the key.
+            source_signature (str): Size and modification time of the session the cube was built from.
+        """
+        self.counts = counts
+        self.keys = list(keys)
+        self.epochs = epochs
+        self.has_spikes = has_spikes
+        self.source_signature = source_signature
+        self._key_index_by_value = {key: key_index for key_index, key in enumerate(self.keys)}
+
+    @property
+    def n_trials(self) -> int:
+        return self.counts.shape[0]
+
+    @property
+    def n_fine_bins(self) -> int:
+        return self.counts.shape[2]
+
+    def key_index(self, key) -> int:
+        try:
+            return self._key_index_by_value[spike_key_value(key)]
+        except KeyError:
+            raise KeyError(f"{key} is not in the PSTH cube") from None
+
+    def binned_counts(self, num_bins: int, keys: list = None) -> np.ndarray:
+        """
+        (n_trials x n_keys x num_bins) spike counts in num_bins equal bins of each epoch.
+        """
+        if self.n_fine_bins % num_bins != 0:
+            raise ValueError(f"num_bins={num_bins} does not divide the cube's {self.n_fine_bins} fine bins")
+        counts = self.counts if keys is None else self.counts[:, [self.key_index(key) for key in keys], :]
+        return counts.reshape(counts.shape[0], counts.shape[1], num_bins, -1).sum(axis=3, dtype=np.int64)
+
+    def binned_rates(self, key, num_bins: int) -> np.ndarray:
+        """
+        (n_trials x num_bins) spike rates of one channel or unit, matching calculate_binned_spike_rates up to
+        float rounding of the bin edges (a spike lying exactly on an edge can be counted in the neighbouring
+        bin). Trials without an epoch or without spikes for the key give rows of zeros.
+        """
+        key_index = self.key_index(key)
+        counts = self.binned_counts(num_bins, [key])[:, 0, :]
+        epoch_durations = self.epochs[:, 1] - self.epochs[:, 0]
+        valid = self.has_spikes[:, key_index] & (np.nan_to_num(epoch_durations) > 0)
+        bin_durations = np.where(valid, epoch_durations, 1.0) / num_bins
+        rates = np.zeros(counts.shape, dtype=np.float64)
+        np.divide(counts, bin_durations[:, None], out=rates, where=valid[:, None])
+        return rates
+
+    def group_mean_rates(self, key, num_bins: int, labels) -> dict:
+        """
+        Mean binned rate per label (e.g. MonkeyGroup of every trial), computed from the cube.
+        """
+        rates = self.binned_rates(key, num_bins)
+        labels = np.asarray(labels, dtype=object)
+        return {label: rates[labels == label].mean(axis=0) for label in dict.fromkeys(labels)}
+
+    def subset(self, keys: list) -> "PsthCube":
+        key_indices = [self.key_index(key) for key in keys]
+        return PsthCube(self.counts[:, key_indices, :], [self.keys[i] for i in key_indices], self.epochs,
+                        self.has_spikes[:, key_indices], self.source_signature)
+
+    def save(self, path: str):
+        tmp_path = path + ".tmp.npz"
+        np.savez_compressed(tmp_path, counts=self.counts, keys=np.array(self.keys, dtype=str), epochs=self.epochs,
+                            has_spikes=self.has_spikes, source_signature=np.array(self.source_signature))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> "PsthCube":
+        with np.load(path) as cube_file:
+            return cls(cube_file["counts"], cube_file["keys"].tolist(), cube_file["epochs"], cube_file["has_spikes"],
+                       str(cube_file["source_signature"]))
+
+
+def build_psth_cube(data, n_fine_bins: int = FINE_BINS, source_signature: str = "") -> PsthCube:
+    """
+    Count every channel's spikes in n_fine_bins equal bins of each trial's epoch.
+
+    Parameters:
+        data: Compiled DataFrame, CompiledSession or ChannelAccessor.
+        n_fine_bins (int): Bins per epoch. Coarser bin counts must divide it.
+        source_signature (str): Stored with the cube to detect a changed session.
+    """
+    accessor = ChannelAccessor.of(data)
+    epochs = epochs_to_array(accessor.metadata['EpochStartStop'].tolist())
+    n_trials = len(epochs)
+    keys = [spike_key_value(key) for key in accessor.channels]
+
+    has_epoch = ~np.isnan(epochs[:, 0]) & (epochs[:, 1] > epochs[:, 0])
+    starts = np.where(has_epoch, epochs[:, 0], 0.0)
+    durations = np.where(has_epoch, epochs[:, 1] - epochs[:, 0], 1.0)
+
+    counts = np.zeros((n_trials, len(keys), n_fine_bins), dtype=np.uint32)
+    has_spikes = np.zeros((n_trials, len(keys)), dtype=bool)
+    for key_index, channel in enumerate(accessor.channels):
+        spike_trains = accessor.spike_trains(channel)
+        has_spikes[:, key_index] = [spikes is not None and not isinstance(spikes, str) for spikes in spike_trains]
+        spike_times, offsets = flatten_spike_trains(spike_trains)
+        trials = np.repeat(np.arange(n_trials), np.diff(offsets))
+        fine_bins = np.floor((spike_times - starts[trials]) / durations[trials] * n_fine_bins)
+        inside = has_epoch[trials] & (fine_bins >= 0) & (fine_bins < n_fine_bins)
+        flat_bins = trials[inside] * n_fine_bins + fine_bins[inside].astype(np.int64)
+        counts[:, key_index, :] = np.bincount(flat_bins, minlength=n_trials * n_fine_bins).reshape(n_trials, -1)
+
+    if counts.size and counts.max() < np.iinfo(np.uint16).max:
+        counts = counts.astype(np.uint16)
+    return PsthCube(counts, keys, epochs, has_spikes, source_signature)
+
+
+def psth_path_for(path) -> str:
+    """
+    The cube file that sits next to a compiled .pk1 file or session directory.
+    """
+    return os.path.splitext(str(path).rstrip(os.sep))[0] + PSTH_SUFFIX
+
+
+def load_psth_cube(path, n_fine_bins: int = FINE_BINS, rebuild: bool = False) -> PsthCube:
+    """
+    Load the cube of a compiled session, building and saving it first if it is missing or out of date.
+    """
+    cube_path = psth_path_for(path)
+    signature = _source_signature(path)
+    if not rebuild and os.path.exists(cube_path):
+        cube = PsthCube.load(cube_path)
+        if cube.source_signature == signature and cube.n_fine_bins == n_fine_bins:
+            return cube
+
+    cube = build_psth_cube(ChannelAccessor.open(path), n_fine_bins, source_signature=signature)
+    cube.save(cube_path)
+    return cube
+
+
+def _source_signature(path) -> str:
+    path = str(path)
+    stat_path = os.path.join(path, "manifest.json") if is_session(path) else path
+    stat = os.stat(stat_path)
+    return f"{stat.st_size}:{stat.st_mtime_ns}"
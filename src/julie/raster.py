@@ -0,0 +1,203 @@
+from dataclasses import dataclass
+
+import numpy as np
+import pandas as pd
+from matplotlib import pyplot as plt
+
+from julie.spike_binning import epochs_to_array, flatten_spike_trains, spike_bounds_in_epochs
+
+RASTER_MODES = ("vector", "image")
+RASTER_TIME_LIMIT = 2.0
+# Default bin width of raster_image; draw_raster_image bins to the pixel width of its axes instead
+RASTER_IMAGE_BIN_WIDTH = 0.002
+# Inches per monkey panel in image mode
+RASTER_IMAGE_PANEL_SIZE = (5, 3)
+
+
+@dataclass
+class RasterPanel:
+    """
+    One monkey's raster: the epoch-aligned spike times of each of its trials, in session order.
+    """
+    group_name: str
+    monkey_name: str
+    column: int
+    row: int
+    trial_rows: np.ndarray
+    spike_times: list[np.ndarray]
+
+    @property
+    def n_trials(self) -> int:
+        return len(self.spike_times)
+
+
+@dataclass
+class RasterLayout:
+    """
+    Everything plot_raster needs: group columns in order of appearance, one panel per (group, monkey), the
+    number of rows of the tallest column and the total number of trials.
+    """
+    group_names: list[str]
+    max_rows: int
+    n_trials: int
+    panels: list[RasterPanel]
+
+
+def align_spikes_to_epochs(spike_trains, epochs) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Keep each trial's spikes with epoch_start <= spike <= epoch_stop and subtract epoch_start.
+
+    Parameters:
+        spike_trains: Sequence of per-trial spike time lists or arrays (None allowed).
+        epochs: Sequence of per-trial (epoch_start, epoch_stop) tuples (None allowed).
+
+    Returns:
+        tuple: (aligned_spike_times, offsets). Trial i is aligned_spike_times[offsets[i]:offsets[i + 1]].
+    """
+    spike_times, offsets = flatten_spike_trains(spike_trains)
+    epoch_array = epochs_to_array(epochs)
+    lo, hi = spike_bounds_in_epochs(spike_times, offsets, epoch_array)
+
+    counts = hi - lo
+    aligned_offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(counts, out=aligned_offsets[1:])
+    # Gather the kept [lo, hi) ranges of every trial into one array
+    indices = np.arange(aligned_offsets[-1]) - np.repeat(aligned_offsets[:-1] - lo, counts)
+    epoch_starts = np.repeat(np.nan_to_num(epoch_array[:, 0]), counts)
+    return spike_times[indices] - epoch_starts, aligned_offsets
+
+
+def prepare_raster(metadata: pd.DataFrame, spike_trains) -> RasterLayout:
+    """
+    Group trials by (MonkeyGroup, MonkeyName) once and epoch-align all their spikes.
+
+    Groups and monkeys keep their order of first appearance and trials without a MonkeyGroup or MonkeyName
+    are left out of the panels, as in the original per-monkey loops.
+
+    Parameters:
+        metadata (pd.DataFrame): Trials with MonkeyGroup, MonkeyName and EpochStartStop columns.
+        spike_trains: Per-trial spike times of one channel or unit, aligned with the rows of metadata.
+    """
+    aligned_spike_times, offsets = align_spikes_to_epochs(list(spike_trains), metadata['EpochStartStop'].tolist())
+
+    monkeys = metadata[['MonkeyGroup', 'MonkeyName']].reset_index(drop=True)
+    panel_codes = monkeys.groupby(['MonkeyGroup', 'MonkeyName'], sort=False, dropna=True).ngroup()
+    # Trials without a group or name get no panel code; order the rest by panel, keeping trial order
+    has_panel = panel_codes.notna().to_numpy()
+    panel_codes = panel_codes.to_numpy()[has_panel].astype(np.int64)
+    order = np.argsort(panel_codes, kind='stable')
+    trial_rows = np.flatnonzero(has_panel)[order]
+    panel_sizes = np.bincount(panel_codes)
+    trial_rows_by_panel = np.split(trial_rows, np.cumsum(panel_sizes)[:-1]) if trial_rows.size else []
+
+    group_names = monkeys['MonkeyGroup'].dropna().unique().tolist()
+    column_by_group = {group_name: column for column, group_name in enumerate(group_names)}
+    rows_by_group = dict.fromkeys(group_names, 0)
+    panels = []
+    for rows in trial_rows_by_panel:
+        group_name = monkeys.at[rows[0], 'MonkeyGroup']
+        monkey_name = monkeys.at[rows[0], 'MonkeyName']
+        panels.append(RasterPanel(group_name=group_name, monkey_name=monkey_name,
+                                  column=column_by_group[group_name], row=rows_by_group[group_name],
+                                  trial_rows=rows,
+                                  spike_times=[aligned_spike_times[offsets[row]:offsets[row + 1]] for row in rows]))
+        rows_by_group[group_name] += 1
+    panels.sort(key=lambda panel: (panel.column, panel.row))
+
+    return RasterLayout(group_names=group_names, max_rows=max(rows_by_group.values(), default=0),
+                        n_trials=len(metadata), panels=panels)
+
+
+def raster_image(panel: RasterPanel, time_limit: float = RASTER_TIME_LIMIT,
+                 bin_width: float = RASTER_IMAGE_BIN_WIDTH, n_bins: int = None, n_rows: int = None) -> np.ndarray:
+    """
+    Pre-binned raster of one panel: (n_rows x n_bins) uint8 spike counts over [0, time_limit], capped at 255.
+
+    Parameters:
+        bin_width (float): Seconds per column, unless n_bins is given.
+        n_bins (int): Number of columns spanning [0, time_limit].
+        n_rows (int): Number of rows; consecutive trials are summed into each row when it is smaller than the
+            number of trials. One row per trial if None.
+    """
+    if n_bins is None:
+        n_bins = int(np.ceil(time_limit / bin_width))
+    n_rows = panel.n_trials if n_rows is None else min(n_rows, panel.n_trials)
+    image = np.zeros(n_rows * n_bins, dtype=np.int64)
+    if panel.n_trials:
+        counts = np.array([spike_times.size for spike_times in panel.spike_times])
+        spike_times = np.concatenate(panel.spike_times)
+        rows = np.repeat(np.arange(panel.n_trials) * n_rows // panel.n_trials, counts)
+        bins = np.floor(spike_times * (n_bins / time_limit)).astype(np.int64)
+        # A spike exactly on time_limit is drawn in the last bin, like the closed x range of the eventplot
+        bins[spike_times == time_limit] = n_bins - 1
+        visible = (bins >= 0) & (bins < n_bins)
+        image = np.bincount(rows[visible] * n_bins + bins[visible], minlength=image.size)
+    return np.minimum(image, 255).astype(np.uint8).reshape(n_rows, n_bins)
+
+
+def draw_raster_image(ax, panel: RasterPanel, time_limit: float = RASTER_TIME_LIMIT):
+    """
+    Draw a panel into ax as a pre-binned image with at most one column per pixel of the axes (and at most one
+    row per pixel row), so nearest-neighbour resampling never skips a bin and every spike darkens at least
+    one pixel. Call once the layout of the figure is final, and save at the figure's dpi or higher.
+    """
+    bbox = ax.get_window_extent()
+    n_bins = max(1, int(np.floor(bbox.width)))
+    n_rows = max(1, int(np.floor(bbox.height)))
+    ax.imshow(raster_image(panel, time_limit, n_bins=n_bins, n_rows=n_rows), cmap='gray_r', vmin=0, vmax=1,
+              aspect='auto', origin='lower', interpolation='nearest',
+              extent=(0, time_limit, -0.5, panel.n_trials - 0.5))
+
+
+def plot_raster(layout: RasterLayout, title: str, mode: str = "vector"):
+    """
+    Draw one raster per monkey, a column per MonkeyGroup, from a prepared RasterLayout.
+
+    Parameters:
+        layout (RasterLayout): From prepare_raster.
+        title (str): Figure title.
+        mode (str): "vector" draws every spike as an eventplot line. "image" draws each panel as a pre-binned
+            image (one column per pixel of the panel, see draw_raster_image) on a figure sized per panel, so
+            figure and file size do not grow with the number of spikes. Axes and labels stay vector artists in
+            both modes.
+    """
+    if mode not in RASTER_MODES:
+        raise ValueError(f"Unknown raster mode {mode!r}, expected one of {RASTER_MODES}")
+    n_columns = len(layout.group_names)
+    if mode == "image":
+        panel_width, panel_height = RASTER_IMAGE_PANEL_SIZE
+        fig = plt.figure(figsize=(panel_width * n_columns, panel_height * layout.max_rows))
+    else:
+        fig = plt.figure(figsize=(15 * n_columns, 45 * layout.max_rows))
+    # Before the panels are added, so image mode bins to their final pixel size
+    plt.subplots_adjust(hspace=1.0, wspace=1.0)
+
+    for panel in layout.panels:
+        ax = fig.add_subplot(layout.max_rows, n_columns, panel.row * n_columns + panel.column + 1)
+        if mode == "image":
+            draw_raster_image(ax, panel)
+        else:
+            ax.eventplot(panel.spike_times, color='black', linewidths=0.5)
+        ax.set_xlim(0, RASTER_TIME_LIMIT)
+        ax.set_yticks([panel.n_trials])
+        # Place the title text to the right of the subplot
+        ax.text(1.05, 0.5, f"{panel.monkey_name}", transform=ax.transAxes, ha='left', va='center', fontsize=14)
+
+    for col_idx, group_name in enumerate(layout.group_names):
+        fig.text(0.5 / n_columns + col_idx / n_columns, 0.95, f'{group_name}', ha='center', va='center')
+
+    # fig.text(0.5, 0.01, 'Monkey Groups', ha='center', va='center')
+    fig.text(0.5, 0.05, 'Time (s)', ha='center', va='center', rotation='horizontal')
+    fig.text(0.99, 0.95, f'N: {layout.n_trials}', ha='right', va='bottom')
+    fig.suptitle(title)
+    return fig
+
+
+def raster_file_extension(mode: str, vector_overlay: bool = True) -> str:
+    """
+    File type to save a raster figure as: SVG, except for image mode without the vector overlay, which is
+    saved as a plain PNG.
+    """
+    if mode == "image" and not vector_overlay:
+        return "png"
+    return "svg"
@@ -0,0 +1,274 @@
+"""
+Whole-array responsiveness overview of a compiled session, for triage before any per-channel plotting.
+
+Every trial of every channel (or sorted unit) gets a baseline and a stimulus spike count from its EpochStartStop.
+Compiled SpikeTimes only hold the spikes inside each epoch, so the baseline is the first response_latency seconds
+of the epoch (before visually driven spikes arrive) and the stimulus window is the rest of it. A trial's
+response is its stimulus rate minus its baseline rate, and each channel x MonkeyName and channel x MonkeyGroup
+gets the z-score mean / sem of its trials' responses.
+
+All channels are counted in one pass: their spikes are concatenated as (channel, trial) pseudo-trials and every
+baseline and stimulus window is counted with a single sort (count_spikes_between_edges).
+"""
+
+import os
+from dataclasses import dataclass
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from matplotlib import pyplot as plt
+
+from julie.channel_access import ChannelAccessor
+from julie.compiled_session import spike_key_value
+from julie.data_quality import reject_noisy_data
+from julie.group_statistics import monkey_labels, group_labels
+from julie.spike_binning import epochs_to_array, flatten_spike_trains, count_spikes_between_edges
+
+RESPONSE_LATENCY = 0.05
+# Spikes counted per count_spikes_between_edges call; channels are batched up to this
+MAX_SPIKES_PER_PASS = 1 << 24
+
+
+def main():
+    experiment_data_filename = "1697058662909405_231011_171103_round3.pk1"
+    script_dir = Path(__file__).parent
+    file_path = (script_dir / '..' / '..' / 'compiled' / 'julie' / experiment_data_filename).resolve()
+    experiment_name = experiment_data_filename.split(".")[0]
+
+    accessor = ChannelAccessor.open(file_path)
+    # Data-quality stage (opt in): trials it flags are left out of the scores
+    reject_noisy = False
+    quality = reject_noisy_data(accessor, drop=False)[1] if reject_noisy else None
+    report = score_responsiveness(accessor, quality=quality)
+    print(report.by_group.to_frame().round(2).to_string())
+
+    save_dir = (script_dir / '..' / '..' / 'plots' / 'julie' / experiment_name).resolve()
+    os.makedirs(save_dir, exist_ok=True)
+    fig = plot_responsiveness_heatmap(report, title=f"Responsiveness: {experiment_name}")
+    save_path = os.path.join(save_dir, "responsiveness.png")
+    fig.savefig(save_path)
+    print("Saved to : ", save_path)
+
+
+@dataclass
+class ResponseCounts:
+    """
+    Baseline and stimulus spike counts of every trial (axis 0) and channel or unit (axis 1).
+
+    valid: False where a trial has no epoch, no stimulus window left after the baseline, or no spike list for
+        the channel. Counts there are 0.
+    """
+    keys: list
+    baseline_counts: np.ndarray
+    stimulus_counts: np.ndarray
+    baseline_durations: np.ndarray
+    stimulus_durations: np.ndarray
+    valid: np.ndarray
+
+    def responses(self) -> np.ndarray:
+        """
+        (n_trials x n_keys) stimulus rate minus baseline rate in spikes/s, 0 where not valid.
+        """
+        has_windows = (self.baseline_durations > 0) & (self.stimulus_durations > 0)
+        baseline_durations = np.where(has_windows, self.baseline_durations, 1.0)[:, None]
+        stimulus_durations = np.where(has_windows, self.stimulus_durations, 1.0)[:, None]
+        responses = self.stimulus_counts / stimulus_durations - self.baseline_counts / baseline_durations
+        return np.where(self.valid, responses, 0.0)
+
+
+@dataclass
+class ResponsivenessScores:
+    """
+    z-scores of the trial responses sharing each label, per channel or unit. Arrays are (n_labels x n_keys).
+
+    labels: e.g. MonkeyGroup names or (MonkeyGroup, MonkeyName) tuples.
+    n: Valid trials. mean_response is in spikes/s and z = mean_response / sem, with np.std's ddof=0.
+    """
+    keys: list
+    labels: list
+    n: np.ndarray
+    mean_response: np.ndarray
+    z: np.ndarray
+
+    def to_frame(self, values: str = "z") -> pd.DataFrame:
+        """
+        One row per channel or unit, one column per label.
+        """
+        columns = [label if isinstance(label, str) else ": ".join(map(str, label)) for label in self.labels]
+        return pd.DataFrame(getattr(self, values).T, index=self.keys, columns=columns)
+
+
+@dataclass
+class ResponsivenessReport:
+    counts: ResponseCounts
+    overall: ResponsivenessScores
+    by_group: ResponsivenessScores
+    by_monkey: ResponsivenessScores
+
+    def ranked_keys(self) -> list:
+        """
+        Channels or units from most to least responsive, by |z| over all trials.
+        """
+        order = np.argsort(-np.nan_to_num(np.abs(self.overall.z[0])), kind="stable")
+        return [self.overall.keys[key_index] for key_index in order]
+
+
+def count_response_spikes(data, channels: list = None, response_latency: float = RESPONSE_LATENCY) -> ResponseCounts:
+    """
+    Baseline [start, start + response_latency) and stimulus [start + response_latency, stop] spike counts of
+    every trial and channel.
+
+    Parameters:
+        data: Compiled DataFrame, CompiledSession or ChannelAccessor.
+        channels (list): Channels or units along axis 1, every one in the session if None.
+        response_latency (float): Seconds at the start of each epoch counted as baseline.
+    """
+    accessor = ChannelAccessor.of(data)
+    channels = accessor.channels if channels is None else channels
+    epochs = epochs_to_array(accessor.metadata['EpochStartStop'].tolist())
+    n_trials, n_keys = len(epochs), len(channels)
+
+    baseline_stops = epochs[:, 0] + response_latency
+    has_epoch = ~np.isnan(epochs[:, 0]) & (epochs[:, 1] > baseline_stops)
+    starts = np.where(has_epoch, epochs[:, 0], 0.0)
+    baseline_stops = np.where(has_epoch, baseline_stops, 0.0)
+    # A spike exactly on the stop time belongs to the epoch, as in the compiled SpikeTimes
+    stops = np.where(has_epoch, np.nextafter(epochs[:, 1], np.inf), 0.0)
+    edges = np.column_stack((starts, baseline_stops, stops))
+
+    counts = np.zeros((n_keys, n_trials, 2), dtype=np.int64)
+    valid = np.zeros((n_keys, n_trials), dtype=bool)
+    batch = []
+    for key_index, channel in enumerate(channels):
+        spike_times, offsets, has_spikes = _spike_arrays(accessor, channel)
+        valid[key_index] = has_spikes & has_epoch
+        batch.append((key_index, spike_times, offsets))
+        if sum(spike_times.size for _, spike_times, _ in batch) >= MAX_SPIKES_PER_PASS or key_index == n_keys - 1:
+            _count_batch(batch, edges, counts)
+            batch = []
+
+    counts[~valid] = 0
+    baseline_durations = np.where(has_epoch, baseline_stops - starts, 0.0)
+    stimulus_durations = np.where(has_epoch, epochs[:, 1] - baseline_stops, 0.0)
+    return ResponseCounts([spike_key_value(channel) for channel in channels], counts[:, :, 0].T.copy(),
+                          counts[:, :, 1].T.copy(), baseline_durations, stimulus_durations, valid.T.copy())
+
+
+def _spike_arrays(accessor: ChannelAccessor, channel) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # Session directories already store flat arrays; DataFrames are flattened from their spike lists
+    if accessor.session is not None and spike_key_value(channel) in accessor.key_by_value:
+        spike_times, offsets = accessor.session.spike_arrays(channel)
+        return spike_times, offsets, np.asarray(accessor.session.has_spikes, dtype=bool)
+    spike_trains = accessor.spike_trains(channel)
+    spike_times, offsets = flatten_spike_trains(spike_trains)
+    has_spikes = np.array([spikes is not None and not isinstance(spikes, str) for spikes in spike_trains],
+                          dtype=bool)
+    return spike_times, offsets, has_spikes
+
+
+def _count_batch(batch: list, edges: np.ndarray, counts: np.ndarray):
+    """
+    Count the windows of several channels at once, each (channel, trial) pair being one pseudo-trial.
+    """
+    n_trials = edges.shape[0]
+    spike_times = np.concatenate([np.asarray(times, dtype=np.float64) for _, times, _ in batch])
+    offsets = [np.zeros(1, dtype=np.int64)]
+    total = 0
+    for _, times, key_offsets in batch:
+        offsets.append(np.asarray(key_offsets[1:], dtype=np.int64) + total)
+        total += times.size
+    offsets = np.concatenate(offsets)
+    batch_counts = count_spikes_between_edges(spike_times, offsets, np.tile(edges, (len(batch), 1)))
+    key_indices = [key_index for key_index, _, _ in batch]
+    counts[key_indices] = batch_counts.reshape(len(batch), n_trials, 2)
+
+
+def z_score_responses(responses: np.ndarray, valid: np.ndarray, codes: np.ndarray, labels: list,
+                      keys: list) -> ResponsivenessScores:
+    """
+    Per label and key: valid trial count, mean response and z = mean / sem, in one reduceat per statistic.
+
+    Parameters:
+        responses (np.ndarray): (n_trials x n_keys) per-trial responses.
+        valid (np.ndarray): (n_trials x n_keys) bool, trials to include per key.
+        codes (np.ndarray): Label index of every trial, -1 for trials that belong to no label.
+        labels (list): Labels, indexed by code. Every label must have at least one trial.
+    """
+    codes = np.asarray(codes, dtype=np.int64)
+    n_keys = responses.shape[1]
+    if len(labels) == 0:
+        empty = np.empty((0, n_keys))
+        return ResponsivenessScores(list(keys), [], empty.astype(np.int64), empty, empty)
+
+    kept_rows = np.flatnonzero(codes >= 0)
+    trial_rows = kept_rows[np.argsort(codes[kept_rows], kind='stable')]
+    starts = np.concatenate(([0], np.cumsum(np.bincount(codes[kept_rows], minlength=len(labels)))[:-1]))
+
+    weights = valid[trial_rows].astype(np.float64)
+    values = responses[trial_rows] * weights
+    n = np.add.reduceat(weights, starts, axis=0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = np.add.reduceat(values, starts, axis=0) / n
+        segment_sizes = np.diff(np.append(starts, len(trial_rows)))
+        deviations = (values - np.repeat(np.nan_to_num(mean), segment_sizes, axis=0)) * weights
+        std = np.sqrt(np.add.reduceat(deviations * deviations, starts, axis=0) / n)
+        sem = std / np.sqrt(n)
+        z = np.where(sem > 0, mean / sem, 0.0)
+    z[n == 0] = np.nan
+    return ResponsivenessScores(list(keys), list(labels), n.astype(np.int64), mean, z)
+
+
+def score_responsiveness(data, channels: list = None, response_latency: float = RESPONSE_LATENCY,
+                         quality=None) -> ResponsivenessReport:
+    """
+    Count every channel's baseline and stimulus spikes and z-score the responses over all trials, per
+    MonkeyGroup and per (MonkeyGroup, MonkeyName). Trials flagged in quality (a data_quality.QualityReport of
+    the session) are left out.
+    """
+    accessor = ChannelAccessor.of(data)
+    counts = count_response_spikes(accessor, channels, response_latency)
+    if quality is not None:
+        counts.valid &= ~quality.bad_trials[:, None]
+    responses = counts.responses()
+    metadata = accessor.metadata
+
+    n_trials = len(metadata)
+    overall = z_score_responses(responses, counts.valid, np.zeros(n_trials, dtype=np.int64), ["All trials"],
+                                counts.keys)
+    groups, group_codes = group_labels(metadata)
+    by_group = z_score_responses(responses, counts.valid, group_codes, groups, counts.keys)
+    monkeys, monkey_codes = monkey_labels(metadata)
+    by_monkey = z_score_responses(responses, counts.valid, monkey_codes, monkeys, counts.keys)
+    return ResponsivenessReport(counts, overall, by_group, by_monkey)
+
+
+def plot_responsiveness_heatmap(report: ResponsivenessReport, title: str = None, max_abs_z: float = None):
+    """
+    One heatmap of the z-scores: a row per channel or unit (most responsive first), columns for all trials,
+    each MonkeyGroup and each monkey.
+    """
+    ranked_keys = report.ranked_keys()
+    frames = [report.overall.to_frame(), report.by_group.to_frame(), report.by_monkey.to_frame()]
+    z = pd.concat(frames, axis=1).loc[ranked_keys]
+    if max_abs_z is None:
+        max_abs_z = max(float(np.nanmax(np.abs(z.to_numpy()))) if z.size else 1.0, 1.0)
+
+    fig, ax = plt.subplots(figsize=(max(8.0, 0.35 * z.shape[1] + 3), max(6.0, 0.25 * z.shape[0] + 2)))
+    image = ax.imshow(z.to_numpy(dtype=np.float64), aspect='auto', cmap='RdBu_r', vmin=-max_abs_z, vmax=max_abs_z,
+                      interpolation='nearest')
+    ax.set_xticks(np.arange(z.shape[1]))
+    ax.set_xticklabels(z.columns, rotation=90, fontsize=7)
+    ax.set_yticks(np.arange(z.shape[0]))
+    ax.set_yticklabels(z.index, fontsize=7)
+    # Separate the all-trials, group and monkey columns
+    for boundary in np.cumsum([frame.shape[1] for frame in frames])[:-1]:
+        ax.axvline(boundary - 0.5, color='black', linewidth=1)
+    fig.colorbar(image, ax=ax, label='z (stimulus - baseline rate)')
+    ax.set_title(title if title is not None else 'Responsiveness')
+    fig.tight_layout()
+    return fig
+
+
+if __name__ == '__main__':
+    main()
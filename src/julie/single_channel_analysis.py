@@ -7,7 +7,16 @@ import pandas as pd
 from matplotlib import pyplot as plt
 from clat.intan.channels import Channel
 
-matplotlib.use("Qt5Agg")
+from julie.channel_access import ChannelAccessor
+from julie.compiled_session import read_compiled, spike_key_value
+from julie.data_quality import reject_noisy_data
+from julie.group_statistics import channel_rate_statistics, monkey_rate_statistics, group_rate_statistics
+from julie.raster import prepare_raster, plot_raster, raster_file_extension
+from julie.spike_binning import calculate_binned_spike_rates
+
+# Interactive by default; batch exports set MPLBACKEND (e.g. Agg) to run headless
+if "MPLBACKEND" not in os.environ:
+    matplotlib.use("Qt5Agg")
 
 
 def main():
@@ -19,8 +28,12 @@ def main():
     # Construct the path from the script directory
     file_path = (script_dir / '..' / '..' / 'compiled' / 'julie' / experiment_data_filename).resolve()
     print(file_path)
-    raw_data = read_pickle(file_path)
-    #   plot_channel_histograms(raw_data, channel=Channel.C_013)
+    # Channel lookups are indexed once for the session and reused by every plot below
+    raw_data = ChannelAccessor.open(file_path)
+    # Data-quality stage (opt in): trials it flags are left out of the plots below
+    reject_noisy = False
+    quality = reject_noisy_data(raw_data, drop=False)[1] if reject_noisy else None
+    plot_histograms = True
 
 
     channels = [
@@ -51,65 +64,43 @@ def main():
     ]
 
     experiment_name = experiment_data_filename.split(".")[0]
-    for channel in channels:
+    if plot_histograms:
+        # Histogram statistics of every channel below in one pass over the session
+        _, monkey_statistics, group_statistics = channel_rate_statistics(raw_data, channels, quality=quality)
+    for channel_index, channel in enumerate(channels):
         print("Working on channel %s" % channel)
         plot_raster_for_monkeys(raw_data, channel=channel,
-                                experiment_name=experiment_name)
+                                experiment_name=experiment_name, quality=quality)
+        if plot_histograms:
+            plot_channel_histograms(raw_data, channel, experiment_name=experiment_name, quality=quality,
+                                    monkey_statistics=monkey_statistics, group_statistics=group_statistics,
+                                    channel_index=channel_index)
 
 
-def read_pickle(file_path):
-    unpacked_pickle = pd.read_pickle(file_path).reset_index(drop=True)
+def read_pickle(file_path, channels=None):
+    # Session directories are read columnar (only the requested channels), anything else as a pickle
+    unpacked_pickle = read_compiled(file_path, channels=channels).reset_index(drop=True)
     return unpacked_pickle
 
 
-def plot_raster_for_monkeys(raw_data, channel, experiment_name=None):
-    channel_data = extract_target_channel_data(channel, raw_data)
-    unique_monkey_groups = channel_data['MonkeyGroup'].dropna().unique().tolist()
-    N = len(channel_data)
-
-    max_rows = 0
-    for group_name in unique_monkey_groups:
-        group_data = channel_data[channel_data['MonkeyGroup'] == group_name]
-        unique_monkeys = group_data['MonkeyName'].dropna().unique().tolist()
-        max_rows = max(max_rows, len(unique_monkeys))
-
-    fig = plt.figure(figsize=(15 * len(unique_monkey_groups), 45 * max_rows))
-
-    for col_idx, group_name in enumerate(unique_monkey_groups):
-        group_data = channel_data[channel_data['MonkeyGroup'] == group_name]
-        unique_monkeys = group_data['MonkeyName'].dropna().unique().tolist()
-
-        for row_idx, monkey_name in enumerate(unique_monkeys):
-            monkey_data = group_data[group_data['MonkeyName'] == monkey_name]
-
-            ax = fig.add_subplot(max_rows, len(unique_monkey_groups), row_idx * len(unique_monkey_groups) + col_idx + 1)
-
-            filtered_spike_times_list = []
-            for idx, row in monkey_data.iterrows():
-                spike_times = row[f'SpikeTimes_{channel.value}']
-                epoch_start, epoch_stop = row['EpochStartStop']
-
-                # Filter spikes based on EpochStartStop and subtract the epoch start time
-                filtered_spike_times = [spike - epoch_start for spike in spike_times if
-                                        epoch_start <= spike <= epoch_stop]
-                filtered_spike_times_list.append(filtered_spike_times)
-
-            ax.eventplot(filtered_spike_times_list, color='black', linewidths=0.5)
-            ax.set_xlim(0, 2.0)
-            ax.set_yticks([len(filtered_spike_times_list)])
-            # Place the title text to the right of the subplot
-            ax.text(1.05, 0.5, f"{monkey_name}", transform=ax.transAxes, ha='left', va='center', fontsize=14)
-
-        fig.text(0.5 / len(unique_monkey_groups) + col_idx / len(unique_monkey_groups), 0.95, f'{group_name}',
-                 ha='center', va='center')
-
-    # fig.text(0.5, 0.01, 'Monkey Groups', ha='center', va='center')
-    fig.text(0.5, 0.05, 'Time (s)', ha='center', va='center', rotation='horizontal')
-    fig.text(0.99, 0.95, f'N: {N}', ha='right', va='bottom')
-    fig.suptitle(f'Raster Plots for Individual Monkeys: Channel: {channel.value}')
-
-    plt.subplots_adjust(hspace=1.0, wspace=1.0)
-    plt.show()
+def plot_raster_for_monkeys(raw_data, channel, experiment_name=None, show=True, raster_mode="vector",
+                            vector_overlay=True, quality=None):
+    """
+    Raster of one channel per monkey. raster_mode="image" draws pre-binned image panels instead of one line
+    per spike; without vector_overlay those figures are saved as PNG instead of SVG. Trials flagged in quality
+    (a data_quality.QualityReport of the session) are left out.
+    """
+    accessor = ChannelAccessor.of(raw_data)
+    metadata, spike_trains = accessor.metadata, accessor.spike_trains(channel)
+    if quality is not None:
+        kept_rows = np.flatnonzero(~quality.bad_trials)
+        metadata = metadata.iloc[kept_rows].reset_index(drop=True)
+        spike_trains = [spike_trains[row] for row in kept_rows]
+    layout = prepare_raster(metadata, spike_trains)
+    fig = plot_raster(layout, f'Raster Plots for Individual Monkeys: Channel: {channel.value}', mode=raster_mode)
+
+    if show:
+        plt.show()
 
     ## SAVE PLOTS
     script_dir = Path(__file__).parent
@@ -119,47 +110,74 @@ def plot_raster_for_monkeys(raw_data, channel, experiment_name=None):
         os.makedirs(save_dir, exist_ok=True)
 
         # Save individual plot
-        individual_save_path_png = os.path.join(save_dir, f"{channel.name}_raster.png")
-        filename = os.path.join(save_dir, f"{channel.name}_raster.svg")
-        individual_save_path_svg = filename
+        extension = raster_file_extension(raster_mode, vector_overlay)
+        filename = os.path.join(save_dir, f"{channel.name}_raster.{extension}")
         print("Saved to : ", os.path.abspath(filename))
-        # fig.savefig(individual_save_path_png)
-        fig.savefig(individual_save_path_svg)
+        fig.savefig(filename)
 
     return fig
 
 
-def plot_channel_histograms(data, channel):
-    ## NOISE FILTERING
-    # data = remove_noisy_data(data, 10, 100)
+def plot_channel_histograms(data, channel, experiment_name=None, show=True, num_bins=10, psth_cube=None,
+                            quality=None, monkey_statistics=None, group_statistics=None, channel_index=0):
+    """
+    Per-monkey and per-group binned spike rate histograms of one channel. With a PsthCube of the same session
+    (see julie.psth_cube.load_psth_cube), rates are summed from the cube instead of rebinned from spike times.
+    Trials flagged in quality (a data_quality.QualityReport of the session) are left out.
 
+    monkey_statistics and group_statistics from group_statistics.channel_rate_statistics (same session, quality
+    and num_bins) are used for the channel at channel_index of their axis 1 instead of being computed here.
+    """
     ## CHANNEL SPECIFIC ANALYSIS
-    num_bins = 10
     channel_data = extract_target_channel_data(channel, data)
-    channel_data = calculate_spikerates_per_bin(channel_data, channel, num_bins)
+    channel_data = calculate_spikerates_per_bin(channel_data, channel, num_bins, psth_cube=psth_cube)
+
+    ## NOISE FILTERING
+    if quality is not None:
+        channel_data = channel_data[~quality.bad_trials].reset_index(drop=True)
+
+    ## STATISTICS
+    if monkey_statistics is None or group_statistics is None:
+        rates = np.stack(channel_data['BinnedSpikeRates'].tolist())[:, None, :]
+        monkey_statistics = monkey_rate_statistics(channel_data, rates)
+        group_statistics = group_rate_statistics(channel_data, rates)
+        channel_index = 0
 
     ## PLOTTING
-    individual_plot = plot_histograms_for_individual_monkeys(channel_data, channel)
-    group_plot = plot_average_among_groups(channel_data, channel)
+    individual_plot = plot_histograms_for_individual_monkeys(channel_data, channel, monkey_statistics,
+                                                             channel_index)
+    group_plot = plot_average_among_groups(channel_data, channel, group_statistics, channel_index)
 
     ## SAVE PLOTS
-    # base_save_dir = "/home/r2_allen/git/EStimShape/EStimShapeAnalysis/plots/julie"
-    # experiment_name = path_to_data_pickle_file.split("/")[-1].split(".")[0]
-    # save_dir = os.path.join(base_save_dir, experiment_name)
-    # os.makedirs(save_dir, exist_ok=True)
-    #
-    # Save individual plot
-    # individual_save_path = os.path.join(save_dir, f"{channel.name}_individual.png")
-    # individual_plot.savefig(individual_save_path)
-    #
-    # Save group plot
-    # group_save_path = os.path.join(save_dir, f"{channel.name}_group.png")
-    # group_plot.savefig(group_save_path)
-
-    plt.show()
-
-
-def plot_histograms_for_individual_monkeys(channel_data, channel):
+    if experiment_name is not None:
+        script_dir = Path(__file__).parent
+        base_save_dir = (script_dir / '..' / '..' / 'plots' / 'julie').resolve()
+        save_dir = os.path.join(base_save_dir, experiment_name)
+        os.makedirs(save_dir, exist_ok=True)
+
+        # Save individual plot
+        individual_save_path = os.path.join(save_dir, f"{channel.name}_individual.png")
+        individual_plot.savefig(individual_save_path)
+
+        # Save group plot
+        group_save_path = os.path.join(save_dir, f"{channel.name}_group.png")
+        group_plot.savefig(group_save_path)
+
+    if show:
+        plt.show()
+    return individual_plot, group_plot
+
+
+def plot_histograms_for_individual_monkeys(channel_data, channel, monkey_statistics=None, channel_index=0):
+    """
+    One subplot per monkey with every trial's binned rates and their mean +- std.
+
+    monkey_statistics (from group_statistics.monkey_rate_statistics) is computed from
+    channel_data['BinnedSpikeRates'] if not given; channel_index selects its channel.
+    """
+    rates = np.stack(channel_data['BinnedSpikeRates'].tolist())
+    if monkey_statistics is None:
+        monkey_statistics = monkey_rate_statistics(channel_data, rates[:, None, :])
     num_groups = channel_data['MonkeyGroup'].nunique()
     unique_monkey_groups = channel_data['MonkeyGroup'].dropna().unique().tolist()
     N = len(channel_data)
@@ -167,35 +185,33 @@ def plot_histograms_for_individual_monkeys(channel_data, channel):
     # Create a new figure
     fig = plt.figure(figsize=(15, 10))
 
-    row_idx = 0
-    global_max_spike_rate = channel_data['BinnedSpikeRates'].apply(lambda x: max(x) if x is not None else 0).max()
     ymax = 50
-    num_bins = len(channel_data['BinnedSpikeRates'].iloc[0])
+    num_bins = rates.shape[1]
     x_proportion = np.linspace(0, 1, num_bins)
 
     legend_handles_labels = None
-    for group_name in unique_monkey_groups:
-        group_data = channel_data[channel_data['MonkeyGroup'] == group_name]
-        unique_monkeys = group_data['MonkeyName'].dropna().unique().tolist()
-
-        for col_idx, monkey_name in enumerate(unique_monkeys):
-            monkey_data = group_data[group_data['MonkeyName'] == monkey_name]
+    for row_idx, group_name in enumerate(unique_monkey_groups):
+        monkey_indices = [index for index, (label_group, _) in enumerate(monkey_statistics.labels)
+                          if label_group == group_name]
 
-            ax = fig.add_subplot(num_groups, len(unique_monkeys), row_idx * len(unique_monkeys) + col_idx + 1)
+        for col_idx, monkey_index in enumerate(monkey_indices):
+            monkey_name = monkey_statistics.labels[monkey_index][1]
+            ax = fig.add_subplot(num_groups, len(monkey_indices), row_idx * len(monkey_indices) + col_idx + 1)
 
-            err_bar = plot_histogram_for_single_monkey(ax, monkey_data, monkey_name, x_proportion, ymax)
+            err_bar = plot_histogram_for_single_monkey(ax, rates[monkey_statistics.trial_rows[monkey_index]],
+                                                       monkey_statistics.mean[monkey_index, channel_index],
+                                                       monkey_statistics.std[monkey_index, channel_index],
+                                                       monkey_name, x_proportion, ymax)
 
             # Collect legend handles and labels from one of the axes
             if legend_handles_labels is None:
                 legend_handles_labels = ([err_bar], ["Mean"])
-                # Add a label for the MonkeyGroup on the left side
 
-                # Correctly position the label for the MonkeyGroup on the left side
+        # Correctly position the label for the MonkeyGroup on the left side
         subplot_height = 1 / num_groups
         vertical_position = 1 - (row_idx * subplot_height + subplot_height / 2)
         fig.text(0.08, vertical_position, f'{group_name}', ha='center', va='center',
                  rotation='vertical')
-        row_idx += 1
 
     # Add a single x-axis label at the bottom
     fig.text(0.5, 0.04, 'Proportion of Total Time', ha='center', va='center')
@@ -215,11 +231,9 @@ def plot_histograms_for_individual_monkeys(channel_data, channel):
     return fig
 
 
-def plot_histogram_for_single_monkey(ax, monkey_data, monkey_name, x_proportion, ymax):
-    spike_rate_arrays = np.vstack(monkey_data['BinnedSpikeRates'])
+def plot_histogram_for_single_monkey(ax, spike_rate_arrays, mean_spike_rates, std_spike_rates, monkey_name,
+                                     x_proportion, ymax):
     num_traces = spike_rate_arrays.shape[0]  # Number of rows in spike_rate_arrays is the number of traces
-    mean_spike_rates = np.mean(spike_rate_arrays, axis=0)
-    std_spike_rates = np.std(spike_rate_arrays, axis=0)
     for spike_rates in spike_rate_arrays:
         ax.plot(x_proportion, spike_rates, color='black', alpha=0.3, linewidth=0.75)
     err_bar = ax.errorbar(x_proportion, mean_spike_rates, yerr=std_spike_rates, color='orange', alpha=0.75,
@@ -258,32 +272,35 @@ def on_click_histo(event):
         plt.show()
 
 
-def plot_average_among_groups(channel_data, channel):
-    # Group the data by MonkeyGroup
-    grouped_data = channel_data.groupby('MonkeyGroup')['BinnedSpikeRates'].apply(
-        lambda x: np.vstack(x)
-    ).reset_index()
+def plot_average_among_groups(channel_data, channel, group_statistics=None, channel_index=0, group_test=None,
+                              alpha=0.05):
+    """
+    Mean +- SEM of the binned rates of each MonkeyGroup. group_statistics (from
+    group_statistics.group_rate_statistics) is computed from channel_data['BinnedSpikeRates'] if not given.
+    With a group_test (from group_tests.group_differences_for_session), bins where the groups differ at alpha after
+    correction are marked with '*'.
+    """
+    if group_statistics is None:
+        rates = np.stack(channel_data['BinnedSpikeRates'].tolist())[:, None, :]
+        group_statistics = group_rate_statistics(channel_data, rates)
 
-    # Find the number of bins (assuming you already have this from your previous calculations)
-    num_bins = len(channel_data['BinnedSpikeRates'].iloc[0])
+    # Calculate the proportion of total time for each bin
+    num_bins = group_statistics.mean.shape[2]
+    x_proportion = np.linspace(0, 1, num_bins)
 
     # Create a figure and axis for the plot
     fig, ax = plt.subplots(figsize=(10, 6))
 
-    # Loop through each unique MonkeyGroup to plot the average and error bars
-    for index, row in grouped_data.iterrows():
-        group_name = row['MonkeyGroup']
-        spike_rates_matrix = row['BinnedSpikeRates']
-
-        # Calculate the mean and standard error for each bin
-        mean_spike_rates = np.mean(spike_rates_matrix, axis=0)
-        std_err_spike_rates = np.std(spike_rates_matrix, axis=0) / np.sqrt(spike_rates_matrix.shape[0])
-
-        # Calculate the proportion of total time for each bin
-        x_proportion = np.linspace(0, 1, num_bins)
+    # Plot the mean trace of each MonkeyGroup with standard error bars
+    for group_index, group_name in enumerate(group_statistics.labels):
+        ax.errorbar(x_proportion, group_statistics.mean[group_index, channel_index],
+                    yerr=group_statistics.sem[group_index, channel_index], label=f'Group: {group_name}', alpha=0.75)
 
-        # Plot the mean trace with error bars
-        ax.errorbar(x_proportion, mean_spike_rates, yerr=std_err_spike_rates, label=f'Group: {group_name}', alpha=0.75)
+    if group_test is not None:
+        significant = group_test.significant(alpha)[group_test.keys.index(spike_key_value(channel))]
+        top = np.nanmax(group_statistics.mean[:, channel_index] + group_statistics.sem[:, channel_index], axis=0)
+        for bin_index in np.flatnonzero(significant):
+            ax.annotate('*', (x_proportion[bin_index], top[bin_index]), ha='center', va='bottom', fontsize=14)
 
     # Add labels, title, and legend
     ax.set_xlabel('Proportion of Total Time')
@@ -320,20 +337,22 @@ def calculate_spike_rate(spikes: list, time_range: tuple) -> float:
 
 
 def extract_target_channel_data(channel: Channel, data):
-    # Get SpikeTimes for channel
-    channel_data = data.copy()
-    channel_data[f'SpikeTimes_{channel.value}'] = data['SpikeTimes'].apply(
-        lambda x: x[next(filter(lambda key: key.value == channel.value, x.keys()), None)])
+    # Get SpikeTimes for channel; data can be a compiled DataFrame or a ChannelAccessor built once per session
+    channel_data = ChannelAccessor.of(data).channel_data(channel)
 
     return channel_data
 
 
-def calculate_spikerates_per_bin(channel_data, channel, num_bins):
-    # Calculate binned spike rates
-    channel_data['BinnedSpikeRates'] = channel_data.apply(
-        lambda row: calculate_binned_spike_rate(row[f'SpikeTimes_{channel.value}'], row['EpochStartStop'], num_bins),
-        axis=1
-    )
+def calculate_spikerates_per_bin(channel_data, channel, num_bins, psth_cube=None):
+    if psth_cube is not None:
+        # Trials of the cube are the rows of the session channel_data was extracted from
+        binned_spike_rates = psth_cube.binned_rates(channel, num_bins)
+    else:
+        # Calculate binned spike rates for all trials at once
+        binned_spike_rates = calculate_binned_spike_rates(channel_data[f'SpikeTimes_{channel.value}'].tolist(),
+                                                          channel_data['EpochStartStop'].tolist(),
+                                                          num_bins)
+    channel_data['BinnedSpikeRates'] = list(binned_spike_rates)
     return channel_data
 
 
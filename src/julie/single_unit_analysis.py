@@ -1,36 +1,85 @@
 import os
+from datetime import date
 
 import matplotlib
 import pandas as pd
 from matplotlib import pyplot as plt
 
 from clat.intan.rhd import load_intan_rhd_format
-from julie.compile.sorted_units_compilation import read_pickle
+from julie.compile.sorted_spike_store import SortedSpikeStore, load_sorted_spikes
+from julie.compile.sorted_units_compilation import compiled_path
+from julie.compile.spike_epoching import assign_sorted_spikes_to_epochs, assign_spike_times_to_epochs
+from julie.data_quality import reject_noisy_data
+from julie.raster import prepare_raster, plot_raster, raster_file_extension
 
-matplotlib.use("Qt5Agg")
+# Interactive by default; batch exports set MPLBACKEND (e.g. Agg) to run headless
+if "MPLBACKEND" not in os.environ:
+    matplotlib.use("Qt5Agg")
+
+
+PLOTS_DIR = "/plots/julie"
+# Written to PLOTS_DIR/round_name once the raster of every unit of a round is saved, listing the units
+SORTED_RASTERS_MARKER = "sorted_rasters_complete.txt"
 
 
 def main():
-    date = "2023-10-05"
-    round = "231005_round2"
-    sorted_spikes_filename = "sorted_spikes.pkl"
-
-    cortana_path = "/home/r2_allen/Documents/JulieIntanData/Cortana"
-    round_path = os.path.join(cortana_path, date, round)
-    compiled_trials_filepath = os.path.join(round_path, "compiled.pk1")
-    experiment_name = os.path.basename(os.path.dirname(compiled_trials_filepath))
+    plot_sorted_units(day=date(2023, 10, 5), round_name="231005_round2")
+
+
+def plot_sorted_units(day: date, round_name: str, sorted_spikes_filename: str = "sorted_spikes.pkl",
+                      show: bool = True, reject_noisy: bool = False, raster_mode: str = "vector",
+                      vector_overlay: bool = True) -> list:
+    """
+    Raster of every sorted unit of a round compiled by sorted_units_compilation, saved under PLOTS_DIR/round_name.
+
+    Parameters:
+        day (date): Recording day.
+        round_name (str): Round directory of that day, e.g. "231005_round2".
+        sorted_spikes_filename (str): Spike sorter output in the round directory.
+        show (bool): Show every figure; batch runs pass False and the figures are closed once saved.
+        reject_noisy (bool): Drop trials flagged by the data-quality stage (abnormal epochs, runaway counts or no
+            spikes) first.
+        raster_mode (str): "vector" (one line per spike) or "image" (pre-binned panels of bounded size).
+        vector_overlay (bool): Save image-mode rasters as SVG with vector axes and labels, or as plain PNG.
+
+    Returns:
+        list: The units plotted.
+    """
+    compiled_trials_filepath = compiled_path(day, round_name)
+    round_path = os.path.dirname(compiled_trials_filepath)
+    experiment_name = os.path.basename(round_path)
+    # A rerun that stops halfway must not look complete
+    marker_path = sorted_rasters_marker_path(experiment_name)
+    if os.path.exists(marker_path):
+        os.remove(marker_path)
     raw_trial_data = pd.read_pickle(compiled_trials_filepath).reset_index(drop=True)
 
     # TODO: specify which sorting pickle to use and which units to plot, then add them to dataframe
     rhd_file_path = os.path.join(round_path, "info.rhd")
-    sorted_spikes_filepath = os.path.join(cortana_path, date, round, sorted_spikes_filename)
-    sorted_spikes = read_pickle(sorted_spikes_filepath)
+    sorted_spikes_filepath = os.path.join(round_path, sorted_spikes_filename)
+    # Memory-mapped; the pickle is converted to sorted_spikes.store next to it on first use
+    sorted_spikes = load_sorted_spikes(sorted_spikes_filepath)
     sample_rate = load_intan_rhd_format.read_data(rhd_file_path)["frequency_parameters"]['amplifier_sample_rate']
     sorted_data = calculate_spike_timestamps(raw_trial_data, sorted_spikes, sample_rate)
+    if reject_noisy:
+        sorted_data, _ = reject_noisy_data(sorted_data)
+
+    units = list(raw_trial_data['SpikeTimes'][0])
+    for unit in units:
+        fig = plot_raster_for_monkeys(sorted_data, unit, experiment_name=experiment_name, show=show,
+                                      raster_mode=raster_mode, vector_overlay=vector_overlay)
+        if not show:
+            plt.close(fig)
+
+    os.makedirs(os.path.dirname(marker_path), exist_ok=True)
+    with open(marker_path + ".tmp", "w") as f:
+        f.writelines(f"{unit}\n" for unit in units)
+    os.replace(marker_path + ".tmp", marker_path)
+    return units
 
-    for unit, data in raw_trial_data['SpikeTimes'][0].items():
-        plot_raster_for_monkeys(sorted_data, unit, experiment_name=experiment_name)
-    # plt.show()
+
+def sorted_rasters_marker_path(round_name: str) -> str:
+    return os.path.join(PLOTS_DIR, round_name, SORTED_RASTERS_MARKER)
 
 
 def calculate_spike_timestamps(df: pd.DataFrame, spike_indices_by_unit_by_channel: dict, sample_rate: int):
@@ -39,104 +88,47 @@ def calculate_spike_timestamps(df: pd.DataFrame, spike_indices_by_unit_by_channe
 
     Parameters:
     - df: Pandas DataFrame with a column 'EpochStartStop' containing tuples of (epoch_start, epoch_stop)
-    - spike_indices_by_unit_by_channel: Dictionary of channels to a dict of Units to spike indices
+    - spike_indices_by_unit_by_channel: Dictionary of channels to a dict of Units to spike indices, or a
+      SortedSpikeStore (spike times are then views into the store's memory map)
     - sample_rate: The sample rate for the spike indices
 
     Returns:
     - new_df: A new DataFrame with an additional column containing the calculated spike timestamps
     """
 
-    def single_row_calculation(epoch_start_stop):
-        epoch_start, epoch_stop = epoch_start_stop
-        spikes_tstamps_by_unit = {}
-
-        for channel, spike_indices_by_unit in reversed(spike_indices_by_unit_by_channel.items()):
-            for unit_name, spike_indices in spike_indices_by_unit.items():
-                new_unit_name = f"{channel}_{unit_name}"
-
-                # Filter and convert spike indices to timestamps
-                spike_times = [spike_index / sample_rate for spike_index in spike_indices]
-                valid_spike_times = []
-                valid_spike_times = [
-                    spike_time
-                    for spike_time in spike_times
-                    if epoch_start <= spike_time < epoch_stop
-                ]
-
-                spikes_tstamps_by_unit[new_unit_name] = valid_spike_times
-
-        return spikes_tstamps_by_unit
-
-    df['SpikeTimes'] = df['EpochStartStop'].apply(single_row_calculation)
+    epoch_start_stop_by_row = {row: epoch_start_stop for row, epoch_start_stop in enumerate(df['EpochStartStop'])
+                               if epoch_start_stop is not None}
+    # Spike times are views into one array per unit, sliced for every row in a single sweep
+    if isinstance(spike_indices_by_unit_by_channel, SortedSpikeStore):
+        spike_times_by_unit = spike_indices_by_unit_by_channel.spike_times_by_unit(sample_rate, reverse_channels=True)
+        spikes_tstamps_by_unit_by_row = assign_spike_times_to_epochs(spike_times_by_unit, epoch_start_stop_by_row)
+    else:
+        spikes_tstamps_by_unit_by_row = assign_sorted_spikes_to_epochs(spike_indices_by_unit_by_channel, sample_rate,
+                                                                       epoch_start_stop_by_row,
+                                                                       reverse_channels=True)
+
+    df['SpikeTimes'] = [spikes_tstamps_by_unit_by_row.get(row) for row in range(len(df))]
     return df
 
 
-def extract_target_unit_data(unit, data):
-    # Get SpikeTimes for channel
-    unit_data = data.copy()
-    unit_data[f'SpikeTimes_{unit}'] = data['SpikeTimes'].apply(lambda x: x[unit] if unit in x else [])
-    return unit_data
-
-
-def plot_raster_for_monkeys(raw_data, unit, experiment_name=None):
-    unit_data = extract_target_unit_data(unit, raw_data)
-    unique_monkey_groups = unit_data['MonkeyGroup'].dropna().unique().tolist()
-    N = len(unit_data)
-
-    max_rows = 0
-    for group_name in unique_monkey_groups:
-        group_data = unit_data[unit_data['MonkeyGroup'] == group_name]
-        unique_monkeys = group_data['MonkeyName'].dropna().unique().tolist()
-        max_rows = max(max_rows, len(unique_monkeys))
-
-    fig = plt.figure(figsize=(15 * len(unique_monkey_groups), 45 * max_rows))
-
-    for col_idx, group_name in enumerate(unique_monkey_groups):
-        group_data = unit_data[unit_data['MonkeyGroup'] == group_name]
-        unique_monkeys = group_data['MonkeyName'].dropna().unique().tolist()
-
-        for row_idx, monkey_name in enumerate(unique_monkeys):
-            monkey_data = group_data[group_data['MonkeyName'] == monkey_name]
-
-            ax = fig.add_subplot(max_rows, len(unique_monkey_groups), row_idx * len(unique_monkey_groups) + col_idx + 1)
-
-            filtered_spike_times_list = []
-            for idx, row in monkey_data.iterrows():
-                spike_times = row[f'SpikeTimes_{unit}']
-                epoch_start, epoch_stop = row['EpochStartStop']
-
-                # Filter spikes based on EpochStartStop and subtract the epoch start time
-                filtered_spike_times = [spike - epoch_start for spike in spike_times if
-                                        epoch_start <= spike <= epoch_stop]
-                filtered_spike_times_list.append(filtered_spike_times)
-
-            ax.eventplot(filtered_spike_times_list, color='black', linewidths=0.5)
-            ax.set_xlim(0, 2.0)
-            ax.set_yticks([len(filtered_spike_times_list)])
-            # Place the title text to the right of the subplot
-            ax.text(1.05, 0.5, f"{monkey_name}", transform=ax.transAxes, ha='left', va='center', fontsize=14)
-
-        fig.text(0.5 / len(unique_monkey_groups) + col_idx / len(unique_monkey_groups), 0.95, f'{group_name}',
-                 ha='center', va='center')
-
-    # fig.text(0.5, 0.01, 'Monkey Groups', ha='center', va='center')
-    fig.text(0.5, 0.05, 'Time (s)', ha='center', va='center', rotation='horizontal')
-    fig.text(0.99, 0.95, f'N: {N}', ha='right', va='bottom')
-    fig.suptitle(f'Raster Plots for Individual Monkeys: Channel: {unit}')
+def plot_raster_for_monkeys(raw_data, unit, experiment_name=None, show=True, raster_mode="vector",
+                            vector_overlay=True):
+    spike_trains = [spike_times_by_unit.get(unit) if isinstance(spike_times_by_unit, dict) else None
+                    for spike_times_by_unit in raw_data['SpikeTimes']]
+    layout = prepare_raster(raw_data, spike_trains)
+    fig = plot_raster(layout, f'Raster Plots for Individual Monkeys: Channel: {unit}', mode=raster_mode)
 
-    plt.subplots_adjust(hspace=1.0, wspace=1.0)
-    plt.show()
+    if show:
+        plt.show()
     ## SAVE PLOTS
-    base_save_dir = "/plots/julie"
+    base_save_dir = PLOTS_DIR
     if experiment_name is not None:
         save_dir = os.path.join(base_save_dir, experiment_name)
         os.makedirs(save_dir, exist_ok=True)
 
         # Save individual plot
-        individual_save_path_png = os.path.join(save_dir, f"{experiment_name}_{unit}_sorted_raster.png")
-        individual_save_path_svg = os.path.join(save_dir, f"{experiment_name}_{unit}_sorted_raster.svg")
-        fig.savefig(individual_save_path_svg)
-        # fig.savefig(individual_save_path_png)
+        extension = raster_file_extension(raster_mode, vector_overlay)
+        fig.savefig(os.path.join(save_dir, f"{experiment_name}_{unit}_sorted_raster.{extension}"))
 
     return fig
 
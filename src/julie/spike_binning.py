@@ -0,0 +1,174 @@
+import numpy as np
+
+
+def flatten_spike_trains(spike_trains) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Pack a sequence of per-trial spike time lists into one flat array.
+
+    Parameters:
+        spike_trains: Sequence with one entry per trial. Each entry is a list/array of spike times
+            or None (treated as a trial without spikes).
+
+    Returns:
+        tuple: (spike_times, offsets). spike_times is a float64 array holding every trial's spikes,
+        sorted within each trial. offsets has length n_trials + 1 and trial i occupies
+        spike_times[offsets[i]:offsets[i + 1]].
+    """
+    counts = np.zeros(len(spike_trains), dtype=np.int64)
+    arrays = []
+    for i, spikes in enumerate(spike_trains):
+        if spikes is None or isinstance(spikes, str):
+            continue
+        spikes = np.asarray(spikes, dtype=np.float64).ravel()
+        counts[i] = spikes.size
+        arrays.append(spikes)
+
+    offsets = np.zeros(len(spike_trains) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    if not arrays:
+        return np.empty(0, dtype=np.float64), offsets
+
+    spike_times = np.concatenate(arrays)
+    trial_indices = np.repeat(np.arange(len(spike_trains)), counts)
+    # Sort by trial first, then by time, so each trial's slice is sorted
+    order = np.lexsort((spike_times, trial_indices))
+    return spike_times[order], offsets
+
+
+def count_spikes_in_windows(spike_times: np.ndarray, offsets: np.ndarray,
+                            window_starts: np.ndarray, window_stops: np.ndarray) -> np.ndarray:
+    """
+    Count spikes inside half-open windows [start, stop) for every trial at once.
+
+    Parameters:
+        spike_times (np.ndarray): Flat spike times from flatten_spike_trains.
+        offsets (np.ndarray): Trial offsets from flatten_spike_trains.
+        window_starts (np.ndarray): (n_trials x n_windows) window start times.
+        window_stops (np.ndarray): (n_trials x n_windows) window stop times.
+
+    Returns:
+        np.ndarray: (n_trials x n_windows) int64 spike counts.
+    """
+    window_starts = np.asarray(window_starts, dtype=np.float64)
+    window_stops = np.asarray(window_stops, dtype=np.float64)
+    lower = _count_spikes_before(spike_times, offsets, window_starts)
+    upper = _count_spikes_before(spike_times, offsets, window_stops)
+    return upper - lower
+
+
+def count_spikes_between_edges(spike_times: np.ndarray, offsets: np.ndarray, edges: np.ndarray) -> np.ndarray:
+    """
+    Count spikes in consecutive half-open windows [edges[:, j], edges[:, j + 1]) of every trial, with a
+    single sort (count_spikes_in_windows sorts once for the starts and once for the stops).
+
+    Parameters:
+        spike_times (np.ndarray): Flat spike times from flatten_spike_trains.
+        offsets (np.ndarray): Trial offsets from flatten_spike_trains.
+        edges (np.ndarray): (n_trials x n_edges) non-decreasing window edges.
+
+    Returns:
+        np.ndarray: (n_trials x n_edges - 1) int64 spike counts.
+    """
+    before = _count_spikes_before(spike_times, offsets, np.asarray(edges, dtype=np.float64))
+    return np.diff(before, axis=1)
+
+
+def _count_spikes_before(spike_times: np.ndarray, offsets: np.ndarray, edges: np.ndarray) -> np.ndarray:
+    """
+    Per-trial searchsorted(side='left'): for every edge, the number of that trial's spikes strictly
+    before it. Done for all trials in a single sort by merging edges into the spike array with
+    (trial, time, is_spike) keys, so edges sort ahead of spikes that sit exactly on them.
+    """
+    n_trials, n_edges = edges.shape
+    n_spikes = spike_times.size
+    spike_trials = np.repeat(np.arange(n_trials), np.diff(offsets))
+    edge_trials = np.repeat(np.arange(n_trials), n_edges)
+
+    values = np.concatenate((spike_times, edges.ravel()))
+    trials = np.concatenate((spike_trials, edge_trials))
+    is_spike = np.concatenate((np.ones(n_spikes, dtype=np.int8), np.zeros(edges.size, dtype=np.int8)))
+
+    order = np.lexsort((is_spike, values, trials))
+    spikes_before_position = np.cumsum(is_spike[order]) - is_spike[order]
+    positions = np.empty_like(order)
+    positions[order] = np.arange(order.size)
+
+    # Every spike of earlier trials also sorts before the edge; remove them
+    counts = spikes_before_position[positions[n_spikes:]] - offsets[edge_trials]
+    return counts.reshape(n_trials, n_edges)
+
+
+def spike_bounds_in_epochs(spike_times: np.ndarray, offsets: np.ndarray, epochs: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Positions of each trial's spikes inside its closed epoch [start, stop].
+
+    Parameters:
+        spike_times (np.ndarray): Flat spike times from flatten_spike_trains.
+        offsets (np.ndarray): Trial offsets from flatten_spike_trains.
+        epochs (np.ndarray): (n_trials x 2) epochs from epochs_to_array. Rows of NaN select no spikes.
+
+    Returns:
+        tuple: (lo, hi) int64 arrays. Trial i's spikes in its epoch are spike_times[lo[i]:hi[i]].
+    """
+    has_epoch = ~np.isnan(epochs[:, 0])
+    starts = np.where(has_epoch, epochs[:, 0], 0.0)
+    # A spike exactly on the stop time is kept, so count up to the next float above it
+    stops = np.where(has_epoch, np.nextafter(epochs[:, 1], np.inf), 0.0)
+    before = _count_spikes_before(spike_times, offsets, np.column_stack((starts, stops)))
+    lo = offsets[:-1] + before[:, 0]
+    hi = np.maximum(offsets[:-1] + before[:, 1], lo)
+    return lo, hi
+
+
+def calculate_binned_spike_rates(spike_trains, epochs, num_bins: int) -> np.ndarray:
+    """
+    Calculate binned spike rates for every trial of a channel in one batch.
+
+    Gives the same numbers as calling single_channel_analysis.calculate_binned_spike_rate per trial:
+    each epoch is split into num_bins bins built as start + i * bin_duration, a spike counts toward a bin
+    if bin_start <= spike < bin_end, and trials with no spikes or no epoch give rows of zeros.
+
+    Parameters:
+        spike_trains: Sequence of per-trial spike time lists (None allowed).
+        epochs: Sequence of per-trial (epoch_start, epoch_stop) tuples (None allowed).
+        num_bins (int): Number of bins per epoch.
+
+    Returns:
+        np.ndarray: (n_trials x num_bins) float64 matrix of spike rates.
+    """
+    n_trials = len(spike_trains)
+    epoch_array = epochs_to_array(epochs)
+    has_data = ~np.isnan(epoch_array[:, 0])
+    for i, spikes in enumerate(spike_trains):
+        if spikes is None or isinstance(spikes, str):
+            has_data[i] = False
+
+    start_times = np.where(has_data, epoch_array[:, 0], 0.0)
+    end_times = np.where(has_data, epoch_array[:, 1], 0.0)
+    bin_durations = (end_times - start_times) / num_bins
+
+    # Same float arithmetic as calculate_binned_spike_rate so bin edges match to the last bit
+    bin_starts = start_times[:, None] + np.arange(num_bins)[None, :] * bin_durations[:, None]
+    bin_ends = bin_starts + bin_durations[:, None]
+    durations = bin_ends - bin_starts
+
+    spike_times, offsets = flatten_spike_trains(spike_trains)
+    counts = count_spikes_in_windows(spike_times, offsets, bin_starts, bin_ends)
+
+    rates = np.zeros((n_trials, num_bins), dtype=np.float64)
+    valid = has_data[:, None] & (bin_starts < bin_ends) & (durations != 0)
+    np.divide(counts, durations, out=rates, where=valid)
+    return rates
+
+
+def epochs_to_array(epochs) -> np.ndarray:
+    """
+    Convert a sequence of (epoch_start, epoch_stop) tuples into an (n x 2) float64 array.
+    Missing epochs become rows of NaN.
+    """
+    epoch_array = np.full((len(epochs), 2), np.nan, dtype=np.float64)
+    for i, epoch in enumerate(epochs):
+        if epoch is None or isinstance(epoch, str):
+            continue
+        epoch_array[i] = epoch
+    return epoch_array
@@ -0,0 +1,5 @@
+import os
+import sys
+
+os.environ.setdefault("MPLBACKEND", "Agg")
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
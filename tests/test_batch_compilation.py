@@ -0,0 +1,29 @@
+import os
+import time
+
+from julie.compile import batch_compilation
+from julie.compile.batch_compilation import CompileJob, run_batch
+
+
+def run_fake_job(job: CompileJob, **options):
+    if job.experiment == "crash":
+        os._exit(1)
+    time.sleep(0.2)
+
+
+def test_a_dying_worker_fails_only_its_own_job(tmp_path, monkeypatch):
+    # Worker processes are forked, so they see the patched runners
+    monkeypatch.setitem(batch_compilation.JOB_RUNNERS, "manual_thresh", run_fake_job)
+    monkeypatch.setattr(CompileJob, "is_complete", lambda self: False)
+    manifest_path = tmp_path / "manifest.csv"
+    manifest_path.write_text("day,experiment,mode,start_time,end_time\n"
+                             + "".join(f"2023-10-11,{name},manual_thresh,,\n"
+                                       for name in ("ok1", "crash", "ok2", "ok3", "ok4")))
+
+    summary = run_batch(str(manifest_path), processes=3, max_attempts=2, retry_delay=0.0).set_index("job_id")
+
+    assert summary.loc["manual_thresh/2023-10-11/crash", "status"] == "failed"
+    assert summary.loc["manual_thresh/2023-10-11/crash", "attempts"] == 2
+    for name in ("ok1", "ok2", "ok3", "ok4"):
+        assert summary.loc[f"manual_thresh/2023-10-11/{name}", "status"] == "done"
+        assert summary.loc[f"manual_thresh/2023-10-11/{name}", "attempts"] == 1
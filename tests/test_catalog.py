@@ -0,0 +1,33 @@
+from datetime import date
+
+import pandas as pd
+
+from julie.catalog import CATALOG_FILENAME, SessionCatalog
+
+ROUND_THREE_PARTS = ["1695326404335201_230921_160004", "1695328203112345_230921_163003"]
+
+
+def write_compiled(path, task_ids):
+    pd.DataFrame({"TaskField": task_ids, "MonkeyName": ["Bart"] * len(task_ids),
+                  "SpikeTimes": [{"A-000": [0.1]} for _ in task_ids]}).to_pickle(path)
+
+
+def test_parts_take_the_round_of_their_merged_file(tmp_path):
+    write_compiled(tmp_path / f"{ROUND_THREE_PARTS[0]}.pk1", [1, 2])
+    write_compiled(tmp_path / f"{ROUND_THREE_PARTS[1]}.pk1", [3])
+    write_compiled(tmp_path / f"{'&'.join(ROUND_THREE_PARTS)}_round3.pk1", [1, 2, 3])
+    write_compiled(tmp_path / "1696367719246571_231003_171519.pk1", [4])
+    write_compiled(tmp_path / "1696367719246571_231003_171519&1696369421224313_231003_174341_round3.pk1", [4])
+    write_compiled(tmp_path / "1696440834320912_231004_133354_round2.pk1", [5])
+
+    catalog = SessionCatalog(str(tmp_path / CATALOG_FILENAME))
+    try:
+        catalog.scan(str(tmp_path))
+
+        paths = catalog.find_sessions(day_to=date(2023, 9, 30), rounds=[3])
+        assert paths == [str(tmp_path / f"{part}.pk1") for part in ROUND_THREE_PARTS]
+        assert len(catalog.find_sessions(rounds=[3])) == 3
+        assert catalog.find_sessions(rounds=[2]) == [str(tmp_path / "1696440834320912_231004_133354_round2.pk1")]
+        assert catalog.query_trials(day_to=date(2023, 9, 30), rounds=[3])["TaskField"].tolist() == [1, 2, 3]
+    finally:
+        catalog.close()
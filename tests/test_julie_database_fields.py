@@ -0,0 +1,14 @@
+from julie.compile.julie_database_fields import MonkeyGroupField, MonkeyMetadataResolver, MonkeyNameField
+from julie.compile.sqlite_stand_in import insert_picture, insert_trial, open_stand_in_connections
+
+
+def test_resolver_matches_fields_for_zero_padded_monkey_ids(tmp_path):
+    conn_xper, conn_photo = open_stand_in_connections(str(tmp_path))
+    insert_picture(conn_photo, monkey_id=66, monkey_name="Bart", jpg_id=3, monkey_group="Zombies")
+    insert_trial(conn_xper, task_id=1, stim_id=1, picture_path="/pictures/066.jpg", slide_off_tstamp=5)
+
+    metadata = MonkeyMetadataResolver(conn_xper=conn_xper, conn_photo=conn_photo).get(1)
+
+    assert metadata.monkey_name == MonkeyNameField(conn_xper=conn_xper, conn_photo=conn_photo).get(1) == "Bart"
+    assert metadata.jpg_id == 3
+    assert metadata.monkey_group == MonkeyGroupField(conn_xper=conn_xper, conn_photo=conn_photo).get(1) == "Zombies"
@@ -0,0 +1,29 @@
+import matplotlib
+
+from julie.benchmarks.synthetic import StandInRecorder, SyntheticSessionSpec
+from julie.compile.julie_intan_file_per_experiment_fields import parse_intan_experiment_directory
+from julie.compile.live_compilation import LiveSessionCompiler
+
+
+def test_live_session_matches_the_end_of_day_parse(tmp_path):
+    backend = matplotlib.get_backend()
+    spec = SyntheticSessionSpec(n_trials=60, n_channels=4, n_monkeys=8)
+    recorder = StandInRecorder(spec, str(tmp_path / "experiment"))
+    plot_path = tmp_path / "live_overview.png"
+    compiler = LiveSessionCompiler(intan_file_path=recorder.directory, conn_xper=recorder.conn_xper,
+                                   conn_photo=recorder.conn_photo, start_unix=recorder.start_unix,
+                                   end_unix=recorder.start_unix + 10 ** 12, plot_path=str(plot_path))
+    while not recorder.done:
+        recorder.advance(1.5)
+        compiler.poll()
+    data = compiler.finish()
+
+    spike_times_by_task_id, epoch_start_stop_by_task_id, _ = parse_intan_experiment_directory(recorder.directory)
+    assert data["TaskField"].tolist() == recorder.complete_task_ids()
+    for task_id, spike_times, epoch in zip(data["TaskField"], data["SpikeTimes"], data["EpochStartStop"]):
+        assert epoch == epoch_start_stop_by_task_id[task_id]
+        assert spike_times == spike_times_by_task_id[task_id]
+    assert data["MonkeyName"].notna().any()
+    assert plot_path.exists()
+    # Drawing the overview leaves pyplot's backend alone
+    assert matplotlib.get_backend() == backend
@@ -0,0 +1,39 @@
+from clat.compile.task.task_field import TaskFieldList
+
+from julie.compile.julie_database_fields import MonkeyMetadataResolver, MonkeyNameField, MonkeyGroupField
+from julie.compile.manual_thresh_compilation import METADATA_FIELD_NAMES, metadata_fingerprints
+from julie.compile.picture_metadata_cache import PictureMetadataCache
+from julie.compile.sqlite_stand_in import insert_picture, insert_trial, open_stand_in_connections
+from julie.compile.task_result_cache import TaskResultCache, cache_task_fields, database_fingerprint, \
+    uncached_task_ids
+
+
+def compile_metadata(tmp_path, conn_xper, conn_photo) -> tuple:
+    # The metadata part of collect_raw_data_*: cached fields, bulk resolve of the uncached tasks, then evaluation
+    cache = TaskResultCache(str(tmp_path / "task_cache.sqlite"))
+    picture_cache = PictureMetadataCache(str(tmp_path / "picture_metadata.sqlite"))
+    try:
+        resolver = MonkeyMetadataResolver(conn_xper=conn_xper, conn_photo=conn_photo, picture_cache=picture_cache)
+        fields = TaskFieldList()
+        fields.append(MonkeyNameField(conn_xper=conn_xper, conn_photo=conn_photo, resolver=resolver))
+        fields.append(MonkeyGroupField(conn_xper=conn_xper, conn_photo=conn_photo, resolver=resolver))
+        database = database_fingerprint(conn_xper)
+        fields = cache_task_fields(fields, cache, lambda task_id: database,
+                                   metadata_fingerprints(conn_xper, conn_photo, picture_cache))
+        resolver.resolve(uncached_task_ids(fields, [1], METADATA_FIELD_NAMES))
+        return tuple(field.get(1) for field in fields)
+    finally:
+        cache.close()
+        picture_cache.close()
+
+
+def test_editing_photo_metadata_recompiles_cached_metadata(tmp_path):
+    conn_xper, conn_photo = open_stand_in_connections(str(tmp_path))
+    insert_picture(conn_photo, monkey_id=12, monkey_name="Bart", jpg_id=3, monkey_group="Zombies")
+    insert_trial(conn_xper, task_id=1, stim_id=1, picture_path="/pictures/012.jpg", slide_off_tstamp=5)
+    assert compile_metadata(tmp_path, conn_xper, conn_photo) == ("Bart", "Zombies")
+
+    conn_photo.execute("UPDATE combined_view SET monkey_name = %s WHERE monkey_id = %s", ("Lisa", 12))
+    conn_photo.execute("UPDATE photos SET monkey_group = %s WHERE jpg_id = %s", ("Humans", 3))
+
+    assert compile_metadata(tmp_path, conn_xper, conn_photo) == ("Lisa", "Humans")
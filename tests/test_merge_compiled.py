@@ -0,0 +1,16 @@
+import pandas as pd
+
+from julie.compile.merge_compiled import add_pickled_dataframes, merge_to_file
+
+
+def test_merging_a_merge_keeps_its_session_tags(tmp_path):
+    pd.DataFrame({"TaskId": [1, 2], "X": [1, 2]}).to_pickle(tmp_path / "a.pk1")
+    pd.DataFrame({"X": [3], "TaskId": [3]}).to_pickle(tmp_path / "b.pk1")
+    pd.DataFrame({"TaskId": [4], "X": [4]}).to_pickle(tmp_path / "c.pk1")
+    merge_to_file([tmp_path / "a.pk1", tmp_path / "b.pk1"], str(tmp_path / "ab.pk1"))
+
+    data = add_pickled_dataframes([tmp_path / "ab.pk1", tmp_path / "c.pk1"])
+
+    assert list(data.columns) == ["TaskId", "X", "Session"]
+    assert data["TaskId"].tolist() == [1, 2, 3, 4]
+    assert data["Session"].tolist() == ["a", "a", "b", "c"]
@@ -0,0 +1,36 @@
+import pytest
+
+from julie.compile.julie_database_fields import MonkeyMetadataResolver
+from julie.compile.picture_metadata_cache import PictureMetadataCache
+from julie.compile.sqlite_stand_in import insert_picture, insert_trial, open_stand_in_connections
+
+
+def resolve_names(tmp_path, conn_xper, conn_photo) -> dict:
+    cache = PictureMetadataCache(str(tmp_path / "picture_metadata.sqlite"), version_check_interval=0)
+    try:
+        resolver = MonkeyMetadataResolver(conn_xper=conn_xper, conn_photo=conn_photo, picture_cache=cache)
+        return {task_id: metadata.monkey_name for task_id, metadata in resolver.resolve([1, 2, 3]).items()}
+    finally:
+        cache.close()
+
+
+@pytest.mark.parametrize("edit, expected", [
+    # Same length and still between the other names, so lengths, counts, MIN and MAX don't change
+    ([("Bort", 12)], {1: "Bort", 2: "Lisa", 3: "Abe"}),
+    # Two monkeys swap names, so the set of names doesn't change
+    ([("Lisa", 12), ("Bart", 13)], {1: "Lisa", 2: "Bart", 3: "Abe"}),
+])
+def test_renames_invalidate_cached_pictures(tmp_path, edit, expected):
+    conn_xper, conn_photo = open_stand_in_connections(str(tmp_path))
+    insert_picture(conn_photo, monkey_id=12, monkey_name="Bart", jpg_id=3, monkey_group="Zombies")
+    insert_picture(conn_photo, monkey_id=13, monkey_name="Lisa", jpg_id=4, monkey_group="Zombies")
+    insert_picture(conn_photo, monkey_id=14, monkey_name="Abe", jpg_id=5, monkey_group="Zombies")
+    insert_trial(conn_xper, task_id=1, stim_id=1, picture_path="/pictures/012.jpg", slide_off_tstamp=5)
+    insert_trial(conn_xper, task_id=2, stim_id=2, picture_path="/pictures/013.jpg", slide_off_tstamp=6)
+    insert_trial(conn_xper, task_id=3, stim_id=3, picture_path="/pictures/014.jpg", slide_off_tstamp=7)
+    assert resolve_names(tmp_path, conn_xper, conn_photo) == {1: "Bart", 2: "Lisa", 3: "Abe"}
+
+    for monkey_name, monkey_id in edit:
+        conn_photo.execute("UPDATE combined_view SET monkey_name = %s WHERE monkey_id = %s", (monkey_name, monkey_id))
+
+    assert resolve_names(tmp_path, conn_xper, conn_photo) == expected
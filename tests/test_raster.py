@@ -0,0 +1,33 @@
+import numpy as np
+import pandas as pd
+import pytest
+from matplotlib import pyplot as plt
+
+from julie.raster import prepare_raster, plot_raster, RASTER_TIME_LIMIT
+
+
+def _one_spike_per_trial(n_trials: int, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    spike_times = rng.uniform(0, RASTER_TIME_LIMIT, n_trials)
+    metadata = pd.DataFrame({"MonkeyGroup": ["Zombies"] * n_trials, "MonkeyName": ["151J"] * n_trials,
+                             "EpochStartStop": [(10.0 * trial, 10.0 * trial + RASTER_TIME_LIMIT)
+                                                for trial in range(n_trials)]})
+    spike_trains = [[10.0 * trial + spike_time] for trial, spike_time in enumerate(spike_times)]
+    return metadata, spike_trains, spike_times
+
+
+@pytest.mark.parametrize("n_trials", [40, 1000])
+def test_image_mode_draws_every_spike(n_trials):
+    metadata, spike_trains, spike_times = _one_spike_per_trial(n_trials)
+    fig = plot_raster(prepare_raster(metadata, spike_trains), "test", mode="image")
+    fig.canvas.draw()
+    pixels = np.asarray(fig.canvas.buffer_rgba())[:, :, :3].min(axis=2)
+    ax = fig.axes[0]
+    height = pixels.shape[0]
+    for trial, spike_time in enumerate(spike_times):
+        x, y = ax.transData.transform((spike_time, trial))
+        column, row = int(x), int(height - y)
+        # Binning to a pixel column and resampling each move a spike by up to one pixel
+        assert pixels[max(row - 1, 0):row + 2, max(column - 2, 0):column + 3].min() < 128, \
+            f"spike of trial {trial} at {spike_time:.4f} s is not drawn"
+    plt.close(fig)